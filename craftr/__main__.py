@@ -16,9 +16,11 @@
 
 from craftr import core
 from craftr.core.config import read_config_file, InvalidConfigError
-from craftr.core.logging import logger
+from craftr.core.logging import logger, set_logger, DefaultLogger, JsonLinesLogger
 from craftr.core.session import session, Session, Module, MANIFEST_FILENAMES
-from craftr.utils import path, shell, tty, cson
+from craftr.core import actioncache, archivecache, remote, resources, rusage, trace
+from craftr import daemon
+from craftr.utils import path, pyutils, shell, tty, cson
 from operator import attrgetter
 from nr.types.version import Version, VersionCriteria
 
@@ -27,14 +29,21 @@ import argparse
 import atexit
 import collections
 import configparser
+import contextlib
 import craftr.defaults
+import craftr.loaders
+import craftr.stats
 import craftr.targetbuilder
+import fnmatch
 import functools
+import io
 import json
 import os
 import pdb
 import sys
 import textwrap
+import time
+import traceback
 
 CONFIG_FILENAME = '.craftrconfig'
 INIT_DIR = path.getcwd()
@@ -213,6 +222,41 @@ def get_ninja_info():
   return ninja_bin, ninja_version
 
 
+def get_current_location():
+  """
+  Returns the filename and line of the module that is currently executed
+  as a string, or None.
+  """
+
+  module = session.module
+  if not module:
+    return None
+  try:
+    return '{}:{}'.format(module.scriptfile, module.current_line)
+  except RuntimeError:
+    return None
+
+
+def get_target_deps(graph):
+  """
+  Returns a dictionary that maps the name of every target in the *graph*
+  to the names of the targets that it depends on.
+  """
+
+  result = {}
+  for target in graph.targets.values():
+    deps = set()
+    for filename in target.inputs + target.implicit_deps + target.order_only_deps:
+      if filename in graph.outfiles:
+        deps.add(graph.outfiles[filename].name)
+      elif filename in graph.targets:
+        deps.add(filename)
+    deps.discard(target.name)
+    if deps:
+      result[target.name] = sorted(deps)
+  return result
+
+
 def finally_(finally_func):
   """
   Decorator that calls *finally_func* after the decorated function.
@@ -247,7 +291,8 @@ class BuildCommand(BaseCommand):
 
   def __init__(self, mode):
     assert mode in ('clean', 'build', 'export', 'run', 'help',
-                    'dump-options', 'dump-deptree', 'lock')
+                    'dump-options', 'dump-deptree', 'lock', 'stats', 'query',
+                    'fetch')
     self.mode = mode
 
   def build_parser(self, parser):
@@ -257,15 +302,21 @@ class BuildCommand(BaseCommand):
     # after the sub-command.
     add_arg('-v', '--verbose', action='store_true')
 
-    if self.mode not in ('dump-options', 'dump-deptree'):
+    if self.mode not in ('dump-options', 'dump-deptree', 'stats'):
       add_arg('-d', '--option', dest='options', action='append', default=[])
 
-    if self.mode in ('export', 'run', 'help', 'dump-options', 'dump-deptree'):
+    if self.mode in ('export', 'run', 'help', 'dump-options', 'dump-deptree',
+                     'query', 'fetch'):
       add_arg('-m', '--module')
       add_arg('-i', '--include-path', action='append', default=[])
     elif self.mode in ('build', 'clean'):
       add_arg('targets', metavar='TARGET', nargs='...')
 
+    if self.mode == 'build':
+      add_arg('--max-mem', metavar='SIZE', help='The memory that the jobs '
+        'in the "mem_heavy" pool may use together, eg. 64G. Requires that '
+        'the project was exported with the craftr.rusage option.')
+
     if self.mode == 'run':
       add_arg('task', nargs='?')
       add_arg('task_args', nargs='*')
@@ -277,6 +328,32 @@ class BuildCommand(BaseCommand):
     if self.mode == 'clean':
       add_arg('-r', '--recursive', action='store_true')
 
+    if self.mode == 'query':
+      add_arg('patterns', metavar='PATTERN', nargs='*', help='Glob patterns '
+        'for the full names of the targets to list. Defaults to all targets.')
+      add_arg('--json', action='store_true', help='Print the inputs, outputs '
+        'and dependencies of the targets as JSON.')
+
+    if self.mode == 'export':
+      add_arg('--trace', metavar='FILE', help='Record a timeline of the '
+        'export in the Chrome trace-event format to FILE.')
+
+    if self.mode in ('export', 'run', 'query'):
+      add_arg('--offline', action='store_true', help='Do not download '
+        'anything, fail if a loader needs a file that was not downloaded '
+        'before, eg. with "craftr fetch". Same as -d craftr.offline=true.')
+
+    if self.mode == 'fetch':
+      add_arg('-j', '--jobs', type=int, default=4, help='The number of '
+        'concurrent downloads and extractions.')
+
+    if self.mode == 'stats':
+      add_arg('--build', type=int, help='The ID of the build to report on. '
+        'Defaults to the most recent build.')
+      add_arg('--compare', metavar='REV', help='Compare the build with the '
+        'most recent build of the Git revision REV, eg. HEAD~1.')
+      add_arg('--top', type=int, default=10)
+
     if self.mode == 'help':
       add_arg('name', help='The name of the symbols to show help for. Must be '
         'in the format <module>:<symbol> where <module> is the name of a '
@@ -297,11 +374,27 @@ class BuildCommand(BaseCommand):
     if os.path.isdir(session.builddir) and not os.listdir(session.builddir):
       logger.debug('note: cleanup empty build directory:', session.builddir)
       os.rmdir(session.builddir)
+    elif os.path.isdir(session.builddir):
+      shell.save_program_cache(path.join(session.builddir, shell.PROGRAM_CACHE_FILENAME))
 
-  @finally_(__cleanup)
   def execute(self, parser, args):
+    if not getattr(args, 'trace', None):
+      return self._execute(parser, args)
+    filename = path.norm(args.trace, INIT_DIR)
+    trace.enable(line_provider=get_current_location)
+    try:
+      return self._execute(parser, args)
+    finally:
+      trace.disable().save(filename)
+      logger.info('trace written to "{}"'.format(filename))
+
+  @finally_(__cleanup)
+  def _execute(self, parser, args):
     if hasattr(args, 'include_path'):
-      session.path.extend(map(path.norm, args.include_path))
+      # The command may be executed multiple times, see WatchCommand.
+      for directory in map(path.norm, args.include_path):
+        if directory not in session.path:
+          session.path.append(directory)
 
     # Help-command preprocessing. Check if we're to show the help on a builtin
     # object, otherwise extract the module name if applicable.
@@ -321,17 +414,20 @@ class BuildCommand(BaseCommand):
 
     module = self._find_module(parser, args)
     session.main_module = module
-    self.ninja_bin, self.ninja_version = get_ninja_info()
 
     # Create and switch to the build directory.
     session.builddir = path.abs(path.norm(args.build_dir, INIT_DIR))
     path.makedirs(session.builddir)
     os.chdir(session.builddir)
     self.cachefile = path.join(session.builddir, '.craftrcache')
+    shell.load_program_cache(path.join(session.builddir, shell.PROGRAM_CACHE_FILENAME))
+    self.ninja_bin, self.ninja_version = get_ninja_info()
 
     # Prepare options, loaders and execute.
-    if self.mode in ('export', 'run', 'help'):
+    if self.mode in ('export', 'run', 'help', 'query'):
       return self._export_run_or_help(args, module)
+    elif self.mode == 'fetch':
+      return self._fetch(args, module)
     elif self.mode == 'dump-options':
       return self._dump_options(args, module)
     elif self.mode == 'dump-deptree':
@@ -340,6 +436,8 @@ class BuildCommand(BaseCommand):
       return self._build_or_clean(args)
     elif self.mode == 'lock':
       self._create_lockfile()
+    elif self.mode == 'stats':
+      return self._stats(args)
     else:
       raise RuntimeError("mode: {}".format(self.mode))
 
@@ -349,7 +447,8 @@ class BuildCommand(BaseCommand):
     modes that do not require a main module.
     """
 
-    if self.mode not in ('export', 'run', 'help', 'dump-options', 'dump-deptree'):
+    if self.mode not in ('export', 'run', 'help', 'dump-options', 'dump-deptree',
+                         'query', 'fetch'):
       return None
 
     # Determine the module to execute, either from the current working
@@ -380,24 +479,24 @@ class BuildCommand(BaseCommand):
 
   def _export_run_or_help(self, args, module):
     """
-    Called when the mode is 'export' or 'run'. Will execute the specified
-    *module* and eventually export a Ninja manifest and Cache.
+    Called when the mode is 'export', 'run', 'help' or 'query'. Will execute
+    the specified *module* and eventually export a Ninja manifest and Cache.
+    The module is not executed again if it was already executed in this
+    session (see :class:`DaemonCommand`).
     """
 
     read_cache(False)
 
     session.expand_relative_options()
     session.cache['build'] = {}
-
-    # Load the dependency lock information if it exists.
-    deplock_fn = path.join(path.dirname(module.manifest.filename), '.dependency-lock')
-    if os.path.isfile(deplock_fn):
-      with open(deplock_fn) as fp:
-        session.preferred_versions = cson.load(fp)
-        logger.debug('note: dependency lock file "{}" loaded'.format(deplock_fn))
+    path.write_stats.clear()
+    if getattr(args, 'offline', False):
+      session.options['craftr.offline'] = 'true'
+    deplock_fn = self._load_dependency_lock(module)
 
     try:
-      module.run()
+      if not module.executed:
+        module.run()
     except Module.InvalidOption as exc:
       for error in exc.format_errors():
         logger.error(error)
@@ -412,12 +511,17 @@ class BuildCommand(BaseCommand):
         # when the cached information was not valid.
         write_cache(self.cachefile)
 
+    logger.flush()
+
     # Fill the cache.
     session.cache['build']['targets'] = list(session.graph.targets.keys())
     session.cache['build']['modules'] = serialise_loaded_module_info()
     session.cache['build']['main'] = module.ident
     session.cache['build']['options'] = args.options
     session.cache['build']['dependency_lock_filename'] = deplock_fn
+    session.cache['build']['target_outputs'] = {
+        t.name: t.outputs for t in session.graph.targets.values() if t.outputs}
+    session.cache['build']['target_deps'] = get_target_deps(session.graph)
 
     if self.mode == 'export':
       # Add the Craftr_run_command variable which is necessary for tasks
@@ -431,14 +535,60 @@ class BuildCommand(BaseCommand):
       run_command += ['-b', path.rel(session.builddir)]
       session.graph.vars['Craftr_run_command'] = shell.join(run_command)
 
+      try:
+        resources.declare_pools(session.graph, session.options)
+      except ValueError as exc:
+        logger.error('error:', exc)
+        return 1
+
       write_cache(self.cachefile)
 
-      # Write the Ninja manifest.
-      with open("build.ninja", 'w') as fp:
+      # Write the Ninja manifest, its modification time is preserved if
+      # the content did not change.
+      with io.StringIO() as fp:
         context = core.build.ExportContext(self.ninja_version)
+        workers = session.options.get('craftr.remote.workers')
+        secret = remote.get_secret(session.options)
+        if workers and not secret:
+          logger.warn('craftr.remote.secret or {} is not set, building locally'
+              .format(remote.SECRET_ENV))
+        elif workers:
+          workers = remote.query_workers(list(filter(bool,
+              (x.strip() for x in workers.split(',')))), secret)
+          if workers:
+            context.launchers.append(remote.RemoteLauncher(workers,
+                [session.maindir, session.builddir], secret=secret))
+            logger.info('using {} remote worker(s) with {} job(s)'.format(
+                len(workers), context.launchers[-1].depth))
+          else:
+            logger.warn('no remote worker is reachable, building locally')
+        if actioncache.is_enabled(session.options):
+          context.launchers.append(actioncache.ActionCacheLauncher(
+              session.builddir, session.options.get('craftr.action_cache.dir')))
+        if rusage.is_enabled(session.options):
+          # Added last so that the usage of the whole action is recorded.
+          if rusage.is_available():
+            try:
+              threshold, max_mem = self._get_rusage_options()
+            except ValueError as exc:
+              logger.error('error:', exc)
+              return 1
+            context.launchers.append(rusage.ResourceLauncher(session.builddir,
+                threshold, rusage.get_memory_budget(max_mem)))
+            if context.launchers[-1].heavy:
+              logger.info('{} target(s) in the "{}" pool'.format(
+                  len(context.launchers[-1].heavy), rusage.POOL_NAME))
+          else:
+            logger.warn('craftr.rusage is not supported on this platform')
         writer = core.build.NinjaWriter(fp)
         session.graph.export(writer, context, session.platform_helper)
-        logger.info('exported "build.ninja"')
+        if path.write_if_changed('build.ninja', fp.getvalue()):
+          logger.info('exported "build.ninja"')
+        else:
+          logger.info('"build.ninja" is up to date')
+        logger.info('{} generated file(s) written, {} unchanged'.format(
+            path.write_stats['written'], path.write_stats['unchanged']))
+        logger.flush()
 
       return 0
 
@@ -451,6 +601,21 @@ class BuildCommand(BaseCommand):
         return task.invoke(args.task_args)
       return 0
 
+    elif self.mode == 'query':
+      targets = [target for name, target in sorted(session.graph.targets.items())
+          if not args.patterns or any(fnmatch.fnmatch(name, x) for x in args.patterns)]
+      if args.json:
+        deps = session.cache['build']['target_deps']
+        print(json.dumps([{'name': target.name, 'inputs': target.inputs,
+            'outputs': target.outputs, 'deps': deps.get(target.name, [])}
+            for target in targets], indent=2))
+      else:
+        for target in targets:
+          print(target.name)
+          for filename in target.outputs:
+            print('  ' + path.rel(filename, session.maindir, nopar=True))
+      return 0
+
     elif self.mode == 'help':
       if args.name not in vars(module.namespace):
         logger.error('symbol not found: "{}:{}"'.format(
@@ -461,6 +626,74 @@ class BuildCommand(BaseCommand):
 
     assert False, "unhandled mode: {}".format(self.mode)
 
+  def _load_dependency_lock(self, module):
+    """
+    Loads the dependency lock information of the *module* if it exists.
+    Returns the filename of the lock file.
+    """
+
+    deplock_fn = path.join(path.dirname(module.manifest.filename), '.dependency-lock')
+    if os.path.isfile(deplock_fn):
+      with open(deplock_fn) as fp:
+        session.preferred_versions = cson.load(fp)
+        logger.debug('note: dependency lock file "{}" loaded'.format(deplock_fn))
+    return deplock_fn
+
+  def _fetch(self, args, module):
+    """
+    Called for the 'fetch' mode. Executes the *module* and all modules in
+    its dependency tree with :func:`craftr.loaders.record_downloads` and
+    then downloads and extracts the recorded files and archives
+    concurrently. The results are stored in the loader cache, thus the next
+    export does not have to download anything and can use ``--offline``.
+    """
+
+    read_cache(False)
+    session.expand_relative_options()
+    self._load_dependency_lock(module)
+
+    # The dependency tree from the manifests. The modules are executed
+    # separately in case a module that loads them fails, as the files that
+    # a loader returns do not exist while they are recorded.
+    modules = []
+    stack = [module]
+    while stack:
+      current = stack.pop()
+      if current in modules:
+        continue
+      modules.append(current)
+      for name, version in reversed(list(current.manifest.dependencies.items())):
+        try:
+          stack.append(session.find_module(name, version))
+        except Module.NotFound as exc:
+          logger.warn('module not found: ' + str(exc))
+
+    with craftr.loaders.record_downloads() as calls:
+      for current in modules:
+        if current.executed:
+          continue
+        try:
+          current.run()
+        except Module.InvalidOption as exc:
+          for error in exc.format_errors():
+            logger.warn(error)
+        except Exception as exc:
+          logger.debug('{}: {}: {}'.format(current.ident, type(exc).__name__, exc))
+
+    if not calls:
+      logger.info('nothing to fetch')
+      return 0
+
+    logger.info('fetching {} file(s) with {} job(s) ...'.format(len(calls), args.jobs))
+    errors = craftr.loaders.replay_downloads(calls, args.jobs)
+    write_cache(self.cachefile)
+    for exc in errors:
+      logger.error('error:', exc)
+    if errors:
+      return 1
+    logger.info('fetched {} file(s)'.format(len(calls)))
+    return 0
+
   def _dump_options(self, args, module):
     width = tty.terminal_size()[0]
 
@@ -620,6 +853,20 @@ class BuildCommand(BaseCommand):
       for key, value in targets_args_vars.items():
         logger.debug('  {}={}'.format(key, value))
 
+    if self.mode == 'build' and getattr(args, 'max_mem', None):
+      if not path.isfile(path.join(session.builddir, rusage.POOL_FILENAME)):
+        logger.error('--max-mem requires that the project is exported with '
+          'the craftr.rusage option')
+        return 1
+      try:
+        threshold = self._get_rusage_options()[0]
+        max_mem = pyutils.parse_size(args.max_mem)
+      except ValueError as exc:
+        logger.error('error:', exc)
+        return 1
+      depth = rusage.update_pool_file(session.builddir, threshold, max_mem)
+      logger.info('depth of the "{}" pool: {}'.format(rusage.POOL_NAME, depth))
+
     # Execute the ninja build.
     cmd = [self.ninja_bin]
     if args.verbose:
@@ -629,7 +876,66 @@ class BuildCommand(BaseCommand):
       if not args.recursive:
         cmd += ['-r']
     cmd += targets
-    return shell.run(cmd, env=targets_args_vars).returncode
+    returncode = shell.run(cmd, env=targets_args_vars).returncode
+
+    if self.mode == 'build':
+      # Import the timings while the commit of the project is still the
+      # one that was built.
+      try:
+        craftr.stats.import_log(session.builddir, session.maindir, session.cache['build'])
+      except craftr.stats.sqlite3.Error as exc:
+        logger.debug('note: could not import build statistics:', exc)
+      # Trim the action cache once per build instead of in every action.
+      if actioncache.is_enabled(session.options):
+        cache = actioncache.ActionCache(session.options.get('craftr.action_cache.dir'))
+        try:
+          removed, freed = cache.gc(actioncache.get_max_size(session.options))
+        except ValueError as exc:
+          logger.error('error: craftr.action_cache.max_size:', exc)
+        except OSError as exc:
+          logger.warn('could not trim the action cache:', exc)
+        else:
+          if removed:
+            logger.debug('removed {} action cache entries ({:.1f} MiB)'.format(
+                removed, freed / 1024 ** 2))
+    return returncode
+
+  def _get_rusage_options(self):
+    """
+    Returns the ``craftr.rusage.threshold`` and ``craftr.rusage.max_mem``
+    options in bytes. The latter may be :const:`None`.
+
+    :raise ValueError: If one of the options is not a valid size.
+    """
+
+    threshold = pyutils.parse_size(session.options.get('craftr.rusage.threshold', '1G'))
+    max_mem = session.options.get('craftr.rusage.max_mem')
+    return threshold, pyutils.parse_size(max_mem) if max_mem else None
+
+  def _stats(self, args):
+    if not read_cache(True):
+      sys.exit(1)
+    build_cache = session.cache['build']
+    craftr.stats.import_log(session.builddir, session.maindir, build_cache)
+    db = craftr.stats.open_database(session.builddir)
+    build = craftr.stats.get_build(db, build_id=args.build)
+    if not build:
+      logger.error('no build statistics available, run "craftr build" first')
+      return 1
+    if args.compare:
+      commit = craftr.stats.get_commit(session.maindir, args.compare)
+      if not commit:
+        logger.error('unknown revision: "{}"'.format(args.compare))
+        return 1
+      other = craftr.stats.get_build(db, commit=commit)
+      if not other:
+        logger.error('no build recorded for revision "{}" ({})'.format(
+            args.compare, commit[:12]))
+        return 1
+      craftr.stats.compare(db, other, build, top=args.top)
+    else:
+      craftr.stats.report(db, build, build_cache.get('target_deps', {}), top=args.top)
+    return 0
 
   def _create_lockfile(self):
     if not read_cache(True):
@@ -715,6 +1021,339 @@ class StartpackageCommand(BaseCommand):
       print('# {}'.format(args.name), file=fp)
 
 
+class CacheCommand(BaseCommand):
+  """
+  Inspect and clean up the local action cache (see :mod:`craftr.core.actioncache`)
+  and the archive cache (see :mod:`craftr.core.archivecache`).
+  """
+
+  def build_parser(self, parser):
+    subparsers = parser.add_subparsers(dest='cache_command')
+    subparsers.add_parser('stats')
+    gc_parser = subparsers.add_parser('gc')
+    gc_parser.add_argument('--max-size', help='The maximum size of the cache '
+        'after garbage collection, eg. 512M or 10G. Defaults to the '
+        '"craftr.action_cache.max_size" option or 5G.')
+    prune_parser = subparsers.add_parser('prune')
+    prune_parser.add_argument('--max-size', help='The maximum size of the '
+        'archive cache after removing the least recently used downloads and '
+        'extracted archives, eg. 512M or 10G. Defaults to the '
+        '"craftr.archive_cache.max_size" option or 10G.')
+
+  def execute(self, parser, args):
+    cache = actioncache.ActionCache(session.options.get('craftr.action_cache.dir'))
+    if args.cache_command == 'stats':
+      stats = cache.stats()
+      total = stats['hits'] + stats['misses']
+      print('Cache directory:', cache.directory)
+      print('Entries:        ', stats['entries'])
+      print('Size:           ', '{:.1f} MiB'.format(stats['size'] / 1024 ** 2))
+      print('Hits:           ', stats['hits'])
+      print('Misses:         ', stats['misses'])
+      if total:
+        print('Hit rate:       ', '{:.1f}%'.format(100.0 * stats['hits'] / total))
+      return 0
+    elif args.cache_command == 'gc':
+      max_size = args.max_size or session.options.get('craftr.action_cache.max_size',
+          actioncache.DEFAULT_MAX_SIZE)
+      try:
+        max_size = pyutils.parse_size(max_size)
+      except ValueError as exc:
+        parser.error(exc)
+      removed, freed = cache.gc(max_size)
+      logger.info('removed {} entries ({:.1f} MiB)'.format(removed, freed / 1024 ** 2))
+      return 0
+    elif args.cache_command == 'prune':
+      archives = archivecache.ArchiveCache(session.options.get('craftr.archive_cache.dir'))
+      max_size = args.max_size or session.options.get('craftr.archive_cache.max_size',
+          archivecache.DEFAULT_MAX_SIZE)
+      try:
+        max_size = pyutils.parse_size(max_size)
+      except ValueError as exc:
+        parser.error(exc)
+      removed, freed = archives.prune(max_size)
+      logger.info('removed {} entries ({:.1f} MiB)'.format(removed, freed / 1024 ** 2))
+      return 0
+    parser.print_usage()
+    return 0
+
+
+class WorkerCommand(BaseCommand):
+  """
+  Run a worker that executes commands for other machines (see
+  :mod:`craftr.core.remote`). The worker only accepts requests signed with
+  the secret that is shared with the clients.
+  """
+
+  def build_parser(self, parser):
+    parser.add_argument('--host', default='127.0.0.1', help='The address to '
+        'listen on. Use 0.0.0.0 to accept connections from other machines.')
+    parser.add_argument('--port', type=int, default=7311)
+    parser.add_argument('--secret', help='The secret shared with the clients. '
+        'Defaults to the {} environment variable.'.format(remote.SECRET_ENV))
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--dir', help='The directory for uploaded files and '
+        'sandboxes. Defaults to ~/.cache/craftr/worker.')
+
+  def execute(self, parser, args):
+    secret = args.secret or os.getenv(remote.SECRET_ENV)
+    if not secret:
+      parser.error('--secret or {} is required'.format(remote.SECRET_ENV))
+    directory = args.dir or actioncache.get_cache_dir('worker')
+    logger.info('craftr worker listening on {}:{} with {} job(s)'.format(
+        args.host, args.port, args.jobs))
+    remote.serve((args.host, args.port), directory, args.jobs, secret)
+    return 0
+
+
+class BenchCommand(BaseCommand):
+  """
+  Run the export and build benchmarks on a synthetic workspace (see
+  :mod:`craftr.bench`).
+  """
+
+  def build_parser(self, parser):
+    from craftr import bench
+    for key, value in sorted(bench.DEFAULT_PARAMS.items()):
+      parser.add_argument('--' + key.replace('_', '-'), type=int, default=value)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help='Write the results as JSON to this file.')
+    parser.add_argument('--keep', metavar='DIR', help='Generate the workspace '
+        'in DIR and keep it after the benchmark.')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='Compare two JSON result files instead of running the benchmark.')
+    parser.add_argument('--count-forks', action='store_true',
+        help='Count the processes created during the clean build (Linux only).')
+
+  def execute(self, parser, args):
+    from craftr import bench
+    if args.compare:
+      results = []
+      for filename in args.compare:
+        with open(filename) as fp:
+          results.append(json.load(fp))
+      bench.print_comparison(*results)
+      return 0
+
+    params = {key: getattr(args, key) for key in bench.DEFAULT_PARAMS}
+    try:
+      data = bench.run_benchmark(params, args.repeat, args.keep and path.abs(args.keep),
+          count_forks=args.count_forks)
+    except EnvironmentError as exc:
+      logger.error('error:', exc)
+      return 1
+    except bench.subprocess.CalledProcessError as exc:
+      logger.error('benchmark command failed: {}'.format(shell.join(exc.cmd)))
+      logger.error(exc.stderr.decode('utf8', 'replace'), indent=1)
+      return 1
+    bench.print_results(data)
+    if args.output:
+      with open(args.output, 'w') as fp:
+        json.dump(data, fp, indent=2)
+      logger.info('results written to "{}"'.format(args.output))
+    return 0
+
+
+class WatchCommand(BaseCommand):
+  """
+  Exports and builds the project and then rebuilds it whenever a file that
+  it depends on changes (see :mod:`craftr.watch`). The project is only
+  re-exported if a build definition changed, otherwise Ninja is invoked
+  for the affected targets only. The session stays in memory between the
+  iterations, thus manifests and tool probes are not repeated.
+  """
+
+  def build_parser(self, parser):
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('-d', '--option', dest='options', action='append', default=[])
+    parser.add_argument('-m', '--module')
+    parser.add_argument('-i', '--include-path', action='append', default=[])
+    parser.add_argument('-b', '--build-dir', default='build')
+    parser.add_argument('--debounce', type=int, default=100, metavar='MS',
+        help='Wait until no file changed for MS milliseconds before '
+        'starting the build. Defaults to 100.')
+    parser.add_argument('targets', metavar='TARGET', nargs='*', help='The '
+        'targets to build. If omitted, only the targets affected by a change '
+        'are passed to Ninja.')
+
+  def execute(self, parser, args):
+    from craftr import watch
+    try:
+      inotify = watch.Inotify()
+    except OSError as exc:
+      logger.error('error:', exc)
+      return 1
+
+    exporter = BuildCommand('export')
+    builder = BuildCommand('build')
+    build_args = argparse.Namespace(**vars(args))
+    action, targets, changes = 'export', None, {}
+    state = None
+    try:
+      with inotify:
+        while True:
+          start = time.perf_counter()
+          if action == 'export':
+            if state is not None:
+              session.reset(x for x in changes if x)
+            returncode, state = self._export(parser, args, exporter)
+            targets = None
+          else:
+            returncode = 0
+          if returncode == 0:
+            build_args.targets = args.targets or targets or []
+            logger.debug('starting build after {:.1f} ms'.format(
+                (time.perf_counter() - start) * 1000))
+            builder.execute(parser, build_args)
+            # Headers in other directories are only known to Ninja.
+            state.discovered = watch.read_ninja_deps(builder.ninja_bin, session.builddir)
+
+          inotify.update(state.directories)
+          logger.info('watching {} directories for changes'.format(
+              len(inotify.directories)))
+          logger.flush()
+          action = None
+          while not action:
+            changes = inotify.wait(args.debounce / 1000.0)
+            action, targets = state.classify(changes)
+    except KeyboardInterrupt:
+      return 0
+
+  def _export(self, parser, args, exporter):
+    """
+    Exports the project and returns the exit code and the
+    :class:`craftr.watch.WatchState` of the exported project. Errors in the
+    build scripts are reported but do not stop the watcher.
+    """
+
+    from craftr import watch
+    try:
+      returncode = exporter.execute(parser, args)
+    except Exception:
+      logger.error(traceback.format_exc())
+      returncode = 1
+    modules = [module for versions in session.modules.values()
+        for module in versions.values() if module.executed]
+    state = watch.WatchState(modules, session.graph,
+        get_target_deps(session.graph), session.builddir)
+    return returncode, state
+
+
+class DaemonCommand(BaseCommand):
+  """
+  Runs a daemon for the build directory that executes the commands listed
+  in :data:`craftr.daemon.COMMANDS` on behalf of the command-line. Parsed
+  manifests, tool probes and the executed modules are kept in memory, the
+  modules are only executed again if a file that they depend on, a globbed
+  directory, the options or the environment changed.
+  """
+
+  def build_parser(self, parser):
+    parser.add_argument('-b', '--build-dir', default='build')
+
+  def execute(self, parser, args):
+    self.parser, self.commands = create_parser()
+    self.logger = logger._get_current_object()
+    self.init_dir = INIT_DIR
+    self.snapshot = None
+    self.signature = None
+    builddir = path.norm(args.build_dir)
+    path.makedirs(builddir)
+    socket_path = daemon.get_socket_path(builddir)
+    logger.info('craftr daemon listening on "{}"'.format(socket_path))
+    logger.flush()
+    try:
+      daemon.serve(socket_path, self._handle)
+    except OSError as exc:
+      logger.error('error:', exc)
+      return 1
+    except KeyboardInterrupt:
+      return 0
+
+  def _handle(self, request, stdout, stderr):
+    global INIT_DIR
+    environ = dict(os.environ)
+    try:
+      os.chdir(request['cwd'])
+      INIT_DIR = request['cwd']
+      os.environ.clear()
+      os.environ.update(request['environ'])
+      with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        return self._execute_request(request['argv'])
+    except SystemExit as exc:
+      if exc.code is None or isinstance(exc.code, int):
+        return exc.code or 0
+      stderr.write(str(exc.code) + '\n')
+      return 1
+    except Exception:
+      stderr.write(traceback.format_exc())
+      self.snapshot = None
+      return 1
+    finally:
+      os.environ.clear()
+      os.environ.update(environ)
+      INIT_DIR = self.init_dir
+      os.chdir(session.maindir)
+      set_logger(self.logger)
+
+  def _execute_request(self, argv):
+    args = self.parser.parse_args(argv)
+    if args.command not in daemon.COMMANDS:
+      self.parser.error('the daemon can not execute "{}"'.format(args.command))
+    log_file = init_logger(args, sys.stdout)
+    try:
+      if args.project_dir:
+        os.chdir(args.project_dir)
+      if path.norm(path.getcwd()) != session.maindir:
+        logger.error('the daemon serves "{}"'.format(session.maindir))
+        return 1
+      session.options = read_options(self.parser, args)
+      parse_cmdline_options(args.options)
+      self._invalidate(args)
+      returncode = self.commands[args.command].execute(self.parser, args) or 0
+      self._take_snapshot(returncode)
+      return returncode
+    finally:
+      logger.flush()
+      if log_file:
+        log_file.close()
+
+  def _invalidate(self, args):
+    """
+    Resets the session if the files that the executed modules depend on,
+    the options or the environment changed since the previous request.
+    """
+
+    signature = repr((sorted(session.options.items()), args.module,
+        args.include_path, sorted(os.environ.items())))
+    if self.snapshot is None:
+      changed = None
+    else:
+      changed = daemon.changed_files(self.snapshot)
+    if changed is None or changed or signature != self.signature:
+      for filename in changed or ():
+        logger.debug('changed:', filename)
+      session.reset(changed or ())
+      self.snapshot = None
+    self.signature = signature
+
+  def _take_snapshot(self, returncode):
+    from craftr import watch
+    if returncode != 0:
+      # The modules may only have been executed partially.
+      self.snapshot = None
+      return
+    files = set()
+    patterns = []
+    for versions in session.modules.values():
+      for module in versions.values():
+        if module.executed:
+          files.update(module.dependent_files)
+          patterns.extend(module.glob_patterns)
+    files.update(watch.glob_directories(patterns, session.builddir))
+    self.snapshot = daemon.take_snapshot(files)
+
+
 class VersionCommand(BaseCommand):
 
   def build_parser(self, parser):
@@ -724,9 +1363,13 @@ class VersionCommand(BaseCommand):
     print(craftr.__version__)
 
 
-def main():
-  # Create argument parsers and dynamically include all BaseCommand
-  # subclasses into it.
+def create_parser():
+  """
+  Creates the argument parser and dynamically includes all BaseCommand
+  subclasses into it. Returns the parser and a dictionary that maps the
+  command names to the :class:`BaseCommand` objects.
+  """
+
   parser = argparse.ArgumentParser(prog='craftr', description='The Craftr build system')
   parser.add_argument('-v', '--verbose', action='store_true')
   parser.add_argument('-q', '--quiet', action='store_true')
@@ -735,6 +1378,13 @@ def main():
   parser.add_argument('-P', '--project-dir')
   parser.add_argument('-d', '--option', dest='options', action='append', default=[])
   parser.add_argument('--pm', action='store_true', help='Post-mortem debugger')
+  parser.add_argument('--log-format', choices=['text', 'jsonl'], default='text',
+      help='The format of log messages. "jsonl" writes one JSON object per '
+      'message, suitable for processing in CI.')
+  parser.add_argument('--log-file', help='Write log messages to this file '
+      'instead of stdout.')
+  parser.add_argument('--no-daemon', action='store_true', help='Do not send '
+      'the command to the "craftr daemon" of the build directory.')
   subparsers = parser.add_subparsers(dest='command')
 
   commands = {
@@ -746,61 +1396,110 @@ def main():
     'help': BuildCommand('help'),
     'options': BuildCommand('dump-options'),
     'deptree': BuildCommand('dump-deptree'),
+    'query': BuildCommand('query'),
+    'fetch': BuildCommand('fetch'),
+    'stats': BuildCommand('stats'),
     'startpackage': StartpackageCommand(),
+    'cache': CacheCommand(),
+    'worker': WorkerCommand(),
+    'bench': BenchCommand(),
+    'watch': WatchCommand(),
+    'daemon': DaemonCommand(),
     'version': VersionCommand()
   }
 
   for key, cmd in commands.items():
     cmd.build_parser(subparsers.add_parser(key))
+  return parser, commands
 
-  # Parse the arguments.
-  args = parser.parse_args()
-  if not args.command:
-    parser.print_usage()
-    return 0
 
-  if args.pm:
-    old_excepthook = sys.excepthook
-    def excepthook(type, value, traceback):
-      logger.error('Exception ({}), entering post-mortem debugger'.format(type.__name__))
-      pdb.post_mortem(traceback)
-      old_excepthook(type, value, traceback)
-    sys.excepthook = excepthook
+def init_logger(args, stream):
+  """
+  Sets up the logger according to the command-line *args*. Messages are
+  written to *stream* unless ``--log-file`` is specified, in which case the
+  opened file is returned and must be closed by the caller.
+  """
 
-  if args.project_dir:
-    os.chdir(args.project_dir)
+  log_file = None
+  if args.log_file:
+    stream = log_file = open(args.log_file, 'w')
+  if args.log_format == 'jsonl':
+    set_logger(JsonLinesLogger(stream))
+  else:
+    set_logger(DefaultLogger(stream))
   if args.verbose:
     logger.set_level(logger.DEBUG)
   elif args.quiet:
     logger.set_level(logger.WARNING)
+  return log_file
 
-  session = Session()
 
-  # Parse the user configuration file.
+def read_options(parser, args):
+  """
+  Reads the user configuration file and the local configuration files or
+  the ones specified on the command-line and returns the options.
+  """
+
   try:
     config_filename = path.expanduser('~/' + CONFIG_FILENAME)
-    session.options = read_config_file(config_filename)
+    options = read_config_file(config_filename)
   except FileNotFoundError as exc:
-    session.options = {}
+    options = {}
   except InvalidConfigError as exc:
     parser.error(exc)
-    return 1
 
-  # Parse the local configuration file or the ones specified on command-line.
   if not args.no_config:
     try:
       for filename in args.config:
-        session.options.update(read_config_file(filename))
+        options.update(read_config_file(filename))
       if not args.config:
         choices = [CONFIG_FILENAME, path.join('craftr', CONFIG_FILENAME)]
         for fn in choices:
           try:
-            session.options.update(read_config_file(fn))
+            options.update(read_config_file(fn))
           except FileNotFoundError as exc:
             pass
     except InvalidConfigError as exc:
       parser.error(exc)
-      return 1
+
+  return options
+
+
+def main():
+  parser, commands = create_parser()
+
+  # Parse the arguments.
+  args = parser.parse_args()
+  if not args.command:
+    parser.print_usage()
+    return 0
+
+  if args.pm:
+    old_excepthook = sys.excepthook
+    def excepthook(type, value, traceback):
+      logger.error('Exception ({}), entering post-mortem debugger'.format(type.__name__))
+      pdb.post_mortem(traceback)
+      old_excepthook(type, value, traceback)
+    sys.excepthook = excepthook
+
+  log_file = init_logger(args, sys.stdout)
+  if log_file:
+    atexit.register(log_file.close)
+
+  if args.project_dir:
+    os.chdir(args.project_dir)
+
+  # Let the daemon of the build directory execute the command if one is
+  # running, otherwise fall through and execute it in this process.
+  if args.command in daemon.COMMANDS and not args.no_daemon:
+    socket_path = daemon.get_socket_path(path.norm(args.build_dir))
+    returncode = daemon.forward(socket_path, sys.argv[1:], INIT_DIR,
+        dict(os.environ), sys.stdout, sys.stderr)
+    if returncode is not None:
+      return returncode
+
+  session = Session()
+  session.options = read_options(parser, args)
 
   # Execute the command in the session context.
   with session:
@@ -0,0 +1,343 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.bench`
+===================
+
+A benchmark harness for ``craftr bench``. It generates a synthetic Craftr
+workspace and measures the time and memory that ``craftr export`` and
+``craftr build`` require for it. The workspace uses stub compilers written
+as shell scripts, so the benchmark runs offline on any Unix system and
+measures only the overhead of Craftr and Ninja.
+
+The Craftr that is measured is the one this module is imported from, thus
+two checkouts can be compared by running ``craftr bench -o <file>`` in
+both and then ``craftr bench --compare <old> <new>``.
+"""
+
+from craftr.utils import path
+
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+#: The default parameters for :func:`generate_workspace`.
+DEFAULT_PARAMS = {
+  'modules': 10,
+  'fanout': 3,
+  'targets': 4,
+  'sources': 10,
+  'glob_depth': 2,
+  'options': 5,
+  'framework_depth': 0,
+  'loop_targets': 0,
+}
+
+#: Generates targets in a loop without assigning them to a variable, thus
+#: their names are derived from the name hint.
+LOOP_TARGETS = '''
+def stamp(framework, index, name=None):
+  builder = TargetBuilder(gtn(name, 'stamp'), frameworks=[framework])
+  return builder.build([['touch', '$out']], explicit=True,
+      outputs=[buildlocal('stamp/{{}}.txt'.format(index))])
+
+loop_targets = []
+for i in range({}):
+  fw = Framework(defines=['LOOP{{}}'.format(i)])
+  loop_targets.append(stamp(fw, i))
+'''
+
+STUB_COMPILER = r'''#!/bin/sh
+# Stub compiler that creates the output and dependency files.
+case "$1" in
+  -v|--version)
+    echo "gcc version 9.4.0 (craftr bench stub)" >&2
+    echo "Target: x86_64-linux-gnu" >&2
+    exit 0;;
+esac
+out=; dep=; src=
+while [ $# -gt 0 ]; do
+  case "$1" in
+    -o) out="$2"; shift;;
+    -MF) dep="$2"; shift;;
+    -*) ;;
+    *) src="$src $1";;
+  esac
+  shift
+done
+[ -n "$out" ] && : > "$out"
+[ -n "$dep" ] && echo "$out:$src" > "$dep"
+exit 0
+'''
+
+STUB_ARCHIVER = r'''#!/bin/sh
+# Stub archiver, invoked as "ar <flags> <output> <inputs...>".
+: > "$2"
+'''
+
+
+def module_name(index):
+  return 'bench.m{:04d}'.format(index)
+
+
+def module_deps(index, fanout):
+  return [module_name(i) for i in range(max(0, index - fanout), index)]
+
+
+def write_file(filename, content):
+  path.makedirs(path.dirname(filename))
+  with open(filename, 'w') as fp:
+    fp.write(content)
+
+
+def generate_workspace(directory, modules, fanout, targets, sources,
+    glob_depth, options, framework_depth=0, loop_targets=0):
+  """
+  Generates a synthetic Craftr workspace in *directory*. The main module
+  loads *modules* modules that each depend on up to *fanout* of the modules
+  generated before them, declare *options* options and build *targets*
+  static libraries from *sources* C files each. The source files are
+  distributed in directories nested *glob_depth* levels deep and collected
+  with a recursive :func:`glob<craftr.defaults.glob>`. The objects are
+  compiled with a chain of *framework_depth* frameworks, each of which
+  includes the previous one. The main module creates *loop_targets*
+  explicit targets and frameworks in a loop.
+  """
+
+  module_names = [module_name(i) for i in range(modules)]
+  write_file(path.join(directory, 'manifest.json'), json.dumps({
+    'name': 'bench',
+    'version': '1.0.0',
+    'dependencies': {x: '*' for x in module_names},
+  }, indent=2))
+  main = ''.join('load({!r})\n'.format(x) for x in module_names)
+  if loop_targets:
+    main += LOOP_TARGETS.format(loop_targets)
+  write_file(path.join(directory, 'Craftrfile'), main)
+
+  for index, name in enumerate(module_names):
+    moddir = path.join(directory, 'craftr', 'modules', name)
+    deps = module_deps(index, fanout)
+    manifest = {
+      'name': name,
+      'version': '1.0.0',
+      'dependencies': dict({x: '*' for x in deps}, **{'craftr.lang.cxx': '*'}),
+      'options': {'opt{}'.format(i): {'type': 'string', 'default': str(i)}
+          for i in range(options)},
+    }
+    write_file(path.join(moddir, 'manifest.json'), json.dumps(manifest, indent=2))
+
+    lines = ["cxx = load('craftr.lang.cxx')"]
+    lines += ['{} = load({!r})'.format(x.replace('.', '_'), x) for x in deps]
+    lines += ['values = [{}]'.format(', '.join('options.opt{}'.format(i)
+        for i in range(options)))]
+    lines.append('frameworks = []')
+    for i in range(framework_depth):
+      lines.append('frameworks = [Framework("fw{0}", defines=["FW{0}"], '
+          'include=["include/fw{0}"], frameworks=frameworks)]'.format(i))
+    for target in range(targets):
+      lines.append('{0} = cxx.static_library(name={0!r}, output={0!r}, '
+          'inputs=cxx.compile_c(name={0!r} + "_obj", frameworks=frameworks, '
+          'sources=glob("src/{0}/**/*.c")))'.format('t{}'.format(target)))
+      for source in range(sources):
+        subdir = path.join(*['d{}'.format(i) for i in range(source % (glob_depth + 1))] or ['.'])
+        write_file(path.join(moddir, 'src', 't{}'.format(target), subdir,
+            's{}.c'.format(source)), 'int t{}_s{}(void) {{ return {}; }}\n'
+            .format(target, source, source))
+    write_file(path.join(moddir, 'Craftrfile'), '\n'.join(lines) + '\n')
+
+
+def write_stubs(directory):
+  """
+  Writes the stub compiler and archiver to *directory* and returns the
+  environment variables that make Craftr use them.
+  """
+
+  path.makedirs(directory)
+  for name, content in [('gcc', STUB_COMPILER), ('g++', STUB_COMPILER),
+      ('ar', STUB_ARCHIVER)]:
+    filename = path.join(directory, name)
+    write_file(filename, content)
+    os.chmod(filename, 0o755)
+  return {
+    'CC': path.join(directory, 'gcc'),
+    'CXX': path.join(directory, 'g++'),
+    'AS': path.join(directory, 'gcc'),
+    'AR': path.join(directory, 'ar'),
+    'PATH': directory + os.pathsep + os.getenv('PATH', ''),
+  }
+
+
+def run_measured(command, cwd, env):
+  """
+  Runs *command* and returns a tuple of the wall time in seconds and the
+  peak resident set size of the process in KiB.
+
+  :raise subprocess.CalledProcessError: If the command fails.
+  """
+
+  start = time.perf_counter()
+  process = subprocess.Popen(command, cwd=cwd, env=env,
+      stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+  stderr = process.stderr.read()
+  __, status, rusage = os.wait4(process.pid, 0)
+  elapsed = time.perf_counter() - start
+  process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+  process.stderr.close()
+  if process.returncode != 0:
+    raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr)
+  return elapsed, rusage.ru_maxrss
+
+
+def count_processes():
+  """
+  Returns the number of processes that have been created on the system
+  since it booted, or :const:`None` if it can not be determined (the
+  ``processes`` line in ``/proc/stat`` is only available on Linux).
+  """
+
+  try:
+    with open('/proc/stat') as fp:
+      for line in fp:
+        if line.startswith('processes '):
+          return int(line.split()[1])
+  except OSError:
+    pass
+  return None
+
+
+def summarize(values):
+  return {'values': values, 'min': min(values), 'median': statistics.median(values)}
+
+
+def run_benchmark(params, repeat=3, directory=None, ninja=None, count_forks=False):
+  """
+  Generates a workspace with the specified *params* (see
+  :data:`DEFAULT_PARAMS`) and runs the benchmarks *repeat* times. Returns
+  a JSON serializable dictionary with the results.
+
+  :param directory: The directory to generate the workspace in. A
+    temporary directory is used and removed afterwards if omitted.
+  :param ninja: The Ninja executable.
+  :param count_forks: Count the processes that are created during the
+    clean build as ``clean_build_forks``. The count is taken from the
+    system-wide counter in ``/proc/stat``, thus other activity on the
+    system adds to it.
+  """
+
+  params = dict(DEFAULT_PARAMS, **params)
+  ninja = ninja or os.getenv('NINJA', 'ninja')
+  tempdir = None
+  if directory is None:
+    directory = tempdir = tempfile.mkdtemp(prefix='craftr-bench-')
+
+  try:
+    workspace = path.join(directory, 'workspace')
+    builddir = path.join(workspace, 'build')
+    path.remove(workspace, recursive=True, silent=True)
+    generate_workspace(workspace, **params)
+
+    env = dict(os.environ)
+    env.update(write_stubs(path.join(directory, 'stubs')))
+    env['PYTHONPATH'] = path.dirname(path.dirname(path.abs(__file__))) + \
+        os.pathsep + env.get('PYTHONPATH', '')
+    craftr = [sys.executable, '-m', 'craftr', '-C']
+
+    results = {name: [] for name in ['export_cold', 'export_warm', 'ninja_noop',
+        'build_noop', 'build_overhead']}
+    if count_forks:
+      if count_processes() is None:
+        raise EnvironmentError('can not count processes on this system')
+      results['clean_build_forks'] = []
+    rss = []
+    for __ in range(repeat):
+      path.remove(builddir, recursive=True, silent=True)
+      elapsed, maxrss = run_measured(craftr + ['export'], workspace, env)
+      results['export_cold'].append(elapsed)
+      rss.append(maxrss)
+      results['export_warm'].append(run_measured(craftr + ['export'], workspace, env)[0])
+      forks = count_processes()
+      run_measured([ninja, '-C', builddir], workspace, env)
+      if count_forks:
+        results['clean_build_forks'].append(count_processes() - forks)
+      ninja_noop = run_measured([ninja, '-C', builddir], workspace, env)[0]
+      build_noop = run_measured(craftr + ['build'], workspace, env)[0]
+      results['ninja_noop'].append(ninja_noop)
+      results['build_noop'].append(build_noop)
+      results['build_overhead'].append(build_noop - ninja_noop)
+
+    data = {name: summarize(values) for name, values in results.items()}
+    data['export_peak_rss_kib'] = max(rss)
+    data['manifest_bytes'] = os.path.getsize(path.join(builddir, 'build.ninja'))
+    return {
+      'params': params,
+      'repeat': repeat,
+      'python': sys.version.split()[0],
+      'craftr': path.dirname(path.abs(__file__)),
+      'timestamp': time.time(),
+      'results': data,
+    }
+  finally:
+    if tempdir:
+      shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def format_value(key, value):
+  if key.endswith('_bytes'):
+    return '{:.1f} KiB'.format(value / 1024.0)
+  elif key.endswith('_kib'):
+    return '{:.1f} MiB'.format(value / 1024.0)
+  elif key.endswith('_forks'):
+    return '{:.0f}'.format(value)
+  return '{:.3f}s'.format(value)
+
+
+def flatten_results(results):
+  for key, value in sorted(results.items()):
+    if isinstance(value, dict):
+      value = value['median']
+    yield key, value
+
+
+def print_results(data, fp=None):
+  print('Parameters:', ', '.join('{}={}'.format(k, v)
+      for k, v in sorted(data['params'].items())), file=fp)
+  for key, value in flatten_results(data['results']):
+    print('  {:<22} {:>12}'.format(key, format_value(key, value)), file=fp)
+
+
+def print_comparison(old, new, fp=None):
+  """
+  Prints the relative change of every result between the *old* and *new*
+  benchmark results (medians for timings).
+  """
+
+  if dict(DEFAULT_PARAMS, **old['params']) != dict(DEFAULT_PARAMS, **new['params']):
+    print('warning: the benchmarks were run with different parameters', file=fp)
+  old_results = dict(flatten_results(old['results']))
+  print('  {:<22} {:>12} {:>12} {:>9}'.format('', 'old', 'new', 'change'), file=fp)
+  for key, value in flatten_results(new['results']):
+    if key not in old_results:
+      continue
+    before = old_results[key]
+    change = ((value - before) / before * 100.0) if before else 0.0
+    print('  {:<22} {:>12} {:>12} {:>+8.1f}%'.format(key,
+        format_value(key, before), format_value(key, value), change), file=fp)
@@ -0,0 +1,532 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.actioncache`
+==============================
+
+A local, content-addressed cache for the outputs of build actions. When the
+``craftr.action_cache`` option is enabled, the command of every
+:attr:`cacheable<craftr.core.build.Target.cacheable>` target is wrapped in
+the launcher implemented by this module, which is invoked by Ninja as
+``python -m craftr.core.actioncache [options] -- <command>``.
+
+The cache is addressed in two steps. The *action key* is computed from the
+command-line and the contents of the input files. It references a manifest
+that lists the additional files (usually headers) that were discovered from
+the depfile when the action was last executed. Together with the contents of
+these files, the action key yields the *object key* under which the outputs
+are stored.
+
+Absolute paths that depend on the build directory are replaced by
+placeholders before they are hashed and stored, so that actions can be
+restored into another build directory.
+
+The launcher only adds objects to the cache. The least recently used
+objects are removed until the cache is smaller than
+``craftr.action_cache.max_size`` once after every ``craftr build`` and when
+``craftr cache gc`` is run, so that parallel actions never remove objects
+that another action is restoring.
+"""
+
+from craftr.utils import path, pyutils
+
+import argparse
+import errno
+import hashlib
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import time
+
+#: Changing this value invalidates all existing cache entries.
+CACHE_VERSION = '1'
+
+#: The default of the ``craftr.action_cache.max_size`` option.
+DEFAULT_MAX_SIZE = '5G'
+
+
+def get_cache_dir(*parts):
+  """
+  Returns the user-level Craftr cache directory, which is ``~/.cache/craftr``
+  by default. It can be changed with the ``CRAFTR_CACHE_DIR`` and
+  ``XDG_CACHE_HOME`` environment variables.
+  """
+
+  directory = os.getenv('CRAFTR_CACHE_DIR')
+  if not directory:
+    directory = path.join(os.getenv('XDG_CACHE_HOME') or
+        path.expanduser('~/.cache'), 'craftr')
+  return path.join(directory, *parts)
+
+
+def is_enabled(options):
+  """
+  Returns :const:`True` if the ``craftr.action_cache`` option is enabled
+  in the *options* dictionary.
+  """
+
+  from craftr.core.manifest import BoolOption
+  return BoolOption('craftr.action_cache')(options.get('craftr.action_cache', ''))
+
+
+def get_max_size(options):
+  """
+  Returns the ``craftr.action_cache.max_size`` option in bytes.
+  """
+
+  return pyutils.parse_size(options.get('craftr.action_cache.max_size', DEFAULT_MAX_SIZE))
+
+
+def hash_file(filename):
+  """
+  Returns the SHA-1 hexdigest of the contents of *filename*.
+  """
+
+  sha1 = hashlib.sha1()
+  with open(filename, 'rb') as fp:
+    for chunk in iter(lambda: fp.read(65536), b''):
+      sha1.update(chunk)
+  return sha1.hexdigest()
+
+
+def parse_depfile(text):
+  """
+  Parses the contents of a Makefile-style dependency file as written by
+  GCC and Clang with ``-MD`` and returns the list of prerequisites.
+  """
+
+  text = text.replace('\\\r\n', ' ').replace('\\\n', ' ')
+  result = []
+  for line in text.split('\n'):
+    target, sep, deps = line.partition(': ')
+    if not sep:
+      continue
+    current = ''
+    escape = False
+    for char in deps:
+      if escape:
+        current += char
+        escape = False
+      elif char == '\\':
+        escape = True
+      elif char in ' \t':
+        if current:
+          result.append(current)
+        current = ''
+      else:
+        current += char
+    if current:
+      result.append(current)
+  return pyutils.unique_list(result)
+
+
+class PathMap(object):
+  """
+  Replaces absolute path prefixes with placeholders and back. The longest
+  prefix is always replaced first.
+
+  :param mappings: A list of ``(prefix, placeholder)`` tuples.
+  """
+
+  def __init__(self, mappings):
+    self.mappings = sorted(mappings, key=lambda x: len(x[0]), reverse=True)
+
+  def normalize(self, value):
+    for prefix, placeholder in self.mappings:
+      value = value.replace(prefix, placeholder)
+    return value
+
+  def denormalize(self, value):
+    for prefix, placeholder in reversed(self.mappings):
+      value = value.replace(placeholder, prefix)
+    return value
+
+
+class ActionCache(object):
+  """
+  Represents the cache directory. Object entries are directories that
+  contain the output files and a ``meta.json`` file. The modification time
+  of the ``meta.json`` file is updated every time the entry is used and
+  serves as the LRU information for :meth:`gc`.
+
+  Hits and misses are appended to ``stats.log`` by :meth:`record` and are
+  summed up into ``stats.json`` by :meth:`gc`.
+  """
+
+  def __init__(self, directory=None):
+    self.directory = directory or get_cache_dir('actions')
+
+  def _manifest_file(self, key):
+    return path.join(self.directory, 'manifests', key[:2], key + '.json')
+
+  def _object_dir(self, key):
+    return path.join(self.directory, 'objects', key[:2], key)
+
+  def read_manifest(self, key):
+    try:
+      with open(self._manifest_file(key)) as fp:
+        return json.load(fp)
+    except (OSError, ValueError):
+      return []
+
+  def write_manifest(self, key, entries):
+    filename = self._manifest_file(key)
+    path.makedirs(path.dirname(filename))
+    tempname = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tempname, 'w') as fp:
+      json.dump(entries, fp)
+    os.replace(tempname, filename)
+
+  def get_object(self, key):
+    """
+    Returns the metadata of the object with the specified *key* and marks
+    it as used, or returns :const:`None` if the object does not exist.
+    """
+
+    meta_file = path.join(self._object_dir(key), 'meta.json')
+    try:
+      with open(meta_file) as fp:
+        meta = json.load(fp)
+      os.utime(meta_file, None)
+    except (OSError, ValueError):
+      return None
+    meta['directory'] = self._object_dir(key)
+    return meta
+
+  def put_object(self, key, files, meta):
+    """
+    Stores the list of *files* under the specified object *key*. The
+    files will be named by their index in the list. The entry is created
+    in a temporary directory first and then renamed, so concurrent
+    writers of the same entry will not corrupt it.
+    """
+
+    directory = self._object_dir(key)
+    if path.isdir(directory):
+      return
+    tempdir = '{}.{}.tmp'.format(directory, os.getpid())
+    path.makedirs(tempdir)
+    try:
+      for index, filename in enumerate(files):
+        dest = path.join(tempdir, str(index))
+        shutil.copyfile(filename, dest)
+        os.chmod(dest, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+      with open(path.join(tempdir, 'meta.json'), 'w') as fp:
+        json.dump(meta, fp)
+      os.rename(tempdir, directory)
+    except OSError as exc:
+      path.remove(tempdir, recursive=True, silent=True)
+      # Another process may have stored the same entry in the meantime.
+      if not path.isdir(directory):
+        raise
+
+  def record(self, event):
+    """
+    Appends an *event* (``'hit'`` or ``'miss'``) to the statistics log.
+    """
+
+    path.makedirs(self.directory)
+    with open(path.join(self.directory, 'stats.log'), 'a') as fp:
+      fp.write(event + '\n')
+
+  def entries(self):
+    """
+    Yields ``(directory, size, atime)`` for every object in the cache.
+    """
+
+    objects_dir = path.join(self.directory, 'objects')
+    for prefix in path.easy_listdir(objects_dir):
+      for name in path.easy_listdir(path.join(objects_dir, prefix)):
+        directory = path.join(objects_dir, prefix, name)
+        if name.endswith('.tmp'):
+          continue
+        try:
+          atime = os.stat(path.join(directory, 'meta.json')).st_mtime
+          size = sum(os.stat(path.join(directory, x)).st_size
+              for x in os.listdir(directory))
+        except OSError:
+          continue
+        yield directory, size, atime
+
+  def stats(self):
+    """
+    Returns a dictionary with the number of ``entries``, their total
+    ``size`` in bytes and the number of cache ``hits`` and ``misses``.
+    """
+
+    result = {'entries': 0, 'size': 0}
+    for directory, size, atime in self.entries():
+      result['entries'] += 1
+      result['size'] += size
+    result.update(self._read_counters())
+    counters = self._count_events(path.join(self.directory, 'stats.log'))
+    result['hits'] += counters['hits']
+    result['misses'] += counters['misses']
+    return result
+
+  def _read_counters(self):
+    try:
+      with open(path.join(self.directory, 'stats.json')) as fp:
+        data = json.load(fp)
+      return {'hits': int(data['hits']), 'misses': int(data['misses'])}
+    except (OSError, ValueError, KeyError, TypeError):
+      return {'hits': 0, 'misses': 0}
+
+  @staticmethod
+  def _count_events(filename):
+    result = {'hits': 0, 'misses': 0}
+    try:
+      with open(filename) as fp:
+        for line in fp:
+          line = line.strip()
+          if line == 'hit':
+            result['hits'] += 1
+          elif line == 'miss':
+            result['misses'] += 1
+    except FileNotFoundError:
+      pass
+    return result
+
+  def compact_stats(self):
+    """
+    Adds the events in ``stats.log`` to the counters in ``stats.json`` and
+    removes the log, so that it does not grow with every action. The log
+    is renamed first, events recorded in the meantime go to a new log.
+    """
+
+    logfile = path.join(self.directory, 'stats.log')
+    tempname = '{}.{}.tmp'.format(logfile, os.getpid())
+    try:
+      os.replace(logfile, tempname)
+    except FileNotFoundError:
+      return
+    counters = self._read_counters()
+    events = self._count_events(tempname)
+    counters['hits'] += events['hits']
+    counters['misses'] += events['misses']
+    filename = path.join(self.directory, 'stats.json')
+    with open(filename + '.tmp', 'w') as fp:
+      json.dump(counters, fp)
+    os.replace(filename + '.tmp', filename)
+    os.remove(tempname)
+
+  def gc(self, max_size):
+    """
+    Removes the least recently used objects until the size of the cache is
+    below *max_size* bytes and compacts the statistics log (see
+    :meth:`compact_stats`). Returns a tuple of the number of removed
+    objects and the number of bytes freed.
+
+    This walks the whole cache and should only be called once per build,
+    not by the launcher of every action.
+    """
+
+    self.compact_stats()
+    entries = sorted(self.entries(), key=lambda x: x[2])
+    total = sum(x[1] for x in entries)
+    removed, freed = 0, 0
+    for directory, size, atime in entries:
+      if total <= max_size:
+        break
+      for name in os.listdir(directory):
+        os.chmod(path.join(directory, name), stat.S_IRUSR | stat.S_IWUSR)
+      path.remove(directory, recursive=True, silent=True)
+      total -= size
+      freed += size
+      removed += 1
+    return removed, freed
+
+
+class ActionCacheLauncher(object):
+  """
+  Wraps the commands of :attr:`cacheable<craftr.core.build.Target.cacheable>`
+  targets during the export so that they are executed through the action
+  cache. An instance of this class is added to the
+  :attr:`ExportContext.launchers<craftr.core.build.ExportContext.launchers>`.
+
+  :param builddir: The absolute path to the build directory.
+  :param cache_dir: An alternative cache directory.
+  """
+
+  variable = 'Craftr_action_cache'
+
+  def __init__(self, builddir, cache_dir=None):
+    self.builddir = builddir
+    self.cache_dir = cache_dir
+
+  def export_vars(self, graph):
+    command = [sys.executable, '-m', __name__]
+    if self.cache_dir:
+      command += ['--cache-dir', self.cache_dir]
+    from craftr.utils import shell
+    graph.vars[self.variable] = shell.join(command)
+
+  def wrap(self, target, command):
+    if not target.cacheable or not target.outputs:
+      return command
+    from craftr.utils import shell
+    ident = target.name.rpartition('.')[0]
+    result = [shell.safe('$' + self.variable)]
+    if ident:
+      result += ['--map', path.join(self.builddir, ident) + '=@BUILDLOCAL@']
+    result += ['--map', self.builddir + '=@BUILDDIR@']
+    if target.depfile:
+      result += ['--depfile', target.depfile]
+    for filename in target.implicit_deps:
+      # Implicit dependencies may also be names of phony targets.
+      if path.isabs(filename):
+        result += ['--implicit', filename]
+    result += ['--inputs', '$in', '--outputs', '$out', '--']
+    return result + command
+
+
+def execute(args):
+  """
+  Executes the action described by the parsed command-line *args* of the
+  launcher, either by restoring its outputs from the cache or by running
+  the command and storing the outputs in the cache. Returns the exit code
+  of the command.
+  """
+
+  cache = ActionCache(args.cache_dir)
+  pathmap = PathMap([tuple(x.partition('=')[::2]) for x in args.map])
+
+  key = hashlib.sha1(CACHE_VERSION.encode())
+  for arg in args.command:
+    key.update(pathmap.normalize(arg).encode() + b'\0')
+  for filename in sorted(set(args.inputs + args.implicit)):
+    key.update(pathmap.normalize(filename).encode() + b'\0')
+    key.update(hash_file(filename).encode())
+  action_key = key.hexdigest()
+
+  # Check if any of the recorded sets of discovered dependencies matches
+  # the current state of these files.
+  manifest = cache.read_manifest(action_key)
+  for entry in manifest:
+    try:
+      matches = all(hash_file(pathmap.denormalize(fn)) == digest
+          for fn, digest in entry['deps'].items())
+    except OSError:
+      matches = False
+    if not matches:
+      continue
+    meta = cache.get_object(entry['object'])
+    if meta is None or len(meta['outputs']) != len(args.outputs):
+      continue
+    try:
+      restore_outputs(meta, args, pathmap)
+    except OSError:
+      # The object was removed by "craftr cache gc" while it was restored.
+      for filename in args.outputs:
+        path.remove(filename, silent=True)
+      break
+    cache.record('hit')
+    return 0
+
+  for filename in args.outputs:
+    # Make sure we never write into a file that is hard-linked into the cache.
+    path.remove(filename, silent=True)
+
+  process = subprocess.Popen(args.command, stdout=subprocess.PIPE,
+      stderr=subprocess.PIPE)
+  stdout, stderr = process.communicate()
+  sys.stdout.buffer.write(stdout)
+  sys.stderr.buffer.write(stderr)
+  cache.record('miss')
+  if process.returncode != 0:
+    return process.returncode
+
+  deps = {}
+  depfile_text = None
+  if args.depfile and path.isfile(args.depfile):
+    with open(args.depfile) as fp:
+      depfile_text = fp.read()
+    inputs = set(args.inputs)
+    for filename in parse_depfile(depfile_text):
+      filename = path.norm(filename)
+      if filename not in inputs and path.isfile(filename):
+        deps[pathmap.normalize(filename)] = hash_file(filename)
+
+  key = hashlib.sha1(action_key.encode())
+  for filename, digest in sorted(deps.items()):
+    key.update(filename.encode() + b'\0' + digest.encode())
+  object_key = key.hexdigest()
+
+  meta = {
+    'outputs': [pathmap.normalize(x) for x in args.outputs],
+    'depfile': pathmap.normalize(depfile_text) if depfile_text is not None else None,
+    'stdout': stdout.decode('utf8', 'replace'),
+    'stderr': stderr.decode('utf8', 'replace'),
+  }
+  try:
+    cache.put_object(object_key, args.outputs, meta)
+    manifest = [x for x in cache.read_manifest(action_key) if x['object'] != object_key]
+    manifest.append({'deps': deps, 'object': object_key})
+    cache.write_manifest(action_key, manifest)
+  except OSError as exc:
+    print('craftr: warning: could not store action in cache:', exc, file=sys.stderr)
+  return 0
+
+
+def restore_outputs(meta, args, pathmap):
+  """
+  Restores the outputs of a cached action. Files are copied from the cache
+  (with a copy-on-write clone where the file system supports it, see
+  :func:`pyutils.copyfile() <craftr.utils.pyutils.copyfile>`) and their
+  modification time is set to the current time, otherwise Ninja would
+  consider the outputs older than their inputs and run the action again.
+
+  :raise OSError: If a file of the object can not be copied, eg. because
+    the object was removed in the meantime. Outputs that were already
+    restored are left in place.
+  """
+
+  for index, filename in enumerate(args.outputs):
+    source = path.join(meta['directory'], str(index))
+    path.makedirs(path.dirname(path.abs(filename)))
+    path.remove(filename, silent=True)
+    for progress in pyutils.copyfile(source, filename):
+      pass
+    os.utime(filename, None)
+  if args.depfile and meta.get('depfile') is not None:
+    with open(args.depfile, 'w') as fp:
+      fp.write(pathmap.denormalize(meta['depfile']))
+  sys.stdout.write(meta.get('stdout', ''))
+  sys.stderr.write(meta.get('stderr', ''))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='python -m craftr.core.actioncache')
+  parser.add_argument('--cache-dir')
+  parser.add_argument('--map', action='append', default=[])
+  parser.add_argument('--depfile')
+  parser.add_argument('--implicit', action='append', default=[])
+  parser.add_argument('--inputs', nargs='*', default=[])
+  parser.add_argument('--outputs', nargs='*', default=[])
+  parser.add_argument('command', nargs=argparse.REMAINDER)
+  args = parser.parse_args(argv)
+  if args.command and args.command[0] == '--':
+    args.command.pop(0)
+  if not args.command:
+    parser.error('missing command')
+  return execute(args)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
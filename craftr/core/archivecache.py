@@ -0,0 +1,370 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.archivecache`
+===============================
+
+A user-level cache for the files downloaded by
+:func:`~craftr.loaders.external_file` and the trees extracted by
+:func:`~craftr.loaders.external_archive`, so that every build directory
+does not download and unpack the same archives again. It is enabled with
+the ``craftr.archive_cache`` option. Since extracted trees are shared and
+read-only, build scripts that write into an extracted archive must pass
+``shared=False`` to :func:`~craftr.loaders.external_archive`.
+
+Downloads are stored under their *download key*, which is the SHA-256
+checksum passed to the loader or otherwise the SHA-256 hash of the URL.
+Extracted trees are stored under a key derived from the download key and
+the files excluded from the archive. The files in the cache are read-only,
+the build directories link to them with a symbolic link (or hard links
+where symbolic links are not available). A process that downloads a file
+into the cache holds a lock on its download directory, so that concurrent
+processes wait for the download instead of writing into the same partial
+file.
+
+The cache is trimmed to ``craftr.archive_cache.max_size`` (``10G`` by
+default) whenever an entry is added, removing the least recently used
+entries first. ``craftr cache prune`` does the same on demand.
+"""
+
+from craftr.core import actioncache
+from craftr.utils import path, pyutils
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+
+DEFAULT_MAX_SIZE = '10G'
+
+_WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+
+def is_enabled(options):
+  """
+  Returns :const:`True` if the ``craftr.archive_cache`` option is enabled
+  in the *options* dictionary.
+  """
+
+  from craftr.core.manifest import BoolOption
+  option = BoolOption('craftr.archive_cache', default=False)
+  return option(options.get('craftr.archive_cache', ''))
+
+
+def get_max_size(options):
+  """
+  Returns the ``craftr.archive_cache.max_size`` option in bytes.
+  """
+
+  return pyutils.parse_size(options.get('craftr.archive_cache.max_size', DEFAULT_MAX_SIZE))
+
+
+def _tree_size(directory):
+  size = 0
+  for root, dirs, files in os.walk(directory):
+    for name in files:
+      try:
+        size += os.lstat(path.join(root, name)).st_size
+      except OSError:
+        pass
+  return size
+
+
+def _chmod_tree(directory, writable):
+  for root, dirs, files in os.walk(directory):
+    for name in [root] + [path.join(root, x) for x in files + dirs]:
+      st = os.lstat(name)
+      if stat.S_ISLNK(st.st_mode):
+        continue
+      mode = stat.S_IMODE(st.st_mode)
+      os.chmod(name, (mode | stat.S_IWUSR) if writable else (mode & ~_WRITE_BITS))
+
+
+def _remove_tree(directory):
+  if path.isdir(directory):
+    _chmod_tree(directory, True)
+  path.remove(directory, recursive=True, silent=True)
+
+
+def link_file(source, dest):
+  """
+  Creates a hard link to the file *source* at *dest*, or copies it if the
+  link can not be created. An existing file at *dest* is replaced.
+  """
+
+  path.makedirs(path.dirname(path.norm(dest)))
+  if os.path.lexists(dest):
+    os.remove(dest)
+  try:
+    os.link(source, dest)
+  except OSError:
+    shutil.copyfile(source, dest)
+
+
+def link_tree(source, dest):
+  """
+  Makes the directory *source* available at *dest* with a symbolic link.
+  Where symbolic links can not be created (eg. on Windows without the
+  required privilege), the tree is reproduced with hard links or copied.
+  Whatever exists at *dest* is removed first.
+  """
+
+  path.makedirs(path.dirname(path.norm(dest)))
+  if os.path.islink(dest) or os.path.isfile(dest):
+    os.remove(dest)
+  elif os.path.isdir(dest):
+    _remove_tree(dest)
+  try:
+    os.symlink(source, dest, target_is_directory=True)
+  except (OSError, NotImplementedError):
+    try:
+      shutil.copytree(source, dest, symlinks=True, copy_function=os.link)
+    except (OSError, shutil.Error):
+      _remove_tree(dest)
+      shutil.copytree(source, dest, symlinks=True)
+
+
+class DownloadLock(object):
+  """
+  An exclusive lock on the file *filename*, which is created if it does not
+  exist. The constructor blocks until the lock is acquired. Uses
+  :func:`fcntl.flock` or :func:`msvcrt.locking` on Windows.
+  """
+
+  def __init__(self, filename):
+    path.makedirs(path.dirname(filename))
+    self.fp = open(filename, 'a+b')
+    try:
+      if os.name == 'nt':
+        import msvcrt
+        self.fp.seek(0)
+        while True:
+          try:
+            msvcrt.locking(self.fp.fileno(), msvcrt.LK_LOCK, 1)
+            break
+          except OSError:
+            pass  # LK_LOCK gives up after 10 seconds
+      else:
+        import fcntl
+        fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
+    except BaseException:
+      self.fp.close()
+      raise
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.release()
+
+  def release(self):
+    """
+    Releases the lock. Does nothing if it was already released.
+    """
+
+    if not self.fp.closed:
+      if os.name == 'nt':
+        import msvcrt
+        self.fp.seek(0)
+        msvcrt.locking(self.fp.fileno(), msvcrt.LK_UNLCK, 1)
+      self.fp.close()
+
+
+class ArchiveCache(object):
+  """
+  Represents the archive cache in *directory*, which defaults to
+  ``~/.cache/craftr/archives`` (see :func:`actioncache.get_cache_dir()
+  <craftr.core.actioncache.get_cache_dir>`).
+
+  Every download is stored in its own directory together with a
+  ``meta.json`` file, every tree has a ``<key>.json`` file next to it. The
+  modification time of these files records when the entry was last used.
+  """
+
+  def __init__(self, directory=None):
+    self.directory = directory or actioncache.get_cache_dir('archives')
+
+  @staticmethod
+  def download_key(url, sha256=None):
+    """
+    Returns the key of the download of *url*. If the expected *sha256*
+    checksum is known, it is used as the key so that the same file is
+    shared between mirrors.
+    """
+
+    if sha256:
+      return sha256.lower()
+    return hashlib.sha256(url.encode('utf8')).hexdigest()
+
+  @staticmethod
+  def tree_key(download_key, exclude_files=()):
+    """
+    Returns the key of the tree extracted from the download with the
+    specified *download_key* without the files matching *exclude_files*.
+    """
+
+    data = json.dumps([download_key, sorted(exclude_files)])
+    return hashlib.sha256(data.encode('utf8')).hexdigest()
+
+  def download_dir(self, key):
+    return path.join(self.directory, 'downloads', key[:2], key)
+
+  def tree_dir(self, key):
+    return path.join(self.directory, 'trees', key[:2], key)
+
+  def get_download(self, key):
+    """
+    Returns the filename of the download with the specified *key* and
+    marks it as used, or returns :const:`None` if it is not in the cache.
+    """
+
+    meta_file = path.join(self.download_dir(key), 'meta.json')
+    try:
+      with open(meta_file) as fp:
+        filename = path.join(self.download_dir(key), json.load(fp)['filename'])
+      if not path.isfile(filename):
+        return None
+      os.utime(meta_file, None)
+    except (OSError, ValueError, KeyError):
+      return None
+    return filename
+
+  def lock_download(self, key):
+    """
+    Waits until no other process downloads the file with the specified
+    *key* and returns a :class:`DownloadLock` that must be released when
+    the download is finished. Check :meth:`get_download` again after the
+    lock was acquired.
+    """
+
+    return DownloadLock(path.join(self.download_dir(key), 'lock'))
+
+  def put_download(self, key, url, filename, sha256):
+    """
+    Marks the file *filename*, which has been downloaded from *url* into
+    the :meth:`download_dir` of *key*, as complete and makes it read-only.
+    *sha256* is the checksum of the file.
+    """
+
+    mode = stat.S_IMODE(os.stat(filename).st_mode)
+    os.chmod(filename, mode & ~_WRITE_BITS)
+    meta = {'url': url, 'filename': path.basename(filename), 'sha256': sha256}
+    meta_file = path.join(self.download_dir(key), 'meta.json')
+    tempname = '{}.{}.tmp'.format(meta_file, os.getpid())
+    with open(tempname, 'w') as fp:
+      json.dump(meta, fp)
+    os.replace(tempname, meta_file)
+
+  def get_tree(self, key):
+    """
+    Returns the directory of the tree with the specified *key* and marks it
+    as used, or returns :const:`None` if it is not in the cache.
+    """
+
+    directory = self.tree_dir(key)
+    try:
+      os.utime(directory + '.json', None)
+    except OSError:
+      return None
+    if not path.isdir(directory):
+      return None
+    return directory
+
+  def put_tree(self, key, extract, meta=None):
+    """
+    Calls *extract* with the name of a temporary directory that it must
+    populate and moves that directory into the cache under the specified
+    *key*. The files of the tree are made read-only. Returns the directory
+    of the tree. If another process added the same tree in the meantime,
+    that tree is returned instead.
+    """
+
+    directory = self.tree_dir(key)
+    tempdir = '{}.{}.tmp'.format(directory, os.getpid())
+    _remove_tree(tempdir)
+    path.makedirs(tempdir)
+    try:
+      extract(tempdir)
+      _chmod_tree(tempdir, False)
+      os.rename(tempdir, directory)
+    except OSError:
+      _remove_tree(tempdir)
+      if not path.isdir(directory):
+        raise
+    except BaseException:
+      _remove_tree(tempdir)
+      raise
+    with open(directory + '.json', 'w') as fp:
+      json.dump(meta or {}, fp)
+    return directory
+
+  def entries(self):
+    """
+    Yields ``(filename, size, atime)`` for every download directory and
+    every tree in the cache. Downloads that were interrupted are included.
+    """
+
+    downloads_dir = path.join(self.directory, 'downloads')
+    for prefix in path.easy_listdir(downloads_dir):
+      for name in path.easy_listdir(path.join(downloads_dir, prefix)):
+        directory = path.join(downloads_dir, prefix, name)
+        meta_file = path.join(directory, 'meta.json')
+        try:
+          atime = os.stat(meta_file if path.isfile(meta_file) else directory).st_mtime
+        except OSError:
+          continue
+        yield directory, _tree_size(directory), atime
+
+    trees_dir = path.join(self.directory, 'trees')
+    for prefix in path.easy_listdir(trees_dir):
+      for name in path.easy_listdir(path.join(trees_dir, prefix)):
+        directory = path.join(trees_dir, prefix, name)
+        if name.endswith('.json') or name.endswith('.tmp'):
+          continue
+        try:
+          atime = os.stat(directory + '.json').st_mtime
+        except OSError:
+          atime = 0
+        yield directory, _tree_size(directory), atime
+
+  def prune(self, max_size, keep=()):
+    """
+    Removes the least recently used entries until the size of the cache is
+    below *max_size* bytes. Returns a tuple of the number of removed
+    entries and the number of bytes freed. Build directories that link to
+    a removed tree extract the archive again on their next export.
+
+    :param keep: A list of download or tree directories that are never
+      removed, eg. the entry that was just added and linked into the build
+      directory, even if it alone is larger than *max_size*.
+    """
+
+    keep = set(keep)
+    entries = sorted(self.entries(), key=lambda x: x[2])
+    total = sum(x[1] for x in entries)
+    removed, freed = 0, 0
+    for directory, size, atime in entries:
+      if total <= max_size:
+        break
+      if directory in keep:
+        continue
+      _remove_tree(directory)
+      path.remove(directory + '.json', silent=True)
+      total -= size
+      freed += size
+      removed += 1
+    return removed, freed
@@ -21,6 +21,7 @@ This module provides all the API to generate a Ninja build manifest.
 """
 
 from craftr import platform
+from craftr.core import restat, trace
 from craftr.utils import argspec
 from craftr.utils import path
 from craftr.utils import pyutils
@@ -87,6 +88,18 @@ class Graph(object):
   .. attributes:: vars
 
     A dictionary of variables that will be exported to the Ninja manifest.
+
+  .. attribute:: pools
+
+    A dictionary that maps the names of Ninja pools to their depth. Use
+    :meth:`add_pool` to declare a new pool.
+
+  .. attribute:: includes
+
+    A list of filenames of Ninja files that are included into the manifest
+    after the :attr:`vars`. Ninja reads them on every invocation, thus they
+    can declare things that change without a re-export (eg. the depth of a
+    pool, see :mod:`craftr.core.rusage`).
   """
 
   def __init__(self):
@@ -95,6 +108,8 @@ class Graph(object):
     self.infiles = {}
     self.outfiles = {}
     self.vars = {}
+    self.pools = {}
+    self.includes = []
     self.tools = {}
 
   def add_tool(self, tool):
@@ -109,6 +124,25 @@ class Graph(object):
           .format(tool.name))
     self.tools[tool.name] = tool
 
+  def add_pool(self, name, depth):
+    """
+    Declare a Ninja pool with the specified *name* that allows at most
+    *depth* jobs to run in parallel. Targets reference the pool by its
+    name with the :attr:`Target.pool` parameter.
+
+    :raise ValueError: If a pool with the specified *name* already exists
+      or if *name* is the name of the built-in ``console`` pool.
+    """
+
+    argspec.validate('name', name, {'type': str})
+    argspec.validate('depth', depth, {'type': int})
+    if name in self.pools or name == 'console':
+      raise ValueError('a pool with the name {!r} already exists'
+          .format(name))
+    if depth < 1:
+      raise ValueError('pool depth must be at least 1, got {}'.format(depth))
+    self.pools[name] = depth
+
   def add_target(self, target):
     """
     Add a :class:`Target` to the Graph.
@@ -154,6 +188,8 @@ class Graph(object):
     return target
 
 
+  @trace.traced('Graph.export', 'export',
+      lambda self, *args, **kwargs: {'targets': len(self.targets)})
   def export(self, writer, context, platform):
     """
     Export the build graph to a Ninja manifest.
@@ -164,15 +200,34 @@ class Graph(object):
     """
 
     argspec.validate('writer', writer, {"type": ninja_syntax.Writer})
+    for launcher in context.launchers:
+      if hasattr(launcher, 'export_vars'):
+        launcher.export_vars(self)
+
     writer.comment('This file was automatically generated with Craftr.')
     writer.comment('It is not recommended to edit this file manually.')
     writer.newline()
 
+    if any(target.dyndep for target in self.targets.values()):
+      # Dynamic dependencies require Ninja 1.10.
+      writer.variable('ninja_required_version', '1.10')
+      writer.newline()
+
     if self.vars:
       for key, value in self.vars.items():
         writer.variable(key, value)
       writer.newline()
 
+    if self.includes:
+      for filename in self.includes:
+        writer.include(filename)
+      writer.newline()
+
+    if self.pools:
+      for name, depth in sorted(self.pools.items()):
+        writer.pool(name, depth)
+      writer.newline()
+
     if self.tools:
       writer.comment('Tools')
       writer.comment('-----')
@@ -189,18 +244,50 @@ class Graph(object):
     if defaults:
       writer.default(defaults)
 
+
+def expand_frameworks(frameworks, seen=None):
+  """
+  Returns a tuple of the *frameworks* and the frameworks listed in their
+  ``'frameworks'`` key, recursively, in the order in which
+  :class:`~craftr.targetbuilder.OptionMerge` looks up options. Every
+  framework is included only once.
+
+  :param seen: A set of the ids of frameworks to skip, including the
+    frameworks they list. It is updated with the ids of the returned
+    frameworks.
+  """
+
+  if seen is None:
+    seen = set()
+  result = []
+  stack = list(reversed(frameworks))
+  while stack:
+    fw = stack.pop()
+    if id(fw) in seen:
+      continue
+    seen.add(id(fw))
+    result.append(fw)
+    stack.extend(reversed(fw.get('frameworks', ())))
+  return tuple(result)
+
+
 class Target(object):
   """
   A higher level abstraction of a Target that can be added to a :class:`Graph`
   and then exported into a Ninja build manifest. A target should be treated
   as read-only always.
+
+  The :attr:`frameworks` of a target are a tuple that contains the frameworks
+  passed to the constructor and all frameworks they include, see
+  :func:`expand_frameworks`.
   """
 
   def __init__(self, name, commands, inputs, outputs, implicit_deps=(),
                order_only_deps=(), pool=None, deps=None, depfile=None,
                msvc_deps_prefix=None, explicit=False, foreach=False,
                description=None, metadata=None, cwd=None, environ=None,
-               frameworks=(), task=None, runprefix=None):
+               frameworks=(), task=None, runprefix=None, cacheable=False,
+               restat=False, dyndep=None):
     argspec.validate('name', name, {'type': str})
     argspec.validate('commands', commands,
       {'type': list, 'allowEmpty': False, 'items':
@@ -222,6 +309,9 @@ class Target(object):
     argspec.validate('frameworks', frameworks, {'type': [list, tuple], 'items': {'type': dict}})
     argspec.validate('task', task, {'type': [None, Task]})
     argspec.validate('runprefix', runprefix, {'type': [None, list, str], 'items': {'type': str}})
+    argspec.validate('cacheable', cacheable, {'type': bool})
+    argspec.validate('restat', restat, {'type': bool})
+    argspec.validate('dyndep', dyndep, {'type': [None, str]})
 
     if isinstance(runprefix, str):
       runprefix = shell.split(runprefix)
@@ -265,6 +355,14 @@ class Target(object):
     self.implicit_deps += expand_mixed_list(implicit_deps, None, 'implicit')
     self.order_only_deps = expand_mixed_list(order_only_deps, None, 'implicit')
 
+    # Ninja requires the dyndep file to be an input of the build. It is an
+    # order-only dependency, the dyndep file itself lists the inputs that
+    # need to cause a rebuild.
+    if dyndep is not None:
+      dyndep = path.abs(dyndep)
+      if dyndep not in self.implicit_deps + self.order_only_deps:
+        self.order_only_deps.append(dyndep)
+
     self.name = name
     self.pool = pool
     self.deps = deps
@@ -276,9 +374,12 @@ class Target(object):
     self.metadata = metadata or {}
     self.cwd = cwd
     self.environ = environ or {}
-    self.frameworks = frameworks
+    self.frameworks = expand_frameworks(frameworks)
     self.task = task
     self.runprefix = runprefix
+    self.cacheable = cacheable
+    self.restat = restat
+    self.dyndep = dyndep
 
     if self.foreach and len(self.inputs) != len(self.outputs):
       raise ValueError('foreach target must have the same number of output '
@@ -316,22 +417,37 @@ class Target(object):
     writer.comment("--------" + "-" * len(self.name))
     commands = platform.prepare_commands(self.commands)
 
-    # Check if we need to export a command file or can export the command
-    # directly.
-    if not self.environ and len(commands) == 1:
-      commands = [platform.prepare_single_command(commands[0], self.cwd)]
-    else:
+    # Export the commands inline if possible, otherwise in a command file.
+    # Launchers are only applied to single commands without environment
+    # variables.
+    pool = self.pool
+    command = None
+    if len(commands) == 1:
+      command = commands[0]
+      if not self.environ:
+        for launcher in context.launchers:
+          command = launcher.wrap(self, command)
+          pool = getattr(launcher, 'get_pool', lambda x: None)(self) or pool
+      if self.restat and not self.task:
+        command = restat.wrap(command)
+      command = platform.prepare_single_command(command, self.cwd, self.environ)
+    elif not self.restat or self.task:
+      command = platform.prepare_command_chain(commands, self.cwd, self.environ)
+
+    if command is None:
       filename = path.join('.commands', self.name)
       command, __ = platform.write_command_file(filename, commands,
         self.inputs, self.outputs, cwd=self.cwd, environ=self.environ,
         foreach=self.foreach)
-      commands = [command]
+      if self.restat and not self.task:
+        command = restat.wrap(command)
+    commands = [command]
 
     assert len(commands) == 1
     command = shell.join(commands[0], for_ninja=True)
 
-    writer.rule(self.name, command, pool=self.pool, deps=self.deps,
-      depfile=self.depfile, description=self.description)
+    writer.rule(self.name, command, pool=pool, deps=self.deps,
+      depfile=self.depfile, description=self.description, restat=self.restat)
 
     if self.msvc_deps_prefix:
       # We can not write msvc_deps_prefix on the rule level with Ninja
@@ -341,6 +457,7 @@ class Target(object):
       writer.variable('msvc_deps_prefix', self.msvc_deps_prefix, indent)
 
     writer.newline()
+    variables = {'dyndep': self.dyndep} if self.dyndep else None
     if self.foreach:
       assert len(self.inputs) == len(self.outputs)
       for infile, outfile in zip(self.inputs, self.outputs):
@@ -349,14 +466,16 @@ class Target(object):
           self.name,
           [infile],
           implicit=self.implicit_deps,
-          order_only=self.order_only_deps)
+          order_only=self.order_only_deps,
+          variables=variables)
     else:
       writer.build(
         self.outputs or [self.name],
         self.name,
         self.inputs,
         implicit=self.implicit_deps,
-        order_only=self.order_only_deps)
+        order_only=self.order_only_deps,
+        variables=variables)
 
     if self.outputs and self.name not in self.outputs:
       writer.build(self.name, 'phony', self.outputs)
@@ -506,10 +625,21 @@ class ExportContext(object):
   the exported manifest.
 
   .. attribute:: ninja_version
+
+  .. attribute:: launchers
+
+    A list of objects that implement a ``wrap(target, command)`` method
+    which is called for every :class:`Target` that is exported with a
+    single command. The method returns the new command, for example to
+    execute it through the :mod:`craftr.core.actioncache`. If the object
+    has an ``export_vars(graph)`` method, it is called before the
+    :class:`Graph` is exported. If it has a ``get_pool(target)`` method
+    that returns a pool name, the target is exported into that pool.
   """
 
-  def __init__(self, ninja_version):
+  def __init__(self, ninja_version, launchers=()):
     self.ninja_version = ninja_version
+    self.launchers = list(launchers)
 
 
 class PlatformHelper(object, metaclass=abc.ABCMeta):
@@ -526,11 +656,21 @@ class PlatformHelper(object, metaclass=abc.ABCMeta):
     """
 
   @abc.abstractmethod
-  def prepare_single_command(self, command, cwd):
+  def prepare_single_command(self, command, cwd, environ=None):
+    """
+    Given a single command as a list of strings, an optional working
+    directory path and a dictionary of environment variables, return an
+    updated list of strings that serves as the new command including the
+    current working directory switch and the environment variables. Return
+    :const:`None` if the command can not be expressed without a command
+    file (see :meth:`write_command_file`).
+    """
+
+  @abc.abstractmethod
+  def prepare_command_chain(self, commands, cwd, environ=None):
     """
-    Given a single command as a list of strings and an optional working
-    directory path, return an updated list of strings that serves as the
-    new command including the current working directory switch.
+    Like :meth:`prepare_single_command`, but for multiple *commands* that
+    must be executed one after another and stop at the first failure.
     """
 
   @abc.abstractmethod
@@ -626,11 +766,16 @@ class WindowsPlatformHelper(PlatformHelper):
       new_commands.append(args)
     return new_commands
 
-  def prepare_single_command(self, command, cwd):
+  def prepare_single_command(self, command, cwd, environ=None):
+    if environ:
+      return None
     if cwd is not None:
       command = ['cmd', '/c', 'cd', cwd, shell.safe('&&')] + command
     return command
 
+  def prepare_command_chain(self, commands, cwd, environ=None):
+    return None
+
   def write_command_file(self, filename, commands, inputs=None, outputs=None,
       cwd=None, environ=None, foreach=False, suffix='.cmd', dry=False,
       accept_additional_args=False):
@@ -646,20 +791,18 @@ class WindowsPlatformHelper(PlatformHelper):
     if dry:
       return result, filename
 
-    path.makedirs(path.dirname(path.abs(filename)))
-    with open(filename, 'w') as fp:
-      fp.write('REM This file is automatically generated with Craftr. It is \n')
-      fp.write('REM not recommended to modify it manually.\n\n')
-      if cwd is not None:
-        fp.write('cd ' + shell.quote(cwd) + '\n\n')
-      for key, value in environ.items():
-        fp.write('set ' + shell.quote('{}={}'.format(key, value), for_ninja=True) + '\n')
-      fp.write('\n')
-      for index, command in enumerate(commands):
-        if accept_additional_args and index == len(commands)-1:
-          command.append(shell.safe('%*'))
-        fp.write(shell.join(command) + '\n')
-        fp.write('if %errorlevel% neq 0 exit %errorlevel%\n\n')
+    lines = ['REM This file is automatically generated with Craftr. It is ',
+      'REM not recommended to modify it manually.', '']
+    if cwd is not None:
+      lines += ['cd ' + shell.quote(cwd), '']
+    for key, value in environ.items():
+      lines.append('set ' + shell.quote('{}={}'.format(key, value), for_ninja=True))
+    lines.append('')
+    for index, command in enumerate(commands):
+      if accept_additional_args and index == len(commands)-1:
+        command.append(shell.safe('%*'))
+      lines += [shell.join(command), 'if %errorlevel% neq 0 exit %errorlevel%', '']
+    path.write_if_changed(filename, '\r\n'.join(lines) + '\r\n')
 
     return result, filename
 
@@ -672,11 +815,53 @@ class UnixPlatformHelper(PlatformHelper):
   def prepare_commands(self, commands):
     return commands
 
-  def prepare_single_command(self, command, cwd):
+  # Ninja runs every command with "/bin/sh -c". The commands are exported
+  # so that the shell replaces itself with the last program ("exec") instead
+  # of forking it, and "env" sets the environment variables by replacing
+  # itself with the program as well.
+
+  SHELL_OPERATORS = frozenset(['&&', '||', ';', '|', '&', '(', ')'])
+
+  def is_simple_command(self, command):
+    """
+    Returns :const:`True` if *command* does not contain shell operators,
+    thus it can be prefixed with ``exec`` or ``env``.
+    """
+
+    return not any(isinstance(x, shell.safe) and x.strip() in self.SHELL_OPERATORS
+        for x in command)
+
+  @staticmethod
+  def format_environ(environ):
+    # Dollar signs must be escaped for Ninja, the values are passed to the
+    # program literally as in command files.
+    return ['{}={}'.format(k, v.replace('$', '$$')) for k, v in sorted(environ.items())]
+
+  def prepare_single_command(self, command, cwd, environ=None):
+    if not self.is_simple_command(command):
+      if environ:
+        return None
+      if cwd is not None:
+        command = [shell.safe('('), 'cd', cwd, shell.safe('&&')] + command + [shell.safe(')')]
+      return command
+    if environ:
+      command = ['env'] + self.format_environ(environ) + command
     if cwd is not None:
-      command = [shell.safe('('), 'cd', cwd, shell.safe('&&')] + command + [shell.safe(')')]
+      command = ['cd', cwd, shell.safe('&&'), shell.safe('exec')] + command
     return command
 
+  def prepare_command_chain(self, commands, cwd, environ=None):
+    if not all(map(self.is_simple_command, commands)):
+      return None
+    result = []
+    if cwd is not None:
+      result += ['cd', cwd, shell.safe('&&')]
+    if environ:
+      result += ['export'] + self.format_environ(environ) + [shell.safe('&&')]
+    for command in commands[:-1]:
+      result += command + [shell.safe('&&')]
+    return result + [shell.safe('exec')] + commands[-1]
+
   def write_command_file(self, filename, commands, inputs=None, outputs=None,
       cwd=None, environ=None, foreach=False, suffix='.sh', dry=False,
       accept_additional_args=False):
@@ -692,24 +877,20 @@ class UnixPlatformHelper(PlatformHelper):
     if dry:
       return result, filename
 
-    path.makedirs(path.dirname(filename))
-    with open(filename, 'w') as fp:
-      # TODO: Make sure this also works for shells other than bash.
-      fp.write('#!' + shell.find_program(environ.get('SHELL', 'bash')) + '\n')
-      fp.write('set -e\n')
-      if cwd:
-        fp.write('cd ' + shell.quote(cwd) + '\n')
-      fp.write('\n')
-      for key, value in environ.items():
-        fp.write('export {}={}\n'.format(key, shell.quote(value)))
-      fp.write('\n')
-      for index, command in enumerate(commands):
-        if accept_additional_args and index == len(commands)-1:
-          command.append(shell.safe('$*'))
-        fp.write(shell.join(command))
-        fp.write('\n')
-
-    os.chmod(filename, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR |
+    # TODO: Make sure this also works for shells other than bash.
+    lines = ['#!' + shell.find_program(environ.get('SHELL', 'bash')), 'set -e']
+    if cwd:
+      lines.append('cd ' + shell.quote(cwd))
+    lines.append('')
+    for key, value in environ.items():
+      lines.append('export {}={}'.format(key, shell.quote(value)))
+    lines.append('')
+    for index, command in enumerate(commands):
+      if accept_additional_args and index == len(commands)-1:
+        command.append(shell.safe('$*'))
+      lines.append(shell.join(command))
+    path.write_if_changed(filename, '\n'.join(lines) + '\n',
+      mode=stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR |
       stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH)  # rwxrw-r--
 
     return result, filename
@@ -0,0 +1,179 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.dyndep`
+=========================
+
+Support for Ninja's dynamic dependencies (``dyndep``), which are required to
+build C++20 modules: the order in which the translation units of a target
+must be compiled depends on the modules they export and import, which is
+only known after the sources have been scanned.
+
+The scan step produces one `P1689`_ file per translation unit. The collate
+step, which is invoked by Ninja as ``python -m craftr.core.dyndep collate``,
+reads all of them and writes
+
+* a module map for every translation unit (``<object>.modmap``) that tells
+  the compiler where to write and find the BMIs (built module interfaces),
+  and
+* the dyndep file that adds the BMI of every exported module as an implicit
+  output of the translation unit that exports it and the BMIs and the
+  module map as implicit inputs of every translation unit that imports it.
+
+All files are written with :func:`path.write_if_changed()<craftr.utils.path.write_if_changed>`.
+The dyndep file is an order-only dependency of the compile step, thus a
+translation unit is only recompiled if its own imports changed.
+
+.. _P1689: https://wg21.link/p1689r5
+"""
+
+from craftr.utils import path
+
+import argparse
+import json
+import ninja_syntax
+import sys
+
+#: The suffix of the scan results, appended to the object filename.
+SCAN_SUFFIX = '.ddi'
+
+#: The suffix of the module map, appended to the object filename.
+MODMAP_SUFFIX = '.modmap'
+
+#: The BMI filename suffix for the supported compilers.
+BMI_SUFFIX = {'gcc': '.gcm', 'llvm': '.pcm'}
+
+
+class ScanError(Exception):
+  pass
+
+
+def read_scan(filename):
+  """
+  Reads the P1689 file *filename* and returns a tuple of the names of the
+  modules that the translation unit provides and the names of the modules
+  that it requires.
+
+  :raise ScanError: If the file is invalid or the translation unit imports
+    header units, which are not supported.
+  """
+
+  try:
+    with open(filename) as fp:
+      data = json.load(fp)
+  except (OSError, ValueError) as exc:
+    raise ScanError('{}: {}'.format(filename, exc))
+  provides, requires = [], []
+  for rule in data.get('rules', []):
+    provides += [x['logical-name'] for x in rule.get('provides', [])]
+    for item in rule.get('requires', []):
+      if 'lookup-method' in item:
+        raise ScanError('{}: header unit "{}" is not supported'
+            .format(filename, item['logical-name']))
+      requires.append(item['logical-name'])
+  return provides, requires
+
+
+def bmi_filename(bmi_dir, module, compiler):
+  return path.join(bmi_dir, module.replace(':', '-') + BMI_SUFFIX[compiler])
+
+
+def collate(objects, output, bmi_dir, compiler):
+  """
+  Reads the scan results of the *objects* and writes the dyndep file
+  *output* and the module map of every object.
+
+  :param objects: A list of the object files of the translation units.
+    The scan result of every object must be in ``<object>.ddi``.
+  :param output: The filename of the dyndep file.
+  :param bmi_dir: The directory to place the BMIs in.
+  :param compiler: The compiler name, ``'gcc'`` or ``'llvm'``.
+  :raise ScanError: If a module is provided more than once or a module
+    is required that is not provided by any of the *objects*.
+  """
+
+  providers = {}
+  scans = {}
+  for obj in objects:
+    provides, requires = read_scan(obj + SCAN_SUFFIX)
+    for module in provides:
+      if module in providers:
+        raise ScanError('module "{}" is provided by "{}" and "{}"'.format(
+            module, providers[module], obj))
+      providers[module] = obj
+    scans[obj] = (provides, requires)
+
+  def closure(modules, result):
+    for module in modules:
+      if module not in result:
+        if module not in providers:
+          raise ScanError('module "{}" is not provided by any source of '
+              'the target'.format(module))
+        result.add(module)
+        closure(scans[providers[module]][1], result)
+    return result
+
+  path.makedirs(bmi_dir)
+  lines = ['ninja_dyndep_version = 1']
+  for obj in objects:
+    provides, requires = scans[obj]
+    outputs = [bmi_filename(bmi_dir, x, compiler) for x in provides]
+    inputs = [bmi_filename(bmi_dir, x, compiler) for x in sorted(set(requires))]
+    inputs.append(obj + MODMAP_SUFFIX)
+    line = 'build ' + ninja_syntax.escape_path(obj)
+    if outputs:
+      line += ' | ' + ' '.join(map(ninja_syntax.escape_path, outputs))
+    line += ': dyndep | ' + ' '.join(map(ninja_syntax.escape_path, inputs))
+    lines.append(line)
+
+    imported = sorted(closure(requires, set()))
+    if compiler == 'gcc':
+      # A GCC module mapper file, passed with -fmodule-mapper.
+      modmap = ['{} {}'.format(x, bmi_filename(bmi_dir, x, compiler))
+          for x in provides + imported]
+    else:
+      # A response file with Clang options.
+      modmap = ['"-fmodule-output={}"'.format(bmi_filename(bmi_dir, x, compiler))
+          for x in provides]
+      modmap += ['"-fmodule-file={}={}"'.format(x, bmi_filename(bmi_dir, x, compiler))
+          for x in imported]
+    path.write_if_changed(obj + MODMAP_SUFFIX, '\n'.join(modmap) + '\n')
+
+  path.write_if_changed(output, '\n'.join(lines) + '\n')
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='python -m craftr.core.dyndep')
+  subparsers = parser.add_subparsers(dest='command')
+  collate_parser = subparsers.add_parser('collate')
+  collate_parser.add_argument('--output', required=True)
+  collate_parser.add_argument('--bmi-dir', required=True)
+  collate_parser.add_argument('--compiler', required=True, choices=sorted(BMI_SUFFIX))
+  collate_parser.add_argument('scans', nargs='*')
+  args = parser.parse_args(argv)
+  if args.command != 'collate':
+    parser.error('missing command')
+  objects = [path.rmvsuffix(x) for x in args.scans]
+  try:
+    collate(objects, args.output, args.bmi_dir, args.compiler)
+  except ScanError as exc:
+    print('error:', exc, file=sys.stderr)
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
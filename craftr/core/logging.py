@@ -19,6 +19,8 @@ from craftr.utils import tty
 import abc
 import contextlib
 import itertools
+import json
+import signal
 import sys
 import time
 import werkzeug
@@ -28,6 +30,73 @@ INFO = 10
 WARNING = 15
 ERROR = 20
 
+LEVEL_NAMES = {DEBUG: 'debug', INFO: 'info', WARNING: 'warning', ERROR: 'error'}
+
+
+def get_current_module():
+  """
+  Returns the :class:`Module<craftr.core.session.Module>` that is currently
+  being executed, or None.
+  """
+
+  from craftr.core.session import session
+  return session.module if session else None
+
+
+def get_module_line(module):
+  try:
+    return module.current_line
+  except RuntimeError:
+    return None
+
+
+def get_module_frame(module):
+  """
+  Returns the frame that executes the top-level code of *module*, or None
+  if it is not on the stack of the current thread. Its ``f_lineno`` is the
+  line of the statement that is currently being executed.
+  """
+
+  namespace = vars(module.namespace)
+  frame = sys._getframe()
+  while frame and not (frame.f_globals is namespace and frame.f_code.co_name == '<module>'):
+    frame = frame.f_back
+  return frame
+
+
+class _TerminalWidth(object):
+  """
+  Caches the width of the terminal. The cached value is invalidated when
+  the process receives ``SIGWINCH``, if the signal handler can be installed.
+  """
+
+  def __init__(self):
+    self._width = None
+    self._handler_installed = False
+
+  def _on_sigwinch(self, signum, frame):
+    self._width = None
+    if callable(self._previous_handler):
+      self._previous_handler(signum, frame)
+
+  def get(self):
+    if self._width is None:
+      self._width = tty.terminal_size()[0]
+      if not self._handler_installed and hasattr(signal, 'SIGWINCH'):
+        self._handler_installed = True
+        try:
+          self._previous_handler = signal.signal(signal.SIGWINCH, self._on_sigwinch)
+        except ValueError:
+          # Not in the main thread, we can not install the handler and
+          # thus must not cache the width.
+          self._handler_installed = False
+          width, self._width = self._width, None
+          return width
+    return self._width
+
+
+terminal_width = _TerminalWidth()
+
 class BaseLogger(object, metaclass=abc.ABCMeta):
 
   DEBUG = DEBUG
@@ -100,37 +169,51 @@ class DefaultLogger(BaseLogger):
     self._indent = 0
     self._progress = None
     self._line_alive = False
-    self._last_module_name = None
+    self._last_location = None
+    self._module = None
+    self._module_frame = None
 
   def log(self, level, *objects, sep=' ', end='\n', indent=0):
-    from craftr.core.session import session
-    module = session.module if session else None
     if level < self._level:
       return
-    width = tty.terminal_size()[0] - 1
+    module = get_current_module()
     if self._progress:
       tty.clear_line()
     lines = sep.join(map(str, objects)).split('\n')
     prefix = '' if self._line_alive else self._indent_seq * (self._indent + indent)
     prefix += tty.compile(self.level_colors[level])
 
-    if module:
-      name = '(' + module.manifest.name + ':{})'.format(module.current_line)
-    if lines and module and name != self._last_module_name:
-      self._last_module_name = name
+    # The module name and line is only displayed when one of them changes,
+    # so the terminal width is only needed in that case. The stack is only
+    # searched for the frame of the module when the module changes.
+    location = None
+    if lines and module:
+      if module is not self._module or self._module_frame is None:
+        self._module = module
+        self._module_frame = get_module_frame(module)
+      frame = self._module_frame
+      location = (module.manifest.name, frame.f_lineno if frame else None)
+    elif not module:
+      self._module = self._module_frame = None
+    if location and location != self._last_location:
+      self._last_location = location
+      name = '({}:{})'.format(*location)
+      width = terminal_width.get() - 1
       rem = width - len(name) - len(self._indent_seq) * (self._indent + indent)
       if len(lines[0]) < rem - 1:
-        print(prefix + lines[0] + ' ' * (rem - 1 - len(lines[0])), name + tty.reset)
+        print(prefix + lines[0] + ' ' * (rem - 1 - len(lines[0])), name + tty.reset,
+            file=self._stream)
         lines.pop(0)
       else:
-        print(' ' * rem + name)
+        print(' ' * rem + name, file=self._stream)
 
     for line in lines:
       print(prefix + line + tty.reset, end=end, file=self._stream)
     self._line_alive = ('\n' not in end)
     if self._progress and 'progress' in self._progress:
       self.progress_update(self._progress['progress'], self._progress['info_text'], _force=True)
-    self._stream.flush()
+    elif level >= ERROR:
+      self._stream.flush()
 
   def add_indent(self, levels):
     self._indent += levels
@@ -175,6 +258,57 @@ class DefaultLogger(BaseLogger):
     self._stream.flush()
 
 
+class JsonLinesLogger(BaseLogger):
+  """
+  Writes every message as a JSON object on a single line to *stream*,
+  without any terminal formatting. Every record contains the ``timestamp``,
+  ``level``, ``message``, ``indent`` and, if a module is currently being
+  executed, the ``module`` name and ``line``. Progress information is
+  discarded.
+  """
+
+  def __init__(self, stream, level=INFO):
+    self._stream = stream
+    self._level = level
+    self._indent = 0
+
+  def log(self, level, *objects, sep=' ', end='\n', indent=0):
+    if level < self._level:
+      return
+    record = {
+      'timestamp': time.time(),
+      'level': LEVEL_NAMES[level],
+      'message': sep.join(map(str, objects)),
+      'indent': self._indent + indent,
+    }
+    module = get_current_module()
+    if module:
+      record['module'] = module.manifest.name
+      record['line'] = get_module_line(module)
+    self._stream.write(json.dumps(record) + '\n')
+    if level >= ERROR:
+      self._stream.flush()
+
+  def add_indent(self, levels):
+    self._indent += levels
+
+  def progress_begin(self, description=None, spinning=False):
+    if description:
+      self.info(description)
+
+  def progress_update(self, progress, info_text=''):
+    pass
+
+  def progress_end(self):
+    pass
+
+  def set_level(self, level):
+    self._level = level
+
+  def flush(self):
+    self._stream.flush()
+
+
 _logger = DefaultLogger()
 logger = werkzeug.LocalProxy(lambda: _logger)
 
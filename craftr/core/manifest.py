@@ -41,6 +41,7 @@ Example manifest:
   }
 """
 
+from craftr.core import trace
 from craftr.core.logging import logger
 from craftr.utils import httputils
 from craftr.utils import path
@@ -239,6 +240,8 @@ class Manifest(recordclass):
     return data
 
   @staticmethod
+  @trace.traced('Manifest.parse', 'io', lambda filename, *args, **kwargs:
+      {'filename': filename})
   def parse(filename, format=None):
     """
     Parses a manifest file and returns a new :class:`Manifest` object. If no
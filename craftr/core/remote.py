@@ -0,0 +1,640 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.remote`
+=========================
+
+Distributes the execution of :attr:`cacheable<craftr.core.build.Target.cacheable>`
+targets to a pool of ``craftr worker`` processes. When the
+``craftr.remote.workers`` option is set, the commands of these targets are
+wrapped in the launcher implemented by this module, which is invoked by
+Ninja as ``python -m craftr.core.remote [options] -- <command>``.
+
+The launcher determines the files that the command reads (the inputs,
+implicit dependencies and, for GCC-style compiler invocations, the headers
+reported by a local ``-M`` scan), uploads those that the worker does not
+already have in its content-addressed blob store and then asks the worker to
+execute the command in a sandbox. Files below one of the *root* directories
+(usually the project and the build directory) are transferred; all other
+paths, eg. the compiler and the system headers, must be available on the
+worker at the same location.
+
+If no worker is reachable or all of them are busy, the command is executed
+locally. The Ninja pool of the remote targets is as deep as the capacity of
+all workers, thus the launchers share one lock file per local CPU (see
+:class:`LocalSlot`) and wait for a free slot or worker instead of starting
+that many commands on the local machine.
+
+Workers and clients share a secret, the ``craftr.remote.secret`` option or
+the ``CRAFTR_WORKER_SECRET`` environment variable. Every request carries an
+HMAC of its header and payload that is signed with the secret, the worker
+rejects requests with a missing or invalid signature. Files that would be
+written outside of the sandbox of a command are rejected as well.
+
+The wire protocol consists of frames with a JSON header and a binary
+payload, each prefixed with their length as 32-bit unsigned integers.
+"""
+
+from craftr.core.actioncache import PathMap, parse_depfile
+from craftr.utils import path
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+#: The name of the file in the build directory that lists the workers
+#: that were available during the export.
+CONFIG_FILENAME = '.craftr-remote.json'
+
+#: The environment variable that contains the shared secret if the
+#: ``craftr.remote.secret`` option is not set.
+SECRET_ENV = 'CRAFTR_WORKER_SECRET'
+
+#: The number of seconds that a launcher waits before it asks the workers
+#: again when all workers are busy and no local slot is free.
+RETRY_INTERVAL = 0.2
+
+#: Matches the program name of compilers that support the ``-M`` flag.
+GCC_STYLE_PROGRAMS = re.compile(r'^(.*-)?(gcc|g\+\+|cc|c\+\+|clang|clang\+\+)(-[\d\.]+)?$')
+
+
+class ProtocolError(Exception):
+  pass
+
+
+def get_secret(options):
+  """
+  Returns the shared secret of the workers from the ``craftr.remote.secret``
+  option in the *options* dictionary or the :data:`SECRET_ENV` environment
+  variable, or :const:`None` if neither is set.
+  """
+
+  return options.get('craftr.remote.secret') or os.getenv(SECRET_ENV) or None
+
+
+def sign(secret, header, payload):
+  """
+  Returns the HMAC of a message with the specified *header* and *payload*.
+  An ``auth`` key in the *header* is ignored.
+  """
+
+  data = json.dumps({k: v for k, v in header.items() if k != 'auth'},
+      sort_keys=True).encode('utf8')
+  mac = hmac.new(secret.encode('utf8'), digestmod=hashlib.sha256)
+  mac.update(struct.pack('>I', len(data)) + data + payload)
+  return mac.hexdigest()
+
+
+def send_message(sock, header, payload=b'', secret=None):
+  if secret is not None:
+    header = dict(header, auth=sign(secret, header, payload))
+  data = json.dumps(header).encode('utf8')
+  sock.sendall(struct.pack('>II', len(data), len(payload)) + data + payload)
+
+
+def recv_exactly(fp, size):
+  data = fp.read(size)
+  if len(data) != size:
+    raise ProtocolError('connection closed unexpectedly')
+  return data
+
+
+def recv_message(fp):
+  """
+  Reads a message from the file-like object *fp*. Returns a tuple of the
+  header and the payload, or :const:`None` if the connection was closed.
+  """
+
+  data = fp.read(8)
+  if not data:
+    return None
+  if len(data) != 8:
+    raise ProtocolError('connection closed unexpectedly')
+  header_size, payload_size = struct.unpack('>II', data)
+  header = json.loads(recv_exactly(fp, header_size).decode('utf8'))
+  return header, recv_exactly(fp, payload_size)
+
+
+def parse_address(address, default_port=7311):
+  host, sep, port = address.rpartition(':')
+  if not sep:
+    return address, default_port
+  return host, int(port)
+
+
+def hash_bytes(data):
+  return hashlib.sha1(data).hexdigest()
+
+
+class Worker(socketserver.ThreadingTCPServer):
+  """
+  A TCP server that executes commands on behalf of the launcher. Blobs
+  uploaded by clients are stored in *directory* and kept across
+  connections. At most *jobs* commands are executed at the same time; if
+  a client requests the execution of another command, it is told that the
+  worker is busy. Only requests signed with the *secret* are accepted.
+
+  .. attribute:: stats
+
+    A dictionary that counts the ``uploads`` and ``executed`` commands.
+  """
+
+  allow_reuse_address = True
+  daemon_threads = True
+
+  def __init__(self, address, directory, jobs, secret):
+    if not secret:
+      raise ValueError('the worker requires a secret')
+    super().__init__(address, WorkerRequestHandler)
+    self.directory = directory
+    self.jobs = jobs
+    self.secret = secret
+    self.semaphore = threading.BoundedSemaphore(jobs)
+    self.stats = {'uploads': 0, 'executed': 0}
+    path.makedirs(path.join(directory, 'blobs'))
+    path.makedirs(path.join(directory, 'sandbox'))
+
+  def blob_path(self, digest):
+    if not re.match('^[0-9a-f]{40}$', digest):
+      raise ProtocolError('invalid digest: {!r}'.format(digest))
+    return path.join(self.directory, 'blobs', digest)
+
+  def check_auth(self, header, payload):
+    """
+    :raise ProtocolError: If the message is not signed with the secret.
+    """
+
+    auth = header.get('auth')
+    if not isinstance(auth, str) or not hmac.compare_digest(
+        auth, sign(self.secret, header, payload)):
+      raise ProtocolError('authentication failed')
+
+  def execute(self, header):
+    """
+    Executes the command described by the *header* of an ``execute``
+    message in a new sandbox and returns the response header and payload.
+    """
+
+    sandbox = tempfile.mkdtemp(dir=path.join(self.directory, 'sandbox'))
+    try:
+      roots = [path.join(sandbox, 'r{}'.format(i)) for i in range(header['roots'])]
+      pathmap = PathMap([(root, '@ROOT{}@'.format(i)) for i, root in enumerate(roots)])
+      def denormalize(filename):
+        return check_sandboxed(sandbox, pathmap.denormalize(filename))
+      for filename, digest in header['files'].items():
+        dest = denormalize(filename)
+        path.makedirs(path.dirname(dest))
+        try:
+          os.link(self.blob_path(digest), dest)
+        except OSError:
+          shutil.copyfile(self.blob_path(digest), dest)
+      outputs = [denormalize(x) for x in header['outputs']]
+      for filename in outputs:
+        path.makedirs(path.dirname(filename))
+      cwd = denormalize(header['cwd']) if header.get('cwd') else sandbox
+      path.makedirs(cwd)
+      depfile = header.get('depfile')
+      depfile = denormalize(depfile) if depfile else None
+
+      command = [pathmap.denormalize(x) for x in header['command']]
+      process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE,
+          stderr=subprocess.PIPE)
+      stdout, stderr = process.communicate()
+      self.stats['executed'] += 1
+
+      response = {
+        'status': 'done',
+        'returncode': process.returncode,
+        'stdout': pathmap.normalize(stdout.decode('utf8', 'replace')),
+        'stderr': pathmap.normalize(stderr.decode('utf8', 'replace')),
+        'outputs': [],
+        'depfile': None,
+      }
+      payload = []
+      if process.returncode == 0:
+        for filename in outputs:
+          with open(filename, 'rb') as fp:
+            payload.append(fp.read())
+          response['outputs'].append(len(payload[-1]))
+        if depfile and path.isfile(depfile):
+          with open(depfile) as fp:
+            response['depfile'] = pathmap.normalize(fp.read())
+      return response, b''.join(payload)
+    finally:
+      path.remove(sandbox, recursive=True, silent=True)
+
+
+def check_sandboxed(sandbox, filename):
+  """
+  Returns *filename* if it is located inside the *sandbox* directory after
+  resolving symbolic links and ``..`` components.
+
+  :raise ProtocolError: If *filename* is outside of the *sandbox*.
+  """
+
+  real = os.path.realpath(filename)
+  if not real.startswith(os.path.realpath(sandbox) + os.sep):
+    raise ProtocolError('path outside of the sandbox: {!r}'.format(filename))
+  return filename
+
+
+class WorkerRequestHandler(socketserver.StreamRequestHandler):
+
+  def handle(self):
+    server = self.server
+    while True:
+      try:
+        message = recv_message(self.rfile)
+      except (ProtocolError, OSError, ValueError):
+        return
+      if message is None:
+        return
+      header, payload = message
+      try:
+        server.check_auth(header, payload)
+        self.handle_message(server, header, payload)
+      except (ProtocolError, OSError) as exc:
+        send_message(self.request, {'status': 'error', 'message': str(exc)})
+        return
+
+  def handle_message(self, server, header, payload):
+    op = header.get('op')
+    if op == 'info':
+      send_message(self.request, {'status': 'ok', 'jobs': server.jobs})
+    elif op == 'has':
+      missing = [x for x in header['digests'] if not path.isfile(server.blob_path(x))]
+      send_message(self.request, {'status': 'ok', 'missing': missing})
+    elif op == 'put':
+      digest = header['digest']
+      if hash_bytes(payload) != digest:
+        raise ProtocolError('blob digest mismatch')
+      filename = server.blob_path(digest)
+      tempname = '{}.{}.tmp'.format(filename, threading.get_ident())
+      with open(tempname, 'wb') as fp:
+        fp.write(payload)
+      os.replace(tempname, filename)
+      server.stats['uploads'] += 1
+      send_message(self.request, {'status': 'ok'})
+    elif op == 'execute':
+      if not server.semaphore.acquire(blocking=False):
+        send_message(self.request, {'status': 'busy'})
+        return
+      try:
+        response, payload = server.execute(header)
+      finally:
+        server.semaphore.release()
+      send_message(self.request, response, payload)
+    else:
+      raise ProtocolError('unknown operation: {!r}'.format(op))
+
+
+def query_workers(addresses, secret, timeout=2.0):
+  """
+  Connects to every worker in the list of *addresses* and returns a list
+  of dictionaries with the ``address`` and number of ``jobs`` of the
+  workers that responded and accepted the *secret*.
+  """
+
+  result = []
+  for address in addresses:
+    try:
+      with socket.create_connection(parse_address(address), timeout) as sock:
+        send_message(sock, {'op': 'info'}, secret=secret)
+        header, __ = recv_message(sock.makefile('rb'))
+    except (OSError, ProtocolError, TypeError, ValueError):
+      continue
+    if header.get('status') != 'ok':
+      continue
+    result.append({'address': address, 'jobs': header['jobs']})
+  return result
+
+
+class RemoteLauncher(object):
+  """
+  Wraps the commands of cacheable targets during the export so that they
+  are executed by the launcher of this module. An instance of this class
+  is added to the :attr:`ExportContext.launchers<craftr.core.build.ExportContext.launchers>`
+  and must come before an :class:`~craftr.core.actioncache.ActionCacheLauncher`
+  so that cache hits do not hit the network.
+
+  :param workers: A list of worker dictionaries as returned by
+    :func:`query_workers`.
+  :param roots: A list of directories whose files are transferred to the
+    workers.
+  :param pool: The name of the Ninja pool for the remote targets.
+  :param secret: The secret shared with the workers, see :func:`get_secret`.
+    It is stored in the :data:`CONFIG_FILENAME`, which is readable only by
+    the current user.
+  """
+
+  variable = 'Craftr_remote'
+
+  def __init__(self, workers, roots, pool_name='remote', secret=None):
+    self.workers = workers
+    self.roots = roots
+    self.pool_name = pool_name
+    self.secret = secret
+
+  @property
+  def depth(self):
+    return sum(x['jobs'] for x in self.workers)
+
+  def export_vars(self, graph):
+    from craftr.utils import shell
+    path.remove(CONFIG_FILENAME, silent=True)
+    fd = os.open(CONFIG_FILENAME, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, 'w') as fp:
+      json.dump({'workers': self.workers, 'secret': self.secret}, fp)
+    command = [sys.executable, '-m', __name__, '--config', path.abs(CONFIG_FILENAME)]
+    for root in self.roots:
+      command += ['--root', root]
+    graph.vars[self.variable] = shell.join(command)
+    # The local machine would otherwise limit the remote targets to the
+    # number of local CPUs. The pool already exists if the same graph is
+    # exported again by the daemon.
+    if self.pool_name in graph.pools:
+      graph.pools[self.pool_name] = self.depth
+    else:
+      graph.add_pool(self.pool_name, self.depth)
+
+  def is_eligible(self, target):
+    return target.cacheable and bool(target.outputs) and target.pool != 'console'
+
+  def get_pool(self, target):
+    return self.pool_name if self.is_eligible(target) else None
+
+  def wrap(self, target, command):
+    if not self.is_eligible(target):
+      return command
+    from craftr.utils import shell
+    result = [shell.safe('$' + self.variable)]
+    if target.depfile:
+      result += ['--depfile', target.depfile]
+    for filename in target.implicit_deps:
+      if path.isabs(filename):
+        result += ['--implicit', filename]
+    result += ['--inputs', '$in', '--outputs', '$out', '--']
+    return result + command
+
+
+def scan_headers(command):
+  """
+  Runs the GCC-style compiler *command* with ``-M`` instead of compiling
+  and returns the list of files that it reads, or :const:`None` if the
+  command is not a GCC-style compiler invocation or the scan failed.
+  """
+
+  if '-c' not in command or not GCC_STYLE_PROGRAMS.match(path.basename(command[0])):
+    return None
+  scan = []
+  skip = False
+  for arg in command:
+    if skip:
+      skip = False
+    elif arg in ('-o', '-MF', '-MT', '-MQ'):
+      skip = True
+    elif arg not in ('-c', '-MD', '-MMD', '-MP'):
+      scan.append(arg)
+  scan.append('-M')
+  process = subprocess.Popen(scan, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+  stdout = process.communicate()[0]
+  if process.returncode != 0:
+    return None
+  return parse_depfile(stdout.decode('utf8', 'replace'))
+
+
+class RemoteUnavailable(Exception):
+  pass
+
+
+def execute_remote(workers, args, secret):
+  """
+  Executes the command described by the launcher *args* on one of the
+  *workers*, signing the requests with *secret*. Workers are tried in
+  random order.
+
+  :raise RemoteUnavailable: If no worker accepted the command.
+  """
+
+  pathmap = PathMap([(root, '@ROOT{}@'.format(i)) for i, root in enumerate(args.root)])
+  def is_transferred(filename):
+    return any(filename.startswith(root + os.sep) for root in args.root)
+
+  headers = scan_headers(args.command)
+  files = set(path.norm(x) for x in args.inputs + args.implicit + (headers or []))
+  blobs = {}
+  for filename in sorted(files):
+    if is_transferred(filename) and path.isfile(filename):
+      with open(filename, 'rb') as fp:
+        data = fp.read()
+      blobs[pathmap.normalize(filename)] = (hash_bytes(data), data)
+
+  cwd = path.getcwd()
+  request = {
+    'op': 'execute',
+    'roots': len(args.root),
+    'command': [pathmap.normalize(x) for x in args.command],
+    'files': {k: v[0] for k, v in blobs.items()},
+    'outputs': [pathmap.normalize(path.abs(x)) for x in args.outputs],
+    'depfile': pathmap.normalize(path.abs(args.depfile)) if args.depfile else None,
+    'cwd': pathmap.normalize(cwd) if is_transferred(cwd + os.sep) else None,
+  }
+
+  workers = list(workers)
+  random.shuffle(workers)
+  for worker in workers:
+    try:
+      with socket.create_connection(parse_address(worker['address'])) as sock:
+        fp = sock.makefile('rb')
+        digests = sorted(set(x[0] for x in blobs.values()))
+        send_message(sock, {'op': 'has', 'digests': digests}, secret=secret)
+        missing = set(recv_message(fp)[0]['missing'])
+        for digest, data in blobs.values():
+          if digest in missing:
+            send_message(sock, {'op': 'put', 'digest': digest}, data, secret)
+            if recv_message(fp)[0]['status'] != 'ok':
+              raise ProtocolError('upload failed')
+            missing.discard(digest)
+        send_message(sock, request, secret=secret)
+        response, payload = recv_message(fp)
+    except (OSError, ProtocolError, TypeError, ValueError, KeyError):
+      continue
+    if response['status'] == 'done':
+      return response, payload, headers is not None
+  raise RemoteUnavailable
+
+
+class LocalSlot(object):
+  """
+  One of a fixed number of lock files that limit the commands that the
+  launchers execute locally at the same time. Use :meth:`acquire` to get a
+  slot, the lock is released when the slot is closed or the process exits.
+  """
+
+  def __init__(self, fp):
+    self.fp = fp
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    self.fp.close()
+
+  @classmethod
+  def acquire(cls, prefix, count=None):
+    """
+    Locks the first free of *count* lock files that are named by *prefix*
+    and an index and returns a :class:`LocalSlot`, or returns
+    :const:`None` if all of them are locked. *count* defaults to the
+    number of CPUs.
+    """
+
+    for index in range(count or os.cpu_count() or 1):
+      fp = open('{}.local{}'.format(prefix, index), 'a+b')
+      try:
+        if os.name == 'nt':
+          import msvcrt
+          fp.seek(0)
+          msvcrt.locking(fp.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+          import fcntl
+          fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except OSError:
+        fp.close()
+        continue
+      return cls(fp)
+    return None
+
+
+def call_locally(args, workers=(), secret=None):
+  """
+  Executes the command of the parsed launcher *args* locally as soon as a
+  :class:`LocalSlot` is free. If *workers* are specified, they are asked
+  again while the launcher waits for a slot. Returns a tuple of the exit
+  code of the local command (or :const:`None`) and the result of
+  :func:`execute_remote` (or :const:`None`).
+  """
+
+  while True:
+    slot = LocalSlot.acquire(args.config)
+    if slot is not None:
+      with slot:
+        return subprocess.call(args.command), None
+    time.sleep(RETRY_INTERVAL)
+    if workers and secret:
+      try:
+        return None, execute_remote(workers, args, secret)
+      except RemoteUnavailable:
+        pass
+
+
+def execute(args):
+  """
+  Executes the action described by the parsed launcher *args* remotely or,
+  as a fallback, locally. Returns the exit code of the command.
+  """
+
+  try:
+    with open(args.config) as fp:
+      config = json.load(fp)
+    workers, secret = config['workers'], config.get('secret')
+  except (OSError, ValueError, KeyError):
+    workers, secret = [], None
+
+  try:
+    if not secret:
+      raise RemoteUnavailable
+    result = execute_remote(workers, args, secret)
+  except RemoteUnavailable:
+    returncode, result = call_locally(args, workers, secret)
+    if result is None:
+      return returncode
+  response, payload, scanned = result
+
+  # If we could not determine the headers of the command, it might have
+  # failed only because of a file that was not transferred.
+  if response['returncode'] != 0 and not scanned:
+    return call_locally(args)[0]
+
+  pathmap = PathMap([(root, '@ROOT{}@'.format(i)) for i, root in enumerate(args.root)])
+  sys.stdout.write(pathmap.denormalize(response['stdout']))
+  sys.stderr.write(pathmap.denormalize(response['stderr']))
+  if response['returncode'] != 0:
+    return response['returncode']
+
+  offset = 0
+  for filename, size in zip(args.outputs, response['outputs']):
+    path.makedirs(path.dirname(path.abs(filename)))
+    path.remove(filename, silent=True)
+    with open(filename, 'wb') as fp:
+      fp.write(payload[offset:offset + size])
+    offset += size
+  if args.depfile and response['depfile'] is not None:
+    with open(args.depfile, 'w') as fp:
+      fp.write(pathmap.denormalize(response['depfile']))
+  return 0
+
+
+def serve(address, directory, jobs, secret):
+  """
+  Runs a :class:`Worker` on the specified *address* until interrupted.
+  """
+
+  worker = Worker(address, directory, jobs, secret)
+  try:
+    worker.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    worker.server_close()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='python -m craftr.core.remote')
+  parser.add_argument('--config', required=True)
+  parser.add_argument('--root', action='append', default=[])
+  parser.add_argument('--depfile')
+  parser.add_argument('--implicit', action='append', default=[])
+  parser.add_argument('--inputs', nargs='*', default=[])
+  parser.add_argument('--outputs', nargs='*', default=[])
+  parser.add_argument('command', nargs=argparse.REMAINDER)
+  args = parser.parse_args(argv)
+  if args.command and args.command[0] == '--':
+    args.command.pop(0)
+  if not args.command:
+    parser.error('missing command')
+  args.root = [path.norm(x) for x in args.root]
+  return execute(args)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,103 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.resources`
+============================
+
+Information about the resources of the machine that is used to compute the
+depth of the default Ninja pools.
+"""
+
+import os
+
+#: The Ninja pools that are used by the Craftr standard library. Maps the
+#: name of the pool to the amount of memory that is expected to be used by
+#: a single job in the pool and the fraction of the CPUs it may use.
+DEFAULT_POOLS = {
+  'link': {'memory': 2 * 1024 ** 3, 'cpu_fraction': 1.0},
+  'heavy': {'memory': 1024 ** 3, 'cpu_fraction': 0.5},
+}
+
+
+def cpu_count():
+  """
+  Returns the number of CPUs that the current process may run on.
+  """
+
+  try:
+    return len(os.sched_getaffinity(0)) or 1
+  except (AttributeError, OSError):
+    return os.cpu_count() or 1
+
+
+def meminfo(filename='/proc/meminfo'):
+  """
+  Parses */proc/meminfo* and returns a dictionary that maps the field names
+  to their values in bytes. Returns an empty dictionary if the file does
+  not exist, eg. on systems other than Linux.
+  """
+
+  result = {}
+  try:
+    with open(filename) as fp:
+      for line in fp:
+        key, sep, value = line.partition(':')
+        parts = value.split()
+        if not sep or not parts or not parts[0].isdigit():
+          continue
+        factor = 1024 if parts[1:] == ['kB'] else 1
+        result[key.strip()] = int(parts[0]) * factor
+  except OSError:
+    pass
+  return result
+
+
+def pool_depth(memory, cpu_fraction):
+  """
+  Computes the depth of a pool of which every job is expected to use
+  *memory* bytes and that may use the *cpu_fraction* of the CPUs. The
+  depth is at least 1.
+  """
+
+  depth = int(cpu_count() * cpu_fraction)
+  total = meminfo().get('MemTotal')
+  if total:
+    depth = min(depth, total // memory)
+  return max(1, depth)
+
+
+def declare_pools(graph, options):
+  """
+  Declares the :data:`DEFAULT_POOLS` in the *graph* unless they have already
+  been declared and applies the ``craftr.pool.<name>`` overrides from the
+  *options* to all pools in the graph.
+
+  :raise ValueError: If an override is not a positive integer.
+  """
+
+  for name, params in DEFAULT_POOLS.items():
+    if name not in graph.pools:
+      graph.add_pool(name, pool_depth(**params))
+  for key, value in options.items():
+    if key.startswith('craftr.pool.'):
+      name = key[len('craftr.pool.'):]
+      try:
+        depth = int(value)
+      except ValueError:
+        depth = 0
+      if depth < 1:
+        raise ValueError('invalid depth for pool {!r}: {!r}'.format(name, value))
+      graph.pools[name] = depth
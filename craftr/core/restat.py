@@ -0,0 +1,98 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.restat`
+=========================
+
+Ninja re-checks the modification time of the outputs of a rule with
+``restat = 1`` after its command finished and does not rebuild dependent
+targets if it did not change. This only works if the command does not
+touch outputs whose content stays the same, which most code generators
+(eg. ``moc``, ``uic`` and ``cython``) do not care about.
+
+This module implements a wrapper that is invoked by Ninja as
+``python -m craftr.core.restat <outputs> -- <command>``. It runs the
+command and restores the modification time of every output that has the
+same content as before. :meth:`Target.export()<craftr.core.build.Target.export>`
+wraps the commands of all targets that are created with ``restat=True``,
+except for tasks which are expected to write their outputs with
+:func:`path.write_if_changed()<craftr.utils.path.write_if_changed>`.
+"""
+
+import hashlib
+import os
+import subprocess
+import sys
+
+
+def wrap(command):
+  """
+  Returns *command* prefixed with the wrapper. The command must produce the
+  files that are referenced by ``$out``.
+  """
+
+  return [sys.executable, '-m', 'craftr.core.restat', '$out', '--'] + command
+
+
+def snapshot(filename):
+  """
+  Returns a tuple of the SHA1 and the :class:`os.stat_result` of *filename*
+  or :const:`None` if the file does not exist.
+  """
+
+  try:
+    with open(filename, 'rb') as fp:
+      return hashlib.sha1(fp.read()).digest(), os.fstat(fp.fileno())
+  except (FileNotFoundError, IsADirectoryError):
+    return None
+
+
+def execute(outputs, command):
+  """
+  Runs *command* and restores the modification time of the *outputs* that
+  the command rewrote with the same content. Returns the exit code of the
+  command.
+  """
+
+  before = {x: snapshot(x) for x in outputs}
+  returncode = subprocess.call(command)
+  if returncode != 0:
+    return returncode
+  for filename, old in before.items():
+    if old is None:
+      continue
+    new = snapshot(filename)
+    if new is not None and new[0] == old[0] and new[1].st_mtime_ns != old[1].st_mtime_ns:
+      os.utime(filename, ns=(new[1].st_atime_ns, old[1].st_mtime_ns))
+  return 0
+
+
+def main(argv=None):
+  if argv is None:
+    argv = sys.argv[1:]
+  if '--' not in argv:
+    print('usage: python -m craftr.core.restat <outputs> -- <command>',
+        file=sys.stderr)
+    return 2
+  index = argv.index('--')
+  if index == len(argv) - 1:
+    print('error: missing command', file=sys.stderr)
+    return 2
+  return execute(argv[:index], argv[index+1:])
+
+
+if __name__ == '__main__':
+  sys.exit(main())
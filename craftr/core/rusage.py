@@ -0,0 +1,258 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.rusage`
+=========================
+
+Memory-aware scheduling based on the recorded resource usage of targets.
+When the ``craftr.rusage`` option is enabled, the command of every target
+is wrapped in the launcher implemented by this module, which is invoked by
+Ninja as ``python -m craftr.core.rusage --database <db> --target <name> --
+<command>``. It records the peak RSS, the CPU and the wall time of the
+command in a SQLite database in the build directory.
+
+On the next export, the targets whose peak RSS in one of their recent runs
+reached the ``craftr.rusage.threshold`` (``1G`` by default) are assigned to
+the ``mem_heavy`` pool. Its depth is the memory budget divided by the
+highest recorded peak of these targets, which limits the memory that the
+heavy jobs use together while the other jobs are scheduled as usual. The
+budget defaults to the total memory of the machine and can be set with the
+``craftr.rusage.max_mem`` option or ``craftr build --max-mem``.
+
+The pool is declared in a file that is included into the manifest. Ninja
+reads it on every invocation, thus the budget can be changed without
+exporting the project again.
+
+The peak RSS is measured with :func:`os.wait4`, which is not available on
+Windows.
+"""
+
+from craftr.core import resources
+from craftr.utils import path
+
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+#: The name of the SQLite database in the build directory.
+DATABASE_FILENAME = '.craftr-rusage.db'
+
+#: The name of the file that declares the :data:`POOL_NAME` pool.
+POOL_FILENAME = '.craftr-pools.ninja'
+
+POOL_NAME = 'mem_heavy'
+
+#: The number of recent runs of a target that are taken into account.
+HISTORY = 5
+
+SCHEMA = '''
+  CREATE TABLE IF NOT EXISTS runs (
+    target TEXT,
+    timestamp REAL,
+    maxrss INTEGER,
+    cpu_ms INTEGER,
+    wall_ms INTEGER,
+    returncode INTEGER
+  );
+  CREATE INDEX IF NOT EXISTS runs_target ON runs(target, timestamp);
+'''
+
+
+def is_available():
+  return hasattr(os, 'wait4')
+
+
+def is_enabled(options):
+  """
+  Returns :const:`True` if the ``craftr.rusage`` option is enabled in the
+  *options* dictionary.
+  """
+
+  from craftr.core.manifest import BoolOption
+  return BoolOption('craftr.rusage')(options.get('craftr.rusage', ''))
+
+
+def open_database(filename):
+  db = sqlite3.connect(filename, timeout=60)
+  db.executescript(SCHEMA)
+  return db
+
+
+def get_peaks(filename, history=HISTORY):
+  """
+  Returns a dictionary that maps the names of the targets recorded in the
+  database *filename* to the highest peak RSS in bytes of their *history*
+  most recent runs. Older runs are deleted.
+  """
+
+  if not path.isfile(filename):
+    return {}
+  db = open_database(filename)
+  try:
+    with db:
+      db.execute('''
+        DELETE FROM runs WHERE rowid NOT IN (
+          SELECT r.rowid FROM runs r WHERE r.target = runs.target
+          ORDER BY r.timestamp DESC LIMIT ?)''', (history,))
+    return dict(db.execute('SELECT target, MAX(maxrss) FROM runs GROUP BY target'))
+  finally:
+    db.close()
+
+
+def get_memory_budget(max_mem=None):
+  """
+  Returns *max_mem* or the total memory of the machine. Returns
+  :const:`None` if neither is known.
+  """
+
+  return max_mem or resources.meminfo().get('MemTotal')
+
+
+def heavy_pool_depth(peaks, budget):
+  """
+  Returns the depth of the :data:`POOL_NAME` pool for the *peaks* of the
+  targets in it and the memory *budget*. The depth is at least 1.
+  """
+
+  if not peaks or not budget:
+    return resources.cpu_count()
+  return max(1, min(resources.cpu_count(), budget // max(peaks.values())))
+
+
+def write_pool_file(builddir, peaks, budget):
+  """
+  Writes the :data:`POOL_FILENAME` to *builddir* for the *peaks* of the
+  heavy targets and the memory *budget*. Returns the depth of the pool.
+  """
+
+  depth = heavy_pool_depth(peaks, budget)
+  path.write_if_changed(path.join(builddir, POOL_FILENAME),
+      'pool {}\n  depth = {}\n'.format(POOL_NAME, depth))
+  return depth
+
+
+def update_pool_file(builddir, threshold, budget):
+  """
+  Recomputes the depth of the pool from the recorded runs, used by
+  ``craftr build --max-mem``. Returns the depth.
+  """
+
+  peaks = get_peaks(path.join(builddir, DATABASE_FILENAME))
+  heavy = {k: v for k, v in peaks.items() if v >= threshold}
+  return write_pool_file(builddir, heavy, budget)
+
+
+class ResourceLauncher(object):
+  """
+  Records the resource usage of the commands of all targets except for
+  those in the ``console`` pool and assigns the targets that used at least
+  *threshold* bytes of memory to the :data:`POOL_NAME` pool. An instance of
+  this class is added to the
+  :attr:`ExportContext.launchers<craftr.core.build.ExportContext.launchers>`.
+
+  :param builddir: The absolute path to the build directory.
+  :param threshold: The peak RSS in bytes from which on a target is
+    assigned to the :data:`POOL_NAME` pool.
+  :param budget: The memory in bytes that the jobs in the pool may use
+    together, see :func:`get_memory_budget`.
+  """
+
+  variable = 'Craftr_rusage'
+
+  def __init__(self, builddir, threshold, budget=None):
+    self.builddir = builddir
+    self.database = path.join(builddir, DATABASE_FILENAME)
+    self.budget = budget
+    peaks = get_peaks(self.database)
+    self.heavy = {k: v for k, v in peaks.items() if v >= threshold}
+
+  def export_vars(self, graph):
+    from craftr.utils import shell
+    write_pool_file(self.builddir, self.heavy, self.budget)
+    graph.vars[self.variable] = shell.join([sys.executable, '-m', __name__,
+        '--database', self.database])
+    pool_file = path.join(self.builddir, POOL_FILENAME)
+    if pool_file not in graph.includes:
+      graph.includes.append(pool_file)
+
+  def get_pool(self, target):
+    if target.name in self.heavy and target.pool != 'console':
+      return POOL_NAME
+    return None
+
+  def wrap(self, target, command):
+    if target.pool == 'console':
+      return command
+    from craftr.utils import shell
+    return [shell.safe('$' + self.variable), '--target', target.name, '--'] + command
+
+
+def execute(database, target, command):
+  """
+  Runs *command*, records its resource usage for *target* in the
+  *database* and returns its exit code.
+  """
+
+  start = time.perf_counter()
+  try:
+    process = subprocess.Popen(command)
+  except OSError as exc:
+    print('craftr.core.rusage: {}: {}'.format(command[0], exc), file=sys.stderr)
+    return 127
+  status, rusage = os.wait4(process.pid, 0)[1:]
+  wall_ms = int((time.perf_counter() - start) * 1000)
+  if os.WIFSIGNALED(status):
+    process.returncode = -os.WTERMSIG(status)
+    returncode = 128 + os.WTERMSIG(status)
+  else:
+    returncode = process.returncode = os.WEXITSTATUS(status)
+
+  # ru_maxrss is in kilobytes on Linux but in bytes on Mac OS.
+  maxrss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+  cpu_ms = int((rusage.ru_utime + rusage.ru_stime) * 1000)
+  try:
+    db = open_database(database)
+    try:
+      with db:
+        db.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?)',
+            (target, time.time(), maxrss, cpu_ms, wall_ms, returncode))
+    finally:
+      db.close()
+  except sqlite3.Error as exc:
+    print('craftr.core.rusage: could not record resource usage: {}'.format(exc),
+        file=sys.stderr)
+  return returncode
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='python -m craftr.core.rusage')
+  parser.add_argument('--database', required=True)
+  parser.add_argument('--target', required=True)
+  parser.add_argument('command', nargs=argparse.REMAINDER)
+  args = parser.parse_args(argv)
+  command = args.command
+  if command and command[0] == '--':
+    command = command[1:]
+  if not command:
+    parser.error('missing command')
+  return execute(args.database, args.target, command)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
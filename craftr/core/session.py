@@ -22,7 +22,7 @@ process of Craftr modules and contains all the important root datastructures
 for the meta build process (such as a :class:`craftr.core.build.Graph`).
 """
 
-from craftr.core import build, manifest, renames
+from craftr.core import build, manifest, renames, trace
 from craftr.core.logging import logger
 from craftr.core.manifest import Manifest
 from craftr.utils import argspec, path
@@ -131,6 +131,12 @@ class Session(object):
     occur.
 
     Reserved keywords in the cache are ``"build"`` and ``"loaders"``.
+
+  .. attribute:: tool_cache
+
+    A dictionary for the results of functions that probe build tools, see
+    :func:`craftr.defaults.memoize_tool`. Other than the rest of the session
+    state, it is preserved by :meth:`reset`.
   """
 
   #: The current session object. Create it with :meth:`start` and destroy
@@ -155,6 +161,7 @@ class Session(object):
     self.options = {}
     self.cache = {}
     self.tasks = {}
+    self.tool_cache = {}
     self._tempdir = None
     self._manifest_cache = {}  # maps manifest_filename: manifest
     self._refresh_cache = True
@@ -179,6 +186,28 @@ class Session(object):
         self._tempdir = None
     Session.current = None
 
+  def reset(self, changed_files=()):
+    """
+    Resets the session to the state before the main module was executed so
+    that the project can be exported again in the same process. Manifests
+    are only re-parsed if they are listed in *changed_files*, the
+    :attr:`tool_cache` and the :attr:`options` are preserved.
+    """
+
+    if self.modulestack:
+      raise RuntimeError('can not reset while a module is executed')
+    for filename in changed_files:
+      self._manifest_cache.pop(path.norm(filename), None)
+    self.graph = build.Graph()
+    self.main_module = None
+    self.tasks = {}
+    self.modules = {}
+    for filename, manifest in self._manifest_cache.items():
+      versions = self.modules.setdefault(manifest.name, {})
+      if manifest.version not in versions:
+        versions[manifest.version] = Module(path.dirname(filename), manifest)
+    self._refresh_cache = True
+
   @property
   def module(self):
     if self.modulestack:
@@ -396,6 +425,18 @@ class Module(object):
     file that is executed for the Module. Additional files might be added
     by some built-in functions like :func:`craftr.defaults.load_file`.
 
+  .. attribute:: glob_patterns
+
+    A list of the absolute patterns that were passed to
+    :func:`craftr.defaults.glob` when the module was executed. Used by
+    ``craftr watch`` to detect files that are added or removed.
+
+  .. attribute:: target_name_counters
+
+    A dictionary that maps the name hints passed to
+    :func:`~craftr.targetbuilder.gtn` to the index of the last target name
+    that was generated for the hint.
+
   .. attribute:: dependencies
 
     A dictionary that maps a dependency name to an actual version. This
@@ -413,6 +454,8 @@ class Module(object):
     self.executed = False
     self.options = None
     self.dependent_files = None
+    self.glob_patterns = None
+    self.target_name_counters = {}
     self.dependencies = None
 
   def __repr__(self):
@@ -476,6 +519,7 @@ class Module(object):
 
     self.executed = True
     self.dependent_files = []
+    self.glob_patterns = []
     self.dependencies = {}
     self.init_options()
 
@@ -492,13 +536,15 @@ class Module(object):
     self.namespace.__file__ = script_fn
     self.namespace.__name__ = self.manifest.name
     self.namespace.__version__ = str(self.manifest.version)
-    try:
-      session.modulestack.append(self)
-      exec(code, vars(self.namespace))
-    except ModuleReturn:
-      pass
-    finally:
-      assert session.modulestack.pop() is self
+    with trace.span('Module.run', 'module', module=self.ident) as span:
+      try:
+        session.modulestack.append(self)
+        exec(code, vars(self.namespace))
+      except ModuleReturn:
+        pass
+      finally:
+        assert session.modulestack.pop() is self
+        span.set(tracemalloc_peak=trace.memory_sample())
 
   def get_init_globals(self):
     """
@@ -0,0 +1,212 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.trace`
+========================
+
+Records a timeline of the work done by Craftr in the Chrome trace-event
+format, which can be viewed with ``chrome://tracing`` or Perfetto. Use it
+with ``craftr export --trace=out.json``.
+
+Code is instrumented with the :func:`span` context manager. As long as the
+tracer is not enabled, :func:`span` returns a shared no-op object, thus the
+overhead of the instrumentation is a single function call.
+
+::
+
+  with trace.span('glob', 'io', patterns=patterns):
+    ...
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+_tracer = None
+
+
+class _NullSpan(object):
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+  def set(self, **kwargs):
+    pass
+
+
+_null_span = _NullSpan()
+
+
+class _Span(object):
+
+  def __init__(self, tracer, name, cat, args):
+    self.tracer = tracer
+    self.name = name
+    self.cat = cat
+    self.args = args
+
+  def __enter__(self):
+    if self.tracer.line_provider:
+      line = self.tracer.line_provider()
+      if line:
+        self.args['line'] = line
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *args):
+    end = time.perf_counter()
+    self.tracer.add({
+      'name': self.name,
+      'cat': self.cat,
+      'ph': 'X',
+      'ts': self.tracer.timestamp(self.start),
+      'dur': (end - self.start) * 1e6,
+      'pid': self.tracer.pid,
+      'tid': threading.get_ident(),
+      'args': self.args,
+    })
+
+  def set(self, **kwargs):
+    """
+    Adds arguments to the span that are only known after it started.
+    """
+
+    self.args.update(kwargs)
+
+
+class Tracer(object):
+  """
+  Collects trace events. Use :func:`enable` to install a tracer.
+
+  :param line_provider: A function that returns a string that describes
+    the current location in the build script, or :const:`None`.
+  :param memory: Whether to record memory samples with :mod:`tracemalloc`.
+  """
+
+  def __init__(self, line_provider=None, memory=True):
+    self.line_provider = line_provider
+    self.memory = memory
+    self.events = []
+    self.pid = os.getpid()
+    self.start = time.perf_counter()
+    self.lock = threading.Lock()
+
+  def timestamp(self, value):
+    return (value - self.start) * 1e6
+
+  def add(self, event):
+    with self.lock:
+      self.events.append(event)
+
+  def memory_sample(self):
+    """
+    Records the peak of the memory traced by :mod:`tracemalloc` since the
+    last sample as a counter event and returns it in bytes.
+    """
+
+    if not self.memory or not tracemalloc.is_tracing():
+      return None
+    current, peak = tracemalloc.get_traced_memory()
+    if hasattr(tracemalloc, 'reset_peak'):
+      tracemalloc.reset_peak()
+    self.add({
+      'name': 'tracemalloc',
+      'ph': 'C',
+      'ts': self.timestamp(time.perf_counter()),
+      'pid': self.pid,
+      'args': {'current': current, 'peak': peak},
+    })
+    return peak
+
+  def save(self, filename):
+    with open(filename, 'w') as fp:
+      json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, fp)
+
+
+def enable(line_provider=None, memory=True):
+  """
+  Installs a new :class:`Tracer` and returns it. If *memory* is True,
+  :mod:`tracemalloc` is started as well.
+  """
+
+  global _tracer
+  _tracer = Tracer(line_provider, memory)
+  if memory and not tracemalloc.is_tracing():
+    tracemalloc.start()
+  return _tracer
+
+
+def disable():
+  """
+  Uninstalls the current tracer and returns it.
+  """
+
+  global _tracer
+  tracer, _tracer = _tracer, None
+  if tracer and tracer.memory and tracemalloc.is_tracing():
+    tracemalloc.stop()
+  return tracer
+
+
+def is_enabled():
+  return _tracer is not None
+
+
+def span(name, cat='craftr', **args):
+  """
+  Returns a context manager that records a complete event with the
+  specified *name*, category and *args* if tracing is enabled.
+  """
+
+  if _tracer is None:
+    return _null_span
+  return _Span(_tracer, name, cat, args)
+
+
+def memory_sample():
+  """
+  Records a :mod:`tracemalloc` sample if tracing is enabled. Returns the
+  peak memory since the last sample or :const:`None`.
+  """
+
+  if _tracer is None:
+    return None
+  return _tracer.memory_sample()
+
+
+def traced(name, cat='craftr', describe=None):
+  """
+  Decorator that records a span for every call of the decorated function.
+  *describe* is called with the arguments of the function and must return
+  a dictionary of arguments for the span. When tracing is disabled, the
+  only overhead is an additional function call.
+  """
+
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      if _tracer is None:
+        return func(*args, **kwargs)
+      with _Span(_tracer, name, cat, describe(*args, **kwargs) if describe else {}):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
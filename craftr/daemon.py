@@ -0,0 +1,197 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.daemon`
+====================
+
+Transport for ``craftr daemon``, a long-lived process per build directory
+that keeps the :class:`~craftr.core.session.Session` in memory. The daemon
+listens on a Unix socket in the build directory. The command-line sends
+its arguments, working directory and environment as a JSON line and
+receives the output of the command as JSON lines, the last of which
+contains the exit code::
+
+  -> {"argv": ["export"], "cwd": "/home/me/project", "environ": {...}}
+  <- {"stdout": "exported \\"build.ninja\\"\\n"}
+  <- {"exit": 0}
+
+The daemon uses :func:`take_snapshot` and :func:`changed_files` to find out
+whether the build scripts and globbed directories changed since the
+previous request.
+"""
+
+from craftr.utils import path
+
+import io
+import json
+import os
+import shutil
+import socket
+import stat
+import tempfile
+
+#: The commands that are sent to the daemon if one is running.
+COMMANDS = ('export', 'run', 'query', 'options', 'deptree')
+
+#: The filename of the socket in the build directory.
+SOCKET_NAME = '.craftr-daemon.sock'
+
+
+def get_socket_path(builddir):
+  return path.join(builddir, SOCKET_NAME)
+
+
+def take_snapshot(filenames):
+  """
+  Returns a dictionary that maps each of the *filenames* to its modification
+  time and size, or :const:`None` if it does not exist. For directories,
+  the sorted names of its entries are stored instead, so that files that
+  are replaced by renaming them do not count as a change of the directory.
+  """
+
+  result = {}
+  for filename in filenames:
+    try:
+      st = os.stat(filename)
+      if stat.S_ISDIR(st.st_mode):
+        result[filename] = tuple(sorted(os.listdir(filename)))
+      else:
+        result[filename] = (st.st_mtime_ns, st.st_size)
+    except OSError:
+      result[filename] = None
+  return result
+
+
+def changed_files(snapshot):
+  """
+  Returns a list of the files in the *snapshot* that changed since it was
+  taken.
+  """
+
+  current = take_snapshot(snapshot)
+  return [x for x in snapshot if current[x] != snapshot[x]]
+
+
+class _Stream(io.TextIOBase):
+  """
+  A text stream that sends everything that is written to it to the client.
+  """
+
+  def __init__(self, fp, name):
+    self._fp = fp
+    self._name = name
+
+  def writable(self):
+    return True
+
+  def write(self, data):
+    if data:
+      self._fp.write(json.dumps({self._name: data}) + '\n')
+    return len(data)
+
+  def flush(self):
+    self._fp.flush()
+
+
+def forward(socket_path, argv, cwd, environ, stdout, stderr):
+  """
+  Sends a command to the daemon listening on *socket_path* and writes its
+  output to *stdout* and *stderr*. Returns the exit code of the command or
+  :const:`None` if no daemon is listening on the socket.
+  """
+
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(socket_path)
+  except OSError:
+    sock.close()
+    return None
+
+  with sock, sock.makefile('rw', encoding='utf8') as fp:
+    fp.write(json.dumps({'argv': argv, 'cwd': cwd, 'environ': environ}) + '\n')
+    fp.flush()
+    for line in fp:
+      message = json.loads(line)
+      if 'stdout' in message:
+        stdout.write(message['stdout'])
+      elif 'stderr' in message:
+        stderr.write(message['stderr'])
+      elif 'exit' in message:
+        stdout.flush()
+        return message['exit']
+  stderr.write('craftr: connection to the daemon was closed unexpectedly\n')
+  return 1
+
+
+def serve(socket_path, handler):
+  """
+  Listens on *socket_path* and calls *handler* for every request, one at a
+  time, with the request dictionary and the ``stdout`` and ``stderr``
+  streams for the client. The handler must return the exit code. Serves
+  until the process is interrupted.
+
+  :raise OSError: If the socket can not be created or another daemon is
+    already listening on it.
+  """
+
+  if is_running(socket_path):
+    raise OSError('a daemon is already listening on "{}"'.format(socket_path))
+  if os.path.exists(socket_path):
+    os.remove(socket_path)
+
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    # Bind in a directory that only the current user can access and move
+    # the socket into place once its permissions are restricted.
+    tempdir = tempfile.mkdtemp(prefix='.craftr-daemon.', dir=path.dirname(socket_path))
+    try:
+      server.bind(path.join(tempdir, 'sock'))
+      os.chmod(path.join(tempdir, 'sock'), 0o600)
+      os.replace(path.join(tempdir, 'sock'), socket_path)
+    finally:
+      shutil.rmtree(tempdir, ignore_errors=True)
+    server.listen(8)
+    while True:
+      conn = server.accept()[0]
+      with conn, conn.makefile('rw', encoding='utf8') as fp:
+        try:
+          request = json.loads(fp.readline())
+        except ValueError:
+          continue
+        try:
+          returncode = handler(request, _Stream(fp, 'stdout'), _Stream(fp, 'stderr'))
+          fp.write(json.dumps({'exit': returncode}) + '\n')
+          fp.flush()
+        except (BrokenPipeError, ConnectionResetError):
+          pass  # the client went away
+  finally:
+    server.close()
+    if os.path.exists(socket_path):
+      os.remove(socket_path)
+
+
+def is_running(socket_path):
+  """
+  Returns True if a daemon is listening on *socket_path*.
+  """
+
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  with sock:
+    try:
+      sock.connect(socket_path)
+    except OSError:
+      return False
+    return True
@@ -31,6 +31,7 @@ from craftr import platform
 from nr.types.singleton import Default
 
 import builtins as _builtins
+import functools as _functools
 import itertools as _itertools
 import os as _os
 import sys as _sys
@@ -61,6 +62,12 @@ def glob(patterns, parent=None, exclude=(), include_dotfiles=False, ignore_false
   if parent is None and session and session.module:
     parent = session.module.namespace.project_dir
 
+  if session and session.module:
+    if isinstance(patterns, str):
+      patterns = [patterns]
+    session.module.glob_patterns.extend(
+        path.norm(x, parent) for x in patterns)
+
   return path.glob(patterns, parent, exclude, include_dotfiles,
     ignore_false_excludes)
 
@@ -298,7 +305,8 @@ def genalias(*targets, name = None, **kwargs):
     implicit_deps = targets, **kwargs)
 
 
-def gentask(func, args = None, inputs = (), outputs = (), name = None, explicit = True, **kwargs):
+def gentask(func, args = None, inputs = (), outputs = (), name = None, explicit = True,
+            restat = False, **kwargs):
   """
   Create a Task that can be embedded into the build chain. Tasks can have input
   and output files that cause the task to be embedded into the build chain. By
@@ -317,6 +325,10 @@ def gentask(func, args = None, inputs = (), outputs = (), name = None, explicit
   :param inputs: A list of input files.
   :param inputs: A list of output files.
   :param name: Alternative target name.
+  :param restat: If True, Ninja does not rebuild targets that depend on the
+    task if the task did not modify its outputs. Use
+    :func:`path.write_if_changed()<craftr.utils.path.write_if_changed>` to
+    write the outputs from *func*.
   :param kwargs: Additional parameters for the :class:`Task` constructor.
   :return: A :class:`Target` object.
   """
@@ -325,7 +337,8 @@ def gentask(func, args = None, inputs = (), outputs = (), name = None, explicit
     args = [inputs, outputs]
   builder = TargetBuilder(gtn(name), inputs = inputs)
   task = _build.Task(builder.name, func, args, **kwargs)
-  return session.graph.add_task(task, inputs = builder.inputs, outputs = outputs, explicit = explicit)
+  return session.graph.add_task(task, inputs = builder.inputs, outputs = outputs,
+    explicit = explicit, restat = restat)
 
 
 def task(inputs = (), outputs = (), args = None, **kwargs):
@@ -390,12 +403,35 @@ def write_response_file(arguments, builder=None, name=None, force_file=False, su
     builder.implicit_deps.append(filename)
 
   if session.builddir:
-    path.makedirs(path.dirname(filename))
-    with open(filename, 'w') as fp:
-      fp.write(content)
+    path.write_if_changed(filename, content)
   return filename, ['@' + filename]
 
 
+def memoize_tool(func):
+  """
+  Decorator for functions that probe a build tool, eg. to identify a
+  compiler. Other than :func:`functools.lru_cache`, the results are stored
+  in the :attr:`Session.tool_cache<craftr.core.session.Session.tool_cache>`
+  and are thus still available when the build script is executed again in
+  the same process, which is what ``craftr watch`` does.
+  """
+
+  key = (func.__module__, func.__qualname__)
+
+  @_functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    cache = session.tool_cache.setdefault(key, {})
+    args_key = (args, tuple(sorted(kwargs.items())))
+    try:
+      return cache[args_key]
+    except KeyError:
+      pass
+    result = cache[args_key] = func(*args, **kwargs)
+    return result
+
+  return wrapper
+
+
 def error(*message):
   """
   Raises a :class:`ModuleError` exception.
@@ -434,7 +470,8 @@ def append_PATH(*paths):
   return result
 
 
-from craftr.loaders import pkg_config, external_file, external_archive
+from craftr.loaders import pkg_config, pkg_config_async, external_file, external_archive, \
+    concurrent_downloads
 
 
 # Backwards compatibility < 2.0.0dev6
@@ -14,12 +14,27 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-__all__ = ['external_file', 'external_archive']
+__all__ = ['external_file', 'external_archive', 'concurrent_downloads',
+  'record_downloads', 'replay_downloads', 'get_archive_cache',
+  'ChecksumMismatch', 'OfflineError']
 
+from craftr.core import archivecache
 from craftr.defaults import buildlocal, gtn, logger, session, Framework, path, shell
 from craftr.utils import httputils, pyutils
 
+import concurrent.futures
+import contextlib
+import fnmatch
 import nr.misc.archive
+import os
+
+#: A stack of the :class:`_DownloadPool` objects of the active
+#: :func:`concurrent_downloads` contexts.
+_download_pools = []
+
+#: A stack of the lists of :class:`LoaderCall` objects of the active
+#: :func:`record_downloads` contexts.
+_recorders = []
 
 
 def get_loader_cache(loader_name, module=None):
@@ -70,6 +85,188 @@ def _external_file_download_callback(progress_text, directory, filename, cache,
     logger.progress_update(data['downloaded'] / data['size'], data['downloaded'])
 
 
+class _DownloadPool(object):
+  """
+  *Private*. Runs downloads and the extraction of archives in background
+  threads, see :func:`concurrent_downloads`.
+  """
+
+  def __init__(self, max_workers):
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+    self.futures = {}  # maps filename: future
+
+  def submit(self, filename, func, after=None):
+    """
+    Runs *func* which produces *filename* in a background thread. If
+    *after* is the filename of a previously submitted function, *func* is
+    run after it completed.
+    """
+
+    previous = self.futures.get(after)
+    def run():
+      if previous is not None:
+        previous.result()
+      return func()
+    self.futures[filename] = self.executor.submit(run)
+
+  def wait(self):
+    """
+    Waits for all submitted functions and returns the first exception that
+    occured in one of them, or :const:`None`.
+    """
+
+    self.executor.shutdown(wait=True)
+    for future in self.futures.values():
+      if future.exception() is not None:
+        return future.exception()
+    return None
+
+
+@contextlib.contextmanager
+def concurrent_downloads(max_workers=4):
+  """
+  A context manager in which :func:`external_file` and
+  :func:`external_archive` only send the request to the server to
+  determine the filename and return right away. The files are downloaded
+  and archives are extracted with up to *max_workers* threads when the
+  context is left.
+
+  .. code:: python
+
+    with concurrent_downloads():
+      boost_dir = external_archive('https://.../boost_1_63_0.tar.bz2')
+      sdl2_dir = external_archive('https://.../SDL2-2.0.5.tar.gz')
+    # boost_dir and sdl2_dir exist now.
+
+  If a download fails in the background, the next URLs are tried in the
+  background, too. The loader cache is only updated for files that were
+  downloaded completely. Errors that occur in the background are raised
+  when the context is left.
+  """
+
+  pool = _DownloadPool(max_workers)
+  _download_pools.append(pool)
+  try:
+    yield
+  except BaseException:
+    pool.executor.shutdown(wait=True)
+    raise
+  finally:
+    _download_pools.remove(pool)
+  exc = pool.wait()
+  if exc is not None:
+    raise exc
+
+
+class LoaderCall(object):
+  """
+  A call to :func:`external_file` or :func:`external_archive` that was
+  recorded by :func:`record_downloads`.
+
+  .. attribute:: module
+
+    The :class:`~craftr.core.session.Module` that called the loader.
+
+  .. attribute:: func
+
+  .. attribute:: urls
+
+  .. attribute:: kwargs
+
+    The keyword arguments of the call, including the resolved ``name``.
+  """
+
+  def __init__(self, module, func, urls, kwargs):
+    self.module = module
+    self.func = func
+    self.urls = urls
+    self.kwargs = kwargs
+
+  def __repr__(self):
+    return '<LoaderCall {}() of "{}": {}>'.format(self.func.__name__,
+        self.module.ident, self.kwargs['name'])
+
+  def replay(self):
+    """
+    Calls the loader again in the context of the :attr:`module`, thus it
+    stores its results in the same loader cache.
+    """
+
+    session.modulestack.append(self.module)
+    try:
+      return self.func(*self.urls, **self.kwargs)
+    finally:
+      assert session.modulestack.pop() is self.module
+
+
+@contextlib.contextmanager
+def record_downloads():
+  """
+  A context manager in which :func:`external_file` and
+  :func:`external_archive` do not download anything but append a
+  :class:`LoaderCall` to the list that is returned by the context manager,
+  unless the file or archive is already in the loader cache. They return
+  the filename or directory that the file would probably be saved or
+  extracted to, which does not exist yet. Used by ``craftr fetch``, see
+  :func:`replay_downloads`.
+  """
+
+  calls = []
+  _recorders.append(calls)
+  try:
+    yield calls
+  finally:
+    _recorders.remove(calls)
+
+
+def replay_downloads(calls, max_workers=4):
+  """
+  Replays the recorded *calls* with :func:`concurrent_downloads`. Calls of
+  the same URLs are replayed after the first of them has completed, when
+  the file can be taken from the archive cache. Returns a list of the
+  exceptions raised by the loaders.
+  """
+
+  first, rest = [], []
+  seen = set()
+  for call in calls:
+    key = (call.urls, call.kwargs.get('sha256'))
+    (rest if key in seen else first).append(call)
+    seen.add(key)
+
+  errors = []
+  try:
+    with concurrent_downloads(max_workers):
+      for call in first:
+        try:
+          call.replay()
+        except Exception as exc:
+          errors.append(exc)
+  except Exception as exc:
+    errors.append(exc)
+  for call in rest:
+    try:
+      call.replay()
+    except Exception as exc:
+      errors.append(exc)
+  return errors
+
+
+def is_offline():
+  """
+  Returns :const:`True` if the ``craftr.offline`` option is enabled, in
+  which case the loaders only use files that were already downloaded (eg.
+  with ``craftr fetch``).
+  """
+
+  from craftr.core.manifest import BoolOption
+  return BoolOption('craftr.offline')(session.options.get('craftr.offline', ''))
+
+
+def _url_basename(url):
+  return url.split('?')[0].rstrip('/').split('/')[-1]
+
+
 class NoExternalFileMatch(Exception):
 
   def __init__(self, name, urls, excs):
@@ -84,12 +281,76 @@ class NoExternalFileMatch(Exception):
     return '\n'.join([self.name] + urls)
 
 
+class OfflineError(Exception):
+
+  def __str__(self):
+    return 'not downloaded, offline mode (see craftr fetch)'
+
+
+class ChecksumMismatch(Exception):
+
+  def __init__(self, url, expected, actual):
+    self.url = url
+    self.expected = expected
+    self.actual = actual
+
+  def __str__(self):
+    return 'SHA-256 checksum mismatch: expected {}, got {}'.format(
+        self.expected, self.actual)
+
+
+def get_archive_cache():
+  """
+  Returns the :class:`~craftr.core.archivecache.ArchiveCache` that is
+  configured with the ``craftr.archive_cache.dir`` option, or :const:`None`
+  if the ``craftr.archive_cache`` option is disabled.
+  """
+
+  if not archivecache.is_enabled(session.options):
+    return None
+  return archivecache.ArchiveCache(session.options.get('craftr.archive_cache.dir'))
+
+
+def _finish_download(download, url, sha256, archives=None, key=None,
+    link=None, lock=None):
+  """
+  *Private*. Receives the content of the started *download*, checks its
+  *sha256* checksum and, if the file is downloaded into the *archives*
+  cache, adds it to the cache under the specified *key* and links it to
+  the filename *link*. The :class:`~craftr.core.archivecache.DownloadLock`
+  *lock* is released in any case.
+
+  :raise ChecksumMismatch: If the checksum does not match. The downloaded
+      file is removed.
+  """
+
+  try:
+    download.finish()
+    if sha256 and download.hexdigest != sha256.lower():
+      path.remove(download.filename, silent=True)
+      raise ChecksumMismatch(url, sha256.lower(), download.hexdigest)
+    if archives:
+      archives.put_download(key, url, download.filename, download.hexdigest)
+  finally:
+    if lock:
+      lock.release()
+  if archives:
+    archivecache.link_file(download.filename, link)
+    archives.prune(archivecache.get_max_size(session.options),
+        keep=[archives.download_dir(key)])
+
+
 def external_file(*urls, filename = None, directory = None,
-    copy_file_url = False, name = None):
+    copy_file_url = False, sha256 = None, name = None):
   """
   Downloads a file from the first valid URL and saves it into *directory*
   under the specified *filename*.
 
+  If the ``craftr.archive_cache`` option is enabled, files downloaded over
+  HTTP are stored in the user-level archive cache (see
+  :mod:`craftr.core.archivecache`) and linked into *directory*, thus they
+  are downloaded only once for all build directories.
+
   :param urls: One or more URLs. Supports ``http://``, ``https://``,
       ``ftp://`` and ``file://`. Note that if a ``file://`` URL is
       specified, the file is not copied to the output filename unless
@@ -100,7 +361,14 @@ def external_file(*urls, filename = None, directory = None,
       is a relative path, it will be joined with this directory. Defaults
       to a path in the build directory.
   :param copy_file_url: If True, ``file://`` URLs will be copied instead
-      of used as-is.
+      of used as-is (see :func:`pyutils.copyfile()
+      <craftr.utils.pyutils.copyfile>`). Pass ``'link'`` to create a hard
+      link instead if possible, which is only safe if the file is not
+      modified later, eg. for read-only mirrors.
+  :param sha256: The expected SHA-256 checksum of the file. It is computed
+      while the file is downloaded. If it does not match, the file is
+      discarded and the next URL is tried. Also serves as the key of the
+      file in the archive cache, so that it is shared between mirrors.
   :param name: The name of the loader action. This name is used to store
       information in the :attr:`Session.cache` so we can re-use existing
       downloaded data. :func:`~craftr.defaults.gtn` will be used to
@@ -113,64 +381,168 @@ def external_file(*urls, filename = None, directory = None,
     directory = buildlocal('data')
 
   cache = get_loader_cache(name)
+  pool = _download_pools[-1] if _download_pools else None
+  archives = get_archive_cache()
+  offline = is_offline()
+
+  if _recorders:
+    existing_file = cache.get('download_file')
+    if cache.get('download_url') in urls and existing_file and path.isfile(existing_file):
+      return existing_file
+    _recorders[-1].append(LoaderCall(session.module, external_file, urls,
+        {'filename': filename, 'directory': directory, 'copy_file_url': copy_file_url,
+         'sha256': sha256, 'name': name}))
+    if not filename:
+      filename = _url_basename(urls[0])
+    return path.join(directory, filename) if directory else filename
 
   # TODO: expand variables of the current module.
 
-  target_filename = None
+  def record(url, target_filename, download_key):
+    cache['download_url'] = url
+    cache['download_sha256'] = sha256
+    cache['download_file'] = target_filename
+    cache['download_key'] = download_key
+    return target_filename
+
   exceptions = []
-  for url in urls:
-    if url == cache.get('download_url'):
-      existing_file = cache.get('download_file')
-      if existing_file and path.isfile(existing_file):
-        return existing_file
-
-    progress_info = 'Downloading {} ...'.format(url)
-    if url.startswith('file://'):
-      source_file = url[7:]
-      if path.isfile(source_file):
-        if not copy_file_url:
-          return source_file
-        if not filename:
-          filename = path.basename(source_file)
-
-        # TODO: Use httputils.download_file() for this as well?
-        logger.progress_begin(progress_info)
-        path.makedirs(directory)
-        target_filename = path.join(directory, filename)
-        with open(source_file, 'rb') as sfp:
-          with open(target_filename, 'wb') as dfp:
-            for bytes_copied, size in pyutils.copyfileobj(sfp, dfp):
-              logger.progress_update(float(bytes_copied) / size)
-        logger.progress_end()
-
-        # TODO: Copy file permissions
-        break
-      else:
-        exceptions.append(FileNotFoundError(url))
-    else:
+
+  def try_urls(start, filename, directory, background):
+    """
+    Tries the URLs from the index *start* on and returns the filename of
+    the file. If a download pool is active, the content of the first URL
+    that responds is received in the pool and the next URLs are tried in
+    the pool if that fails. The loader cache is updated when the file is
+    complete. *background* is True when this function is called from the
+    pool, in which case the file is always created at *filename*.
+    """
+
+    for index in range(start, len(urls)):
+      url = urls[index]
+      if url == cache.get('download_url') and sha256 == cache.get('download_sha256'):
+        existing_file = cache.get('download_file')
+        if existing_file and path.isfile(existing_file) and \
+            (not background or existing_file == filename):
+          return existing_file
+
+      progress_info = 'Downloading {} ...'.format(url)
+      if url.startswith('file://'):
+        source_file = url[7:]
+        if path.isfile(source_file):
+          if not copy_file_url and not background:
+            return source_file
+          if not filename:
+            filename = path.basename(source_file)
+
+          if not background:
+            logger.progress_begin(progress_info)
+          target_filename = path.join(directory, filename) if directory else filename
+          path.makedirs(path.dirname(path.norm(target_filename)))
+          link = (copy_file_url == 'link')
+          for bytes_copied, size in pyutils.copyfile(source_file, target_filename, link):
+            if not background:
+              logger.progress_update(float(bytes_copied) / size if size else 1.0)
+          if not background:
+            logger.progress_end()
+
+          # TODO: Copy file permissions
+          return record(url, target_filename, None)
+        else:
+          exceptions.append(FileNotFoundError(url))
+        continue
+
       progress = lambda data: _external_file_download_callback(
           progress_info, directory, filename, cache, data)
+      if pool or background:
+        # The progress bar can not display multiple downloads.
+        progress = None
+
+      lock = None
+      download_key = None
+      if archives:
+        download_key = archives.download_key(url, sha256)
+        cached_file = archives.get_download(download_key)
+        if not cached_file and not offline:
+          # Wait for another process that downloads the same file.
+          lock = archives.lock_download(download_key)
+          cached_file = archives.get_download(download_key)
+          if cached_file:
+            lock.release()
+        if cached_file:
+          target_filename = filename or path.basename(cached_file)
+          if directory:
+            target_filename = path.join(directory, target_filename)
+          archivecache.link_file(cached_file, target_filename)
+          return record(url, target_filename, download_key)
+
+      if offline:
+        exceptions.append(OfflineError(url))
+        continue
+      if archives:
+        download = httputils.Download(url,
+          directory = archives.download_dir(download_key), on_exists = 'overwrite',
+          progress = progress, hash_name = 'sha256')
+      else:
+        download = httputils.Download(url, filename = filename,
+          directory = directory, on_exists = 'skip', progress = progress,
+          hash_name = 'sha256' if sha256 else None)
 
       try:
-        target_filename, reused = httputils.download_file(
-          url, filename = filename, directory = directory, on_exists = 'skip',
-          progress = progress)
+        target_filename, reused = download.start()
       except (httputils.URLError, httputils.HTTPError) as exc:
+        if lock:
+          lock.release()
         exceptions.append(exc)
+        if not background:
+          logger.progress_end()
+        continue
+      except BaseException:
+        if lock:
+          lock.release()
+        raise
+
+      if archives:
+        link = filename or path.basename(target_filename)
+        target_filename = path.join(directory, link) if directory else link
+        finish = lambda: _finish_download(download, url, sha256, archives,
+            download_key, target_filename, lock)
+      elif not reused:
+        finish = lambda: _finish_download(download, url, sha256)
       else:
-        break
+        return record(url, target_filename, download_key)
+
+      if pool and not background:
+        def finish_or_retry(index=index, url=url, target_filename=target_filename,
+            download_key=download_key, finish=finish):
+          try:
+            finish()
+          except (httputils.URLError, httputils.HTTPError, ChecksumMismatch) as exc:
+            exceptions.append(exc)
+            # Try the next URLs, but keep the filename that the caller
+            # already received.
+            try_urls(index + 1, target_filename, None, True)
+          else:
+            record(url, target_filename, download_key)
+        logger.info(progress_info)
+        pool.submit(target_filename, finish_or_retry)
+        return target_filename
+      try:
+        finish()
+      except (httputils.URLError, httputils.HTTPError, ChecksumMismatch) as exc:
+        exceptions.append(exc)
+      else:
+        return record(url, target_filename, download_key)
       finally:
-        logger.progress_end()
+        if not background:
+          logger.progress_end()
 
-  if target_filename:
-    cache['download_url'] = url
-    cache['download_file'] = target_filename
-    return target_filename
+    raise NoExternalFileMatch(name, urls, exceptions)
 
-  raise NoExternalFileMatch(name, urls, exceptions)
+  return try_urls(0, filename, directory, False)
 
 
-def external_archive(*urls, exclude_files = (), directory = None, name = None):
+def external_archive(*urls, exclude_files = (), directory = None,
+    sha256 = None, shared = True, name = None):
   """
   Downloads an archive from the first valid URL and unpacks it into
   *directory*. Archives with a single directory at the root will be
@@ -181,7 +553,10 @@ def external_archive(*urls, exclude_files = (), directory = None, name = None):
   against the arcnames in the archive. Note that to exclude a directory,
   a pattern must match all files in that directory.
 
-  Uses :func:`external_file` to download the archive.
+  Uses :func:`external_file` to download the archive. If the archive
+  cache is enabled, the archive is extracted into the cache once and
+  *directory* is a symbolic link to the read-only tree (see
+  :mod:`craftr.core.archivecache`).
 
   :param urls: See :func:`external_file`
   :param exclude_files: A list of glob patterns.
@@ -189,6 +564,10 @@ def external_archive(*urls, exclude_files = (), directory = None, name = None):
       to a directory on the build directory derived from the downloaded
       archive filename. If defined and followed by a trailing slash, the
       archive filename will be appended.
+  :param sha256: See :func:`external_file`
+  :param shared: Pass False if files are written into the extracted
+      directory, eg. by a ``configure`` script. The archive is then
+      extracted into *directory* instead of being shared.
   :param name: The name of the loader action. This name is used to store
       information in the :attr:`Session.cache` so we can re-use existing
       downloaded data. :func:`~craftr.defaults.gtn` will be used to
@@ -197,10 +576,25 @@ def external_archive(*urls, exclude_files = (), directory = None, name = None):
   """
 
   name = gtn(name)
+
+  if _recorders:
+    cache = get_loader_cache(name)
+    if cache.get('archive_dir') and path.isdir(cache['archive_dir']):
+      return cache['archive_dir']
+    _recorders[-1].append(LoaderCall(session.module, external_archive, urls,
+        {'exclude_files': exclude_files, 'directory': directory,
+         'sha256': sha256, 'shared': shared, 'name': name}))
+    if not directory:
+      directory = buildlocal('data') + '/'
+    if path.maybedir(directory):
+      # The actual name depends on the suffix of the downloaded file.
+      directory = path.join(directory, path.rmvsuffix(_url_basename(urls[0])))
+    return directory
+
   if not directory:
     directory = buildlocal('data') + '/'
 
-  archive = external_file(*urls, directory = directory, name = name)
+  archive = external_file(*urls, directory = directory, sha256 = sha256, name = name)
   cache = get_loader_cache(name)  # shared with external_file()
 
   suffix = nr.misc.archive.get_opener(archive)[0]
@@ -208,9 +602,21 @@ def external_archive(*urls, exclude_files = (), directory = None, name = None):
     filename = path.basename(archive)[:-len(suffix)]
     directory = path.join(directory, filename)
 
+  # The download may still be running in a download pool, in which case
+  # the loader cache is updated when it is complete.
+  pending = bool(_download_pools) and archive in _download_pools[-1].futures
+  archives = get_archive_cache() if shared else None
+
+  def get_tree_key():
+    if archives and cache.get('download_key'):
+      return archives.tree_key(cache['download_key'], exclude_files)
+    return None
+
   # Check if we already unpacked it etc.
-  if cache.get('archive_source') == archive and \
+  if not pending and \
+      cache.get('archive_source') == archive and \
       cache.get('archive_dir') == directory and \
+      cache.get('archive_tree') == get_tree_key() and \
       path.isdir(directory):
     return directory
 
@@ -234,12 +640,37 @@ def external_archive(*urls, exclude_files = (), directory = None, name = None):
     else:
       logger.progress_update(progress, '{} / {}'.format(index, count))
 
-  nr.misc.archive.extract(archive, directory, suffix = suffix,
-    unpack_single_dir = True, check_extract_file = match_exclude_files,
-    progress_callback = progress)
-
-  cache['archive_source'] = archive
-  cache['archive_dir'] = directory
+  def extract(dest, progress_callback):
+    nr.misc.archive.extract(archive, dest, suffix = suffix,
+      unpack_single_dir = True, check_extract_file = match_exclude_files,
+      progress_callback = progress_callback)
+
+  def unpack(progress_callback):
+    tree_key = get_tree_key()
+    if tree_key:
+      tree = archives.get_tree(tree_key)
+      added = not tree
+      if added:
+        meta = {'url': cache['download_url'], 'exclude_files': list(exclude_files)}
+        tree = archives.put_tree(tree_key,
+            lambda tempdir: extract(tempdir, progress_callback), meta)
+      archivecache.link_tree(tree, directory)
+      if added:
+        # Only after linking, the new tree is never removed.
+        archives.prune(archivecache.get_max_size(session.options), keep=[tree])
+    else:
+      # Never extract into a tree of the archive cache.
+      if path.islink(directory):
+        os.remove(directory)
+      extract(directory, progress_callback)
+    cache['archive_source'] = archive
+    cache['archive_dir'] = directory
+    cache['archive_tree'] = tree_key
+
+  if _download_pools:
+    _download_pools[-1].submit(directory, lambda: unpack(None), after = archive)
+  else:
+    unpack(progress)
   return directory
 
 
@@ -288,4 +719,16 @@ def pkg_config(pkg_name, static = False):
   return result
 
 
+def pkg_config_async(pkg_name, static = False):
+  """
+  Runs :func:`pkg_config` in the background and returns a
+  :class:`concurrent.futures.Future` for its result. Use
+  :func:`shell.gather() <craftr.utils.shell.gather>` to query multiple
+  packages concurrently.
+  """
+
+  return shell.submit(pkg_config, pkg_name, static)
+
+
 pkg_config.Error = PkgConfigError
+pkg_config_async.Error = PkgConfigError
@@ -0,0 +1,359 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.stats`
+===================
+
+Build timing analytics for ``craftr stats``. The ``.ninja_log`` in the build
+directory is read incrementally (from the offset at which the previous
+import stopped) and every Ninja invocation found in it is stored as a build
+in a SQLite database together with the Git commit of the project. The
+outputs in the log are mapped back to Craftr targets with the information
+that ``craftr export`` stores in the build cache.
+"""
+
+from craftr.utils import path, shell
+
+import collections
+import mmap
+import os
+import sqlite3
+import time
+
+#: The name of the SQLite database in the build directory.
+DATABASE_FILENAME = '.craftr-stats.db'
+
+SCHEMA = '''
+  CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+  );
+  CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp REAL,
+    commit_id TEXT,
+    wall_ms INTEGER
+  );
+  CREATE TABLE IF NOT EXISTS edges (
+    build_id INTEGER REFERENCES builds(id),
+    target TEXT,
+    start_ms INTEGER,
+    end_ms INTEGER
+  );
+  CREATE INDEX IF NOT EXISTS edges_build ON edges(build_id);
+'''
+
+Edge = collections.namedtuple('Edge', 'target start end')
+
+
+def open_database(builddir):
+  db = sqlite3.connect(path.join(builddir, DATABASE_FILENAME))
+  db.executescript(SCHEMA)
+  return db
+
+
+def get_commit(directory, rev='HEAD'):
+  """
+  Returns the full Git commit ID of *rev* in the repository that contains
+  *directory*, or :const:`None` if it can not be determined.
+  """
+
+  try:
+    output = shell.pipe(['git', 'rev-parse', '--verify', '-q', rev + '^{commit}'],
+        cwd=directory, check=True, merge=False).stdout
+  except (shell.CalledProcessError, OSError):
+    return None
+  return output.strip() or None
+
+
+def read_log(filename, offset):
+  """
+  Reads the complete lines of the Ninja log *filename* starting at *offset*
+  using a memory map. Returns a tuple of the parsed entries and the new
+  offset. Every entry is a tuple of ``(start_ms, end_ms, output)``.
+  """
+
+  entries = []
+  with open(filename, 'rb') as fp:
+    size = os.fstat(fp.fileno()).st_size
+    if size <= offset:
+      return entries, offset
+    with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      end = data.rfind(b'\n', offset) + 1
+      if end <= offset:
+        return entries, offset
+      for line in data[offset:end].decode('utf8', 'replace').splitlines():
+        if not line or line.startswith('#'):
+          continue
+        parts = line.split('\t')
+        if len(parts) < 4:
+          continue
+        entries.append((int(parts[0]), int(parts[1]), parts[3]))
+  return entries, end
+
+
+def split_runs(entries):
+  """
+  Splits the entries of a Ninja log into the individual Ninja invocations.
+  Ninja appends entries when a command completes and its times are relative
+  to the start of the invocation, thus an end time that is lower than the
+  previous one marks the start of a new invocation.
+  """
+
+  runs = []
+  last_end = None
+  for entry in entries:
+    if last_end is None or entry[1] < last_end:
+      runs.append([])
+    runs[-1].append(entry)
+    last_end = entry[1]
+  return runs
+
+
+def import_log(builddir, maindir, build_cache):
+  """
+  Imports the new entries of the ``.ninja_log`` in *builddir* into the
+  statistics database. *build_cache* is the ``build`` section of the
+  Craftr cache that contains the ``target_outputs`` of the last export.
+  Returns the number of builds that were imported.
+  """
+
+  logfile = path.join(builddir, '.ninja_log')
+  if not path.isfile(logfile):
+    return 0
+
+  outputs = {}
+  for target, files in build_cache.get('target_outputs', {}).items():
+    for filename in files:
+      outputs[filename] = target
+
+  db = open_database(builddir)
+  with db:
+    state = dict(db.execute('SELECT key, value FROM state'))
+    offset = int(state.get('offset', 0))
+    inode = str(os.stat(logfile).st_ino)
+    recompacted = state.get('inode') not in (None, inode) or \
+        os.path.getsize(logfile) < offset
+    if recompacted:
+      offset = 0
+
+    entries, offset = read_log(logfile, offset)
+    runs = split_runs(entries)
+    if recompacted:
+      # Ninja rewrote the log and only kept the most recent entry of every
+      # output, we can only tell apart the invocation that was just appended.
+      runs = runs[-1:]
+
+    commit = get_commit(maindir)
+    for run in runs:
+      wall = max(x[1] for x in run) - min(x[0] for x in run)
+      cursor = db.execute('INSERT INTO builds (timestamp, commit_id, wall_ms) '
+          'VALUES (?, ?, ?)', (time.time(), commit, wall))
+      edges = set()
+      for start, end, output in run:
+        target = outputs.get(path.norm(output, builddir), output)
+        edges.add((target, start, end))
+      db.executemany('INSERT INTO edges VALUES (?, ?, ?, ?)',
+          ((cursor.lastrowid,) + x for x in edges))
+
+    db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', ('offset', str(offset)))
+    db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', ('inode', inode))
+  db.close()
+  return len(runs)
+
+
+def get_build(db, build_id=None, commit=None):
+  """
+  Returns the row of the build with the specified *build_id*, or the most
+  recent build of *commit*, or the most recent build overall.
+  """
+
+  if build_id is not None:
+    query, params = 'WHERE id = ?', (build_id,)
+  elif commit is not None:
+    query, params = 'WHERE commit_id = ? ORDER BY id DESC LIMIT 1', (commit,)
+  else:
+    query, params = 'ORDER BY id DESC LIMIT 1', ()
+  return db.execute('SELECT id, timestamp, commit_id, wall_ms FROM builds '
+      + query, params).fetchone()
+
+
+def get_edges(db, build_id):
+  return [Edge(*x) for x in db.execute(
+      'SELECT target, start_ms, end_ms FROM edges WHERE build_id = ?', (build_id,))]
+
+
+def module_of(target):
+  return target.rpartition('.')[0] or target
+
+
+def target_times(edges):
+  """
+  Returns a dictionary that maps every target to the sum of the time
+  spent in its commands.
+  """
+
+  result = collections.Counter()
+  for edge in edges:
+    result[edge.target] += edge.end - edge.start
+  return result
+
+
+def module_times(edges):
+  result = collections.Counter()
+  for target, time_ms in target_times(edges).items():
+    result[module_of(target)] += time_ms
+  return result
+
+
+def critical_path(edges, target_deps):
+  """
+  Computes the critical path of a build, that is the chain of dependent
+  targets with the longest accumulated time. The weight of a target is its
+  longest command, as the commands of a target can run in parallel.
+
+  :param edges: A list of :class:`Edge` objects.
+  :param target_deps: A dictionary that maps every target to the list of
+    targets that it depends on.
+  :return: A tuple of the total time and the list of targets.
+  """
+
+  weight = {}
+  for edge in edges:
+    weight[edge.target] = max(weight.get(edge.target, 0), edge.end - edge.start)
+
+  # Depth-first search without recursion, a target is finished after all
+  # of its dependencies. Dependencies on the stack (cycles) are ignored.
+  total = {}
+  previous = {}
+  for root in weight:
+    if root in total:
+      continue
+    active = {root}
+    stack = [(root, iter(target_deps.get(root, ())))]
+    while stack:
+      target, deps = stack[-1]
+      for dep in deps:
+        if dep in weight and dep not in total and dep not in active:
+          active.add(dep)
+          stack.append((dep, iter(target_deps.get(dep, ()))))
+          break
+      else:
+        stack.pop()
+        active.discard(target)
+        best = None
+        for dep in target_deps.get(target, ()):
+          if dep in total and (best is None or total[dep] > total[best]):
+            best = dep
+        previous[target] = best
+        total[target] = weight[target] + (total[best] if best is not None else 0)
+
+  last, result = None, 0
+  for target in weight:
+    if total[target] > result:
+      last, result = target, total[target]
+  path = []
+  while last is not None:
+    path.append(last)
+    last = previous[last]
+  path.reverse()
+  return result, path
+
+
+def parallelism(edges, buckets=20):
+  """
+  Returns a list of tuples ``(start_ms, average_jobs)`` that describes the
+  number of commands that were running in parallel over time.
+  """
+
+  if not edges:
+    return []
+  begin = min(x.start for x in edges)
+  end = max(x.end for x in edges)
+  size = max(1, (end - begin + buckets - 1) // buckets)
+  busy = [0] * buckets
+  for edge in edges:
+    for index in range((edge.start - begin) // size, buckets):
+      lower = begin + index * size
+      upper = lower + size
+      if lower >= edge.end:
+        break
+      busy[index] += min(upper, edge.end) - max(lower, edge.start)
+  return [(index * size, busy[index] / size) for index in range(buckets)]
+
+
+def format_ms(value):
+  return '{:.2f}s'.format(value / 1000.0)
+
+
+def report(db, build, target_deps, top=10, fp=None):
+  """
+  Prints the per-target and per-module times, the critical path and the
+  parallelism of the *build* to *fp*.
+  """
+
+  build_id, timestamp, commit, wall = build
+  edges = get_edges(db, build_id)
+  print('Build #{} ({}), commit {}, wall time {}, {} command(s)'.format(
+      build_id, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)),
+      (commit or 'unknown')[:12], format_ms(wall), len(edges)), file=fp)
+
+  print('\nSlowest targets:', file=fp)
+  for target, time_ms in target_times(edges).most_common(top):
+    print('  {:>9}  {}'.format(format_ms(time_ms), target), file=fp)
+
+  print('\nSlowest modules:', file=fp)
+  for module, time_ms in module_times(edges).most_common(top):
+    print('  {:>9}  {}'.format(format_ms(time_ms), module), file=fp)
+
+  total, chain = critical_path(edges, target_deps)
+  print('\nCritical path ({}):'.format(format_ms(total)), file=fp)
+  for target in chain:
+    print('  ' + target, file=fp)
+
+  print('\nParallelism:', file=fp)
+  for start, jobs in parallelism(edges):
+    print('  {:>9}  {:5.1f} {}'.format(format_ms(start), jobs,
+        '#' * int(round(jobs * 4))), file=fp)
+
+
+def compare(db, old, new, top=10, fp=None):
+  """
+  Prints the difference of the target times between the *old* and the
+  *new* build.
+  """
+
+  old_times = target_times(get_edges(db, old[0]))
+  new_times = target_times(get_edges(db, new[0]))
+  print('Build #{} ({}) vs. #{} ({}): wall time {} -> {}'.format(
+      old[0], (old[2] or 'unknown')[:12], new[0], (new[2] or 'unknown')[:12],
+      format_ms(old[3]), format_ms(new[3])), file=fp)
+  diffs = []
+  for target in set(old_times) & set(new_times):
+    diffs.append((new_times[target] - old_times[target], target))
+  diffs.sort(reverse=True)
+  print('\nLargest regressions:', file=fp)
+  for diff, target in diffs[:top]:
+    if diff <= 0:
+      break
+    print('  {:>9} -> {:>9}  (+{})  {}'.format(format_ms(old_times[target]),
+        format_ms(new_times[target]), format_ms(diff), target), file=fp)
+  print('\nLargest improvements:', file=fp)
+  for diff, target in reversed(diffs[-top:]):
+    if diff >= 0:
+      break
+    print('  {:>9} -> {:>9}  ({})  {}'.format(format_ms(old_times[target]),
+        format_ms(new_times[target]), format_ms(diff), target), file=fp)
@@ -44,8 +44,11 @@ else:
   error('platform currently not supported: {}'.format(platform.name))
 
 # Grab the cURL source and update the include directory in the public framework.
+# The source directory is not shared with other build directories because
+# ./configure writes into it on Mac OS.
 source_directory = external_archive(
-  "https://curl.haxx.se/download/curl-{}.tar.gz".format(options.version)
+  "https://curl.haxx.se/download/curl-{}.tar.gz".format(options.version),
+  shared = (platform.name != 'mac')
 )
 cURL['include'] += [path.join(source_directory, 'include')]
 
@@ -20,15 +20,20 @@
 Provides the :class:`TargetBuilder` and :class:`Framework` classes.
 """
 
-from craftr.core import build
+from craftr.core import build, trace
 from craftr.core.logging import logger
 from craftr.core.session import session
-from craftr.utils import argspec, pyutils
+from craftr.utils import argspec
 from nr.py.bytecode import get_assigned_name
 from nr.types.version import Version
 
 import collections
 import sys
+import weakref
+
+#: Maps code objects to a dictionary that maps instruction offsets to the
+#: result of :func:`get_assigned_name`, see :func:`_get_assigned_name`.
+_assigned_names = weakref.WeakKeyDictionary()
 
 
 def get_full_name(target_name, module=None, module_name=None, version=None):
@@ -54,6 +59,28 @@ def get_full_name(target_name, module=None, module_name=None, version=None):
   return '{}-{}.{}'.format(module_name, version, target_name)
 
 
+def _get_assigned_name(frame):
+  """
+  Cached :func:`get_assigned_name`. The assigned name only depends on the
+  code and the current instruction of the *frame*.
+  """
+
+  names = _assigned_names.get(frame.f_code)
+  if names is None:
+    names = _assigned_names[frame.f_code] = {}
+  try:
+    name, error = names[frame.f_lasti]
+  except KeyError:
+    try:
+      name, error = get_assigned_name(frame), None
+    except ValueError as exc:
+      name, error = None, exc.args
+    names[frame.f_lasti] = (name, error)
+  if error is not None:
+    raise ValueError(*error)
+  return name
+
+
 def gtn(target_name=None, name_hint=NotImplemented):
   """
   This function is mandatory in combination with the :class:`TargetBuilder`
@@ -86,7 +113,9 @@ def gtn(target_name=None, name_hint=NotImplemented):
   If *name_hint* is :const:`None` and no assigned name could be determined,
   no exception will be raised but also no alternative target name will
   be generated and :const:`None` will be returned. This is useful for wrapping
-  existing target generator functions.
+  existing target generator functions. Otherwise, the target is named after
+  the *name_hint* with the lowest free ``_0000`` suffix, starting from the
+  suffix that was returned last for the hint in the current module.
   """
 
   if not session:
@@ -97,7 +126,7 @@ def gtn(target_name=None, name_hint=NotImplemented):
 
   if target_name is None:
     try:
-      target_name = get_assigned_name(sys._getframe(2))
+      target_name = _get_assigned_name(sys._getframe(2))
     except ValueError:
       if name_hint is NotImplemented:
         raise
@@ -111,13 +140,16 @@ def gtn(target_name=None, name_hint=NotImplemented):
     if name_hint is None:
       return None
 
-    index = 0
+    # Targets are never removed from the graph, thus we can continue to
+    # search from the last index that was returned for the hint.
+    index = module.target_name_counters.get(name_hint, 0)
     while True:
       target_name = '{}_{:0>4}'.format(name_hint, index)
       full_name = get_full_name(target_name, module)
       if full_name not in session.graph.targets:
         break
       index += 1
+    module.target_name_counters[name_hint] = index
 
   if full_name is None:
     full_name = get_full_name(target_name, module)
@@ -171,13 +203,22 @@ class TargetBuilder(object):
     self.implicit_deps = list(implicit_deps)
     self.order_only_deps = list(order_only_deps)
 
+    # The frameworks of Targets are already expanded, thus we only need to
+    # skip those that we have already seen.
+    seen = set()
+    def add_frameworks(frameworks):
+      for fw in frameworks:
+        if id(fw) not in seen:
+          seen.add(id(fw))
+          self.frameworks.append(fw)
+
     # If we find any Target objects in the inputs, expand the outputs
     # and append the frameworks.
     if inputs is not None:
       self.inputs = []
       for input_ in (inputs or ()):
         if isinstance(input_, build.Target):
-          pyutils.unique_extend(self.frameworks, input_.frameworks)
+          add_frameworks(input_.frameworks)
           self.inputs += input_.outputs
         else:
           self.inputs.append(input_)
@@ -188,9 +229,9 @@ class TargetBuilder(object):
     for fw in frameworks:
       if isinstance(fw, build.Target):
         self.implicit_deps.append(fw)
-        self.frameworks += fw.frameworks
+        add_frameworks(fw.frameworks)
       else:
-        self.frameworks.append(fw)
+        add_frameworks([fw])
 
     if option_kwargs is None:
       option_kwargs = {}
@@ -220,7 +261,10 @@ class TargetBuilder(object):
 
   def setdefault(self, key, value):
     self.option_kwargs_defaults[key] = value
+    self.options_merge.invalidate()
 
+  @trace.traced('TargetBuilder.build', 'target',
+      lambda self, *args, **kwargs: {'target': self.name})
   def build(self, commands, inputs=(), outputs=(), implicit_deps=(),
       order_only_deps=(), metadata=None, **kwargs):
     """
@@ -281,29 +325,46 @@ class OptionMerge(object):
   in the first dictionaries passed to the constructor take precedence over the
   last.
 
+  The values returned by :meth:`get` and :meth:`get_list` are looked up in
+  an index that is built on first access and invalidated by :meth:`append`.
+  If a framework is modified after it has been added, :meth:`invalidate`
+  must be called.
+
   :param frameworks: One or more :class:`Framework` objects. Note that
     the constructor will expand and flatten the ``'frameworks'`` list.
   """
 
   def __init__(self, *frameworks):
     self.frameworks = []
+    self._ids = set()
+    self._index = None
+    self._lists = {}
     [self.append(x) for x in frameworks]
 
   def __getitem__(self, key):
-    for options in self.frameworks:
-      try:
-        return options[key]
-      except KeyError:
-        pass  # intentional
-    raise KeyError(key)
+    if self._index is None:
+      index = {}
+      for options in reversed(self.frameworks):
+        index.update(options)
+      self._index = index
+    return self._index[key]
 
   def append(self, framework):
-    def update(fw):
-      if not isinstance(framework, Framework):
+    if not isinstance(framework, Framework):
+      raise TypeError('expected Framework, got {}'.format(type(framework).__name__))
+    for fw in build.expand_frameworks([framework], self._ids):
+      if not isinstance(fw, Framework):
         raise TypeError('expected Framework, got {}'.format(type(fw).__name__))
-      pyutils.unique_append(self.frameworks, fw, id_compare=True)
-      [update(x) for x in fw.get('frameworks', [])]
-    update(framework)
+      self.frameworks.append(fw)
+    self.invalidate()
+
+  def invalidate(self):
+    """
+    Clears the index of the values of all keys.
+    """
+
+    self._index = None
+    self._lists.clear()
 
   def get(self, key, default=None):
     try:
@@ -319,6 +380,11 @@ class OptionMerge(object):
     *key*.
     """
 
+    try:
+      return list(self._lists[key])
+    except KeyError:
+      pass
+
     result = []
     for option in self.frameworks:
       value = option.get(key)
@@ -326,6 +392,7 @@ class OptionMerge(object):
         continue
       if not isinstance(value, collections.Sequence):
         raise ValueError('found "{}" for key "{}" which is a non-sequence'
-            .format(tpye(value).__name__, key))
+            .format(type(value).__name__, key))
       result += value
+    self._lists[key] = tuple(result)
     return result
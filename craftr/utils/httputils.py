@@ -14,12 +14,37 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+"""
+:mod:`craftr.utils.httputils`
+=============================
+
+Downloads over HTTP(S). All downloads share one :class:`requests.Session`
+(see :func:`get_session`), thus connections to the same host are reused.
+Files are first written to a ``.part`` file next to the output file. If a
+download is interrupted, it is continued with a HTTP ``Range`` request,
+either right away or the next time the file is downloaded, if the server
+supports it and the file on the server did not change.
+"""
+
 from craftr.utils import argspec
 from craftr.utils import path
 from requests.exceptions import RequestException as URLError, HTTPError #FIXME !!
 
 import cgi
+import hashlib
+import json
+import os
 import requests
+import threading
+
+#: The default size of the chunks that are read from the response.
+DEFAULT_CHUNKSIZE = 256 * 1024
+
+#: The number of connections per host kept in the pool of the session.
+POOL_SIZE = 8
+
+_session = None
+_session_lock = threading.Lock()
 
 
 class UserInterrupt(Exception):
@@ -28,8 +53,26 @@ class UserInterrupt(Exception):
   """
 
 
+def get_session():
+  """
+  Returns the :class:`requests.Session` that is used for all downloads. It
+  is created on the first call and can be used from multiple threads.
+  """
+
+  global _session
+  with _session_lock:
+    if _session is None:
+      _session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE,
+          pool_maxsize=POOL_SIZE)
+      _session.mount('http://', adapter)
+      _session.mount('https://', adapter)
+    return _session
+
+
 def download_file(url, filename=None, file=None, directory=None,
-    on_exists='rename', progress=None, chunksize=4096, request_kwargs=None):
+    on_exists='rename', progress=None, chunksize=None, request_kwargs=None,
+    retries=3):
   """
   Download a file from a URL to one of the following destinations:
 
@@ -51,84 +94,241 @@ def download_file(url, filename=None, file=None, directory=None,
     dictionary provides the keys ``size``,  ``downloaded`` and ``response``.
     If the callable returns :const:`False` (specifically the value False), the
     download will be aborted and a :class:`UserInterrupt` will be raised.
+  :param chunksize: The size of the chunks that are read from the
+    response. Defaults to :data:`DEFAULT_CHUNKSIZE`.
   :param request_kwargs: A dictionary with additional keyword arguments
-    for :func:`requests.get`.
+    for :meth:`requests.Session.get`.
+  :param retries: The number of times that an interrupted download is
+    continued with a ``Range`` request.
 
   Raise and return:
 
   :raise requests.RequestException:
   :raise UserInterrupt: If the *progress* returned :const:`False`.
-  :return: If the download mode is *directory*, the name of the downloaded
-    file will be returned and False if the file was newly downloaded, True
-    if the download was skipped because the file already existed.
-    Otherwise, the number of bytes downloaded will be returned.
+  :return: A tuple of the name of the downloaded file (:const:`None` if
+    *file* is specified) and True if the download was skipped because the
+    file already existed, False otherwise.
   """
 
-  argspec.validate('on_exists', on_exists, {'enum': ['rename', 'overwrite', 'skip']})
+  download = Download(url, filename, file, directory, on_exists, progress,
+      chunksize, request_kwargs, retries)
+  filename, reused = download.start()
+  if reused:
+    return filename, True
+  return download.finish()
 
-  if sum(map(bool, [filename, file, directory])) != 1:
-    raise ValueError('exactly one of filename, file or directory must be specifed')
 
-  request_kwargs = request_kwargs or {}
-  request_kwargs.setdefault('stream', True)
-  response = requests.get(url, **request_kwargs)
+class Download(object):
+  """
+  Implements :func:`download_file` in two steps. :meth:`start` sends the
+  request and determines the output filename, :meth:`finish` receives the
+  content. :meth:`finish` can be called from another thread, which allows
+  to know the filename of a download before it is complete. The parameters
+  are the same as for :func:`download_file`.
+
+  :param hash_name: The name of a :mod:`hashlib` algorithm. The content is
+    hashed while it is received and :attr:`hexdigest` is set when the
+    download is finished.
+  """
+
+  def __init__(self, url, filename=None, file=None, directory=None,
+      on_exists='rename', progress=None, chunksize=None, request_kwargs=None,
+      retries=3, hash_name=None):
+    argspec.validate('on_exists', on_exists, {'enum': ['rename', 'overwrite', 'skip']})
+    if sum(map(bool, [filename, file, directory])) != 1:
+      raise ValueError('exactly one of filename, file or directory must be specifed')
+
+    self.url = url
+    self.filename = filename
+    self.file = file
+    self.directory = directory
+    self.on_exists = on_exists
+    self.progress = progress
+    self.chunksize = chunksize or DEFAULT_CHUNKSIZE
+    self.request_kwargs = dict(request_kwargs or {})
+    self.request_kwargs['stream'] = True
+    self.retries = retries
+    self.response = None
+    self.validator = None
+    self.offset = 0
+    self.size = None
+    self.hash_name = hash_name
+    self.hexdigest = None
+    self._hash = None
 
-  if directory:
+  def _get(self, offset=0):
+    kwargs = dict(self.request_kwargs)
+    if offset:
+      kwargs['headers'] = dict(kwargs.get('headers') or {},
+          **{'Range': 'bytes={}-'.format(offset), 'If-Range': self.validator})
+    response = get_session().get(self.url, **kwargs)
+    if offset and response.status_code == 416:
+      # The range is invalid, eg. because the partial file is complete.
+      response.close()
+      return self._get(0)
+    response.raise_for_status()
+
+    # The server sends the full content if it does not support ranges or
+    # the file changed.
+    if offset and response.status_code != 206:
+      offset = 0
     try:
-      filename = parse_content_disposition(
-        response.headers.get('Content-Disposition', ''))
+      size = offset + int(response.headers.get('Content-Length', ''))
     except ValueError:
-      filename = url.split('/')[-1]
-    filename = path.join(directory, filename)
-    path.makedirs(directory)
-
-    if path.exists(filename):
-      if on_exists == 'skip':
-        return filename, True
-      elif on_exists == 'rename':
-        index = 0
-        while True:
-          new_filename = filename + '_{:0>4}'.format(index)
-          if not path.exists(new_filename):
-            filename = new_filename
-            break
-          index += 1
-      elif on_exists != 'overwrite':
-        raise RuntimeError
-
-  try:
-    size = int(response.headers.get('Content-Length', ''))
-  except ValueError:
-    size = None
-
-  progress_info = {'response': response, 'size': size, 'downloaded': 0,
-    'completed': False, 'filename': filename, 'url': url}
-  if progress and progress(progress_info) is False:
-    raise UserInterrupt
-
-  def copy_to_file(fp):
-    for chunk in response.iter_content(4096):
-      progress_info['downloaded'] += len(chunk)
-      fp.write(chunk)
-      if progress and progress(progress_info) is False:
-        raise UserInterrupt
-    progress_info['completed'] = True
-    if progress and progress(progress_info) is False:
-      raise UserInterrupt
+      size = None
+
+    self.response = response
+    self.offset = offset
+    self.size = size
+    return response
 
-  if filename:
-    path.makedirs(path.dirname(filename))
+  @staticmethod
+  def _get_validator(response):
+    if response.headers.get('Accept-Ranges') != 'bytes':
+      return None
+    validator = response.headers.get('ETag')
+    if not validator or validator.startswith('W/'):
+      validator = response.headers.get('Last-Modified')
+    return validator
+
+  def start(self):
+    """
+    Sends the request. Returns a tuple of the output filename and True if
+    the file already exists and *on_exists* is ``'skip'``.
+    """
+
+    response = self._get()
+    self.validator = self._get_validator(response)
+
+    if self.directory:
+      try:
+        filename = parse_content_disposition(
+          response.headers.get('Content-Disposition', ''))
+      except ValueError:
+        filename = self.url.split('/')[-1]
+      filename = path.join(self.directory, filename)
+      path.makedirs(self.directory)
+
+      if path.exists(filename):
+        if self.on_exists == 'skip':
+          response.close()
+          return filename, True
+        elif self.on_exists == 'rename':
+          index = 0
+          while True:
+            new_filename = filename + '_{:0>4}'.format(index)
+            if not path.exists(new_filename):
+              filename = new_filename
+              break
+            index += 1
+        elif self.on_exists != 'overwrite':
+          raise RuntimeError
+      self.filename = filename
+
+    # Continue a previous download of the same file.
+    if self.filename and self.validator:
+      try:
+        with open(self.partfile + '.json') as fp:
+          state = json.load(fp)
+        offset = os.path.getsize(self.partfile)
+      except (OSError, ValueError):
+        state, offset = None, 0
+      if offset and state == {'url': self.url, 'validator': self.validator}:
+        response.close()
+        self._get(offset)
+
+    return self.filename, False
+
+  @property
+  def partfile(self):
+    return self.filename + '.part'
+
+  def finish(self):
+    """
+    Receives the content of the response. Returns a tuple of the output
+    filename and False.
+    """
+
+    if self.file:
+      self._receive(self.file)
+      return None, False
+
+    path.makedirs(path.dirname(self.filename))
+    if self.validator:
+      with open(self.partfile + '.json', 'w') as fp:
+        json.dump({'url': self.url, 'validator': self.validator}, fp)
     try:
-      with open(filename, 'wb') as fp:
-        copy_to_file(fp)
+      with open(self.partfile, 'r+b' if self.offset else 'wb') as fp:
+        self._receive(fp)
+    except (URLError, KeyboardInterrupt):
+      # Keep the partial file, the download can be continued later.
+      raise
     except BaseException:
-      # Delete the file if it could not be downloaded successfully.
-      path.remove(filename, silent=True)
+      path.remove(self.partfile, silent=True)
+      path.remove(self.partfile + '.json', silent=True)
       raise
-  elif file:
-    copy_to_file(file)
+    os.replace(self.partfile, self.filename)
+    path.remove(self.partfile + '.json', silent=True)
+    return self.filename, False
+
+  def _receive(self, fp):
+    progress = self.progress
+    progress_info = {'response': self.response, 'size': self.size,
+      'downloaded': self.offset, 'completed': False,
+      'filename': self.filename, 'url': self.url}
+    if progress and progress(progress_info) is False:
+      raise UserInterrupt
+
+    # Only the partial file can be rewound if the server does not continue
+    # an interrupted download where it stopped.
+    seekable = not self.file
+    def rewind(offset):
+      fp.seek(offset)
+      fp.truncate()
+      if self.hash_name:
+        # Hash the content that was received by a previous download.
+        self._hash = hashlib.new(self.hash_name)
+        fp.seek(0)
+        for chunk in iter(lambda: fp.read(65536), b''):
+          self._hash.update(chunk)
 
-  return filename, False
+    if seekable:
+      rewind(self.offset)
+    elif self.hash_name:
+      self._hash = hashlib.new(self.hash_name)
+    retries = self.retries
+    while True:
+      try:
+        for chunk in self.response.iter_content(self.chunksize):
+          progress_info['downloaded'] += len(chunk)
+          fp.write(chunk)
+          if self._hash:
+            self._hash.update(chunk)
+          if progress and progress(progress_info) is False:
+            raise UserInterrupt
+        if self.size is not None and progress_info['downloaded'] < self.size:
+          raise requests.exceptions.ChunkedEncodingError('incomplete response')
+        break
+      except (requests.exceptions.ConnectionError,
+          requests.exceptions.ChunkedEncodingError):
+        if not retries or not self.validator:
+          raise
+        retries -= 1
+        self.response.close()
+        self._get(progress_info['downloaded'])
+        if self.offset != progress_info['downloaded']:
+          if not seekable:
+            raise
+          rewind(self.offset)
+          progress_info['downloaded'] = self.offset
+        progress_info['response'] = self.response
+        progress_info['size'] = self.size
+
+    if self._hash:
+      self.hexdigest = self._hash.hexdigest()
+    progress_info['completed'] = True
+    if progress and progress(progress_info) is False:
+      raise UserInterrupt
 
 
 def parse_content_disposition(value):
@@ -14,15 +14,19 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from craftr.core import trace
 from craftr.utils import argspec
 from os import sep, pathsep, curdir, pardir, getcwd
 from os.path import exists, isdir, isfile, isabs, abspath as abs
 from os.path import join, split, dirname, basename, expanduser
 from os.path import getmtime
 
+import binascii
+import collections
 import ctypes
 import errno
 import glob2
+import hashlib
 import os
 import shutil
 import tempfile as _tempfile
@@ -30,6 +34,10 @@ import tempfile as _tempfile
 curdir_sep = curdir + sep
 pardir_sep = pardir + sep
 
+#: Counts the files that :func:`write_if_changed` ``'written'`` and the
+#: files that it left ``'unchanged'``.
+write_stats = collections.Counter()
+
 
 def rel(path, parent=None, nopar=False):
   """
@@ -70,6 +78,8 @@ def canonical(path):
     path = path.lower()
   return path
 
+@trace.traced('glob', 'io', lambda patterns, parent=None, *args, **kwargs:
+    {'patterns': patterns, 'parent': parent})
 def glob(patterns, parent=None, excludes=(), include_dotfiles=False, ignore_false_excludes=False):
   """
   Wrapper for :func:`glob2.glob` that accepts an arbitrary number of
@@ -431,3 +441,66 @@ def getimtime(path):
   """
 
   return int(getmtime(path))
+
+
+def write_if_changed(filename, content, mode=None, encoding='utf8'):
+  """
+  Writes *content* to *filename* only if the file does not already exist
+  with the same content, so that its modification time is preserved and
+  Ninja does not consider dependent targets dirty. The file is written to a
+  temporary file in the same directory first and then renamed, thus readers
+  never see a partially written file.
+
+  :param filename: The file to write. The parent directory is created if
+    it does not exist.
+  :param content: A :class:`str` or :class:`bytes` object.
+  :param mode: If specified, the file permissions are set to this mode
+    (also if the content did not change).
+  :param encoding: The encoding used if *content* is a string.
+  :return: True if the file was written, False if it was unchanged.
+  """
+
+  if isinstance(content, str):
+    content = content.encode(encoding)
+
+  try:
+    with open(filename, 'rb') as fp:
+      current = hashlib.sha1(fp.read()).digest()
+      current_mode = os.fstat(fp.fileno()).st_mode & 0o7777
+  except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+    current = current_mode = None
+
+  if current == hashlib.sha1(content).digest():
+    if mode is not None and current_mode != mode:
+      os.chmod(filename, mode)
+    write_stats['unchanged'] += 1
+    return False
+
+  if mode is None:
+    mode = current_mode
+
+  directory = dirname(abs(filename))
+  makedirs(directory)
+  # Without a mode, the temporary file gets the permissions that open()
+  # would have used (0666 minus the umask, which is applied by the OS).
+  flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+  while True:
+    tempname = join(directory, '.{}.{}.tmp'.format(basename(filename),
+        binascii.hexlify(os.urandom(6)).decode()))
+    try:
+      fd = os.open(tempname, flags, 0o666 if mode is None else 0o600)
+      break
+    except FileExistsError:
+      pass
+  try:
+    with os.fdopen(fd, 'wb') as fp:
+      fp.write(content)
+    if mode is not None:
+      os.chmod(tempname, mode)
+    os.replace(tempname, filename)
+  except BaseException:
+    remove(tempname, silent=True)
+    raise
+
+  write_stats['written'] += 1
+  return True
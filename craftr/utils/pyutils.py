@@ -15,9 +15,25 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import contextlib
+import errno
+import os
 import sys
 from craftr.utils import shell
 
+#: The ``FICLONE`` ioctl of Linux that creates a copy-on-write clone of a
+#: file on file systems that support it (eg. Btrfs, XFS).
+FICLONE = 0x40049409
+
+#: The number of bytes copied by one call to :func:`os.copy_file_range` or
+#: :func:`os.sendfile` in :func:`copyfile`.
+COPY_CHUNKSIZE = 8 * 1024 * 1024
+
+#: Errors that indicate that a copy method is not supported for the files,
+#: upon which :func:`copyfile` tries the next method.
+_COPY_UNSUPPORTED = frozenset(filter(None, [errno.EXDEV, errno.ENOSYS,
+    errno.EINVAL, errno.EBADF, errno.EPERM, errno.ENOTTY,
+    getattr(errno, 'EOPNOTSUPP', None), getattr(errno, 'ENOTSUP', None)]))
+
 
 def flatten(iterable):
   """
@@ -152,17 +168,121 @@ def copyfileobj(sfp, dfp, size=None, chunksize=4096):
 
   if size is None:
     pos = sfp.tell()
-    sfp.seek(os.SEEK_END)
+    sfp.seek(0, os.SEEK_END)
     size = sfp.tell()
     sfp.seek(pos)
 
   bytes_copied = 0
   while True:
     yield bytes_copied, size
-    data = dfp.read(chunksize)
+    data = sfp.read(chunksize)
     if not data:
       break
-    written = sfp.write(data)
+    written = dfp.write(data)
     if written is not None and written != len(data):
       raise IOError('wrote {} of {} bytes'.format(written, len(data)))
     bytes_copied += len(data)
+
+
+def _copy_kernel(copy, sfd, dfd, size):
+  """
+  *Private*. Copies *size* bytes with *copy*, which is a wrapper for
+  :func:`os.copy_file_range` or :func:`os.sendfile`, and yields the
+  progress. Raises :class:`NotImplementedError` if the first call fails
+  because the method is not supported for the files.
+  """
+
+  bytes_copied = 0
+  while bytes_copied < size:
+    try:
+      count = copy(sfd, dfd, min(COPY_CHUNKSIZE, size - bytes_copied), bytes_copied)
+    except OSError as exc:
+      if bytes_copied == 0 and exc.errno in _COPY_UNSUPPORTED:
+        raise NotImplementedError(exc)
+      raise
+    if count == 0:
+      break  # the file was truncated while it was copied
+    bytes_copied += count
+    yield bytes_copied, size
+
+
+def copyfile(source, dest, link=False, chunksize=1024 * 1024):
+  """
+  Generator that copies the file *source* to *dest* and yields the
+  progress as ``(bytes_copied, size)`` tuples like :func:`copyfileobj`.
+  The first method that the platform and file system support is used:
+
+  1. a hard link if *link* is True (only for files that are not modified
+     afterwards, eg. from a read-only mirror),
+  2. a copy-on-write clone (``FICLONE`` on Linux),
+  3. :func:`os.copy_file_range`, which copies in the kernel and may be
+     offloaded to the file system or the server of a network file system,
+  4. :func:`os.sendfile` (Linux),
+  5. :func:`copyfileobj` with *chunksize* bytes per read.
+  """
+
+  if link:
+    try:
+      if os.path.lexists(dest):
+        os.remove(dest)
+      os.link(source, dest)
+    except OSError:
+      pass
+    else:
+      size = os.path.getsize(dest)
+      yield size, size
+      return
+
+  with open(source, 'rb') as sfp, open(dest, 'wb') as dfp:
+    size = os.fstat(sfp.fileno()).st_size
+    yield 0, size
+    sfd, dfd = sfp.fileno(), dfp.fileno()
+
+    if sys.platform.startswith('linux'):
+      import fcntl
+      try:
+        fcntl.ioctl(dfd, FICLONE, sfd)
+      except OSError:
+        pass
+      else:
+        yield size, size
+        return
+
+    methods = []
+    if hasattr(os, 'copy_file_range'):
+      methods.append(lambda sfd, dfd, count, offset:
+          os.copy_file_range(sfd, dfd, count, offset, offset))
+    if sys.platform.startswith('linux') and hasattr(os, 'sendfile'):
+      methods.append(lambda sfd, dfd, count, offset:
+          os.sendfile(dfd, sfd, offset, count))
+    for copy in methods:
+      try:
+        yield from _copy_kernel(copy, sfd, dfd, size)
+      except NotImplementedError:
+        continue
+      return
+
+    for progress in copyfileobj(sfp, dfp, size, chunksize):
+      yield progress
+
+
+def parse_size(value):
+  """
+  Parses a size specification like ``512M`` or ``10G`` and returns the
+  number of bytes. Supported suffixes are ``K``, ``M``, ``G`` and ``T``
+  (powers of 1024). A plain number is interpreted as bytes.
+
+  :raise ValueError: If *value* is not a valid size specification.
+  """
+
+  value = value.strip().upper().rstrip('B')
+  factor = 1
+  for index, suffix in enumerate('KMGT'):
+    if value.endswith(suffix):
+      factor = 1024 ** (index + 1)
+      value = value[:-1]
+      break
+  try:
+    return int(float(value) * factor)
+  except ValueError:
+    raise ValueError('invalid size: {!r}'.format(value))
@@ -14,15 +14,37 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import os
 import re
 import shlex
 import subprocess
 import sys
+import threading
+import time
 
 from . import path
+from craftr.core import trace
+from concurrent.futures import ThreadPoolExecutor, wait
 from subprocess import PIPE, STDOUT
 
+#: The filename of the persistent :func:`find_program` cache in the build
+#: directory, see :func:`load_program_cache`.
+PROGRAM_CACHE_FILENAME = '.craftr-programs.json'
+
+#: Maps ``(name, PATH, PATHEXT)`` to a tuple of the result of
+#: :func:`find_program` (:const:`None` if the program was not found) and a
+#: list of ``(directory, mtime)`` tuples for the directories that have been
+#: searched.
+_program_cache = {}
+
+#: The maximum number of processes started concurrently by :func:`run_async`
+#: and :func:`pipe_async`, see :func:`submit`.
+MAX_WORKERS = max(4, (os.cpu_count() or 1) * 2)
+
+_executor = None
+_executor_lock = threading.Lock()
+
 class safe(str):
   """
   If this object is passed to `quote()`, it will not be escaped.
@@ -95,6 +117,11 @@ def find_program(name):
   environment variable and returns the full absolute path to it. On Windows,
   this also takes the `PATHEXT` variable into account.
 
+  The result is cached for the values of ``PATH`` and ``PATHEXT``. A cached
+  result is used as long as the modification time of the directories in
+  which the program has been searched did not change, ie. no file has been
+  added to, removed from or renamed in them.
+
   :param name: The name of the program to find.
   :return: :class:`str` -- The absolute path to the program.
   :raise FileNotFoundError: If the program could not be found in the PATH.
@@ -126,20 +153,86 @@ def find_program(name):
     pathext = []
   pathext.insert(0, None)
 
+  dirnames = os.environ['PATH'].split(path.pathsep)
+  key = (name, os.environ['PATH'], os.environ.get('PATHEXT', ''))
+  entry = _program_cache.get(key)
+  if entry is not None and all(_mtime(d) == m for d, m in entry[1]):
+    if entry[0] is None:
+      raise FileNotFoundError(name)
+    return entry[0]
+
+  # The modification time of every directory is read before it is searched,
+  # thus a file that is added during the search invalidates the result.
+  searched = []
   first_candidate = None
-  for dirname in os.environ['PATH'].split(path.pathsep):
+  result = None
+  for dirname in dirnames:
+    mtime = _mtime(dirname)
+    searched.append((dirname, mtime))
+    if mtime is None:
+      continue
     fullname = path.join(dirname, name)
     for ext in pathext:
       extname = (fullname + ext) if ext else fullname
       if path.isfile(extname):
         if os.access(extname, os.X_OK):
-          return extname
+          result = extname
+          break
         if first_candidate is None:
           first_candidate = extname
+    if result:
+      break
 
-  if first_candidate:
+  if first_candidate and not result:
     raise PermissionError('{0!r} is not executable'.format(first_candidate))
-  raise FileNotFoundError(name)
+
+  # Relative directories in the PATH depend on the working directory. A
+  # directory that has been modified just now could be modified again
+  # without changing its timestamp, which has only a limited resolution.
+  racy = int((time.time() - 2) * 1e9)
+  if all(path.isabs(x) for x in dirnames) and \
+      all(m is None or m < racy for d, m in searched):
+    _program_cache[key] = (result, searched)
+  if not result:
+    raise FileNotFoundError(name)
+  return result
+
+
+def _mtime(dirname):
+  try:
+    return os.stat(dirname).st_mtime_ns
+  except OSError:
+    return None
+
+
+def load_program_cache(filename):
+  """
+  Loads the :func:`find_program` cache from *filename* that has been
+  written with :func:`save_program_cache`, usually the
+  :data:`PROGRAM_CACHE_FILENAME` in the build directory. Entries are still
+  checked for modified directories before they are used. Does nothing if
+  the file does not exist or is invalid.
+  """
+
+  try:
+    with open(filename) as fp:
+      data = json.load(fp)
+    entries = {tuple(k): (r, [tuple(x) for x in s]) for k, r, s in data}
+  except (OSError, ValueError, TypeError):
+    return
+  for key, entry in entries.items():
+    _program_cache.setdefault(key, entry)
+
+
+def save_program_cache(filename):
+  """
+  Saves the :func:`find_program` cache to *filename*. The file is only
+  written if its content changed.
+  """
+
+  data = [[list(k), r, [list(x) for x in s]] for k, (r, s) in sorted(
+      _program_cache.items(), key=lambda x: x[0])]
+  path.write_if_changed(filename, json.dumps(data, indent=1))
 
 
 def test_program(name):
@@ -249,25 +342,11 @@ class CompletedProcess(object):
       raise CalledProcessError(self)
 
 
-def run(cmd, *, stdin=None, input=None, stdout=None, stderr=None, shell=False,
-    timeout=None, check=False, cwd=None, env=None, encoding=sys.getdefaultencoding()):
+def _prepare(cmd, shell, env):
   """
-  Run the process with the specified *cmd*. If *cmd* is a list of
-  commands and *shell* is True, the list will be automatically converted
-  to a properly escaped string for the shell to execute.
-
-  .. note::
-
-    If "shell" is True, this function will manually check if the file
-    exists and is executable first and raise :class:`FileNotFoundError`
-    if not.
-
-  :raise CalledProcessError: If *check* is True and the process exited with
-    a non-zero exit-code.
-  :raise TimeoutExpired: If *timeout* was specified and the process did not
-    finish before the timeout expires.
-  :raise OSError: For some OS-level error, eg. if the program could not be
-      found.
+  Converts *cmd* into the representation required for *shell*, merges *env*
+  into the current environment and checks that the program exists if the
+  command is executed in a shell. Used by :func:`run`.
   """
 
   if shell and not isinstance(cmd, str):
@@ -291,6 +370,47 @@ def run(cmd, *, stdin=None, input=None, stdout=None, stderr=None, shell=False,
       program = cmd[0]
     find_program(program)
 
+  return cmd, env
+
+
+def _fix_os_error(exc, cmd):
+  if not exc.filename and os.name == 'nt':
+    # Windows does not include the name of the file with which
+    # the error occured in the exception message.
+    if isinstance(cmd, str):
+      program = split(cmd)[0]
+    else:
+      program = cmd[0]
+    exc.filename = program
+
+
+@trace.traced('shell.run', 'subprocess', lambda cmd, *args, **kwargs:
+    {'cmd': cmd if isinstance(cmd, str) else join(cmd)})
+def run(cmd, *, stdin=None, input=None, stdout=None, stderr=None, shell=False,
+    timeout=None, check=False, cwd=None, env=None, encoding=sys.getdefaultencoding()):
+  """
+  Run the process with the specified *cmd*. If *cmd* is a list of
+  commands and *shell* is True, the list will be automatically converted
+  to a properly escaped string for the shell to execute.
+
+  .. note::
+
+    If "shell" is True, this function will manually check if the file
+    exists and is executable first and raise :class:`FileNotFoundError`
+    if not.
+
+  :raise CalledProcessError: If *check* is True and the process exited with
+    a non-zero exit-code.
+  :raise TimeoutExpired: If *timeout* was specified and the process did not
+    finish before the timeout expires.
+  :raise OSError: For some OS-level error, eg. if the program could not be
+      found.
+  """
+
+  cmd, env = _prepare(cmd, shell, env)
+  if input is not None and stdin is None:
+    stdin = PIPE
+
   try:
     popen = subprocess.Popen(
       cmd, stdin=stdin, stdout=stdout, stderr=stderr, shell=shell,
@@ -303,14 +423,7 @@ def run(cmd, *, stdin=None, input=None, stdout=None, stderr=None, shell=False,
     process.decode(encoding)
     raise TimeoutExpired(process, timeout)
   except OSError as exc:
-    if not exc.filename and os.name == 'nt':
-      # Windows does not include the name of the file with which
-      # the error occured in the exception message.
-      if isinstance(cmd, str):
-        program = split(cmd)[0]
-      else:
-        program = cmd[0]
-      exc.filename = program
+    _fix_os_error(exc, cmd)
     raise
 
   process = CompletedProcess(cmd, popen.returncode, stdout, stderr)
@@ -320,6 +433,72 @@ def run(cmd, *, stdin=None, input=None, stdout=None, stderr=None, shell=False,
   return process
 
 
+def _get_executor():
+  global _executor
+  with _executor_lock:
+    if _executor is None:
+      _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    return _executor
+
+
+def submit(func, *args, **kwargs):
+  """
+  Calls *func* with the specified arguments in a thread of a pool that is
+  shared by the whole process and returns a :class:`concurrent.futures.Future`
+  for its result. The function should spend its time waiting for
+  subprocesses, eg. by calling :func:`run` or :func:`pipe`, and must not
+  wait for other functions submitted to the pool.
+  """
+
+  return _get_executor().submit(func, *args, **kwargs)
+
+
+def run_async(*args, **kwargs):
+  """
+  Starts :func:`run` with the specified arguments in the background, see
+  :func:`submit`, and returns a :class:`concurrent.futures.Future` for the
+  :class:`CompletedProcess`. Use :func:`gather` to wait for the result of
+  multiple processes.
+  """
+
+  return submit(run, *args, **kwargs)
+
+
+def pipe_async(*args, **kwargs):
+  """
+  Like :func:`run_async`, but pipes stdout and stderr to a buffer, see
+  :func:`pipe`.
+  """
+
+  return submit(pipe, *args, **kwargs)
+
+
+def gather(*futures, return_exceptions=False):
+  """
+  Waits for the :class:`concurrent.futures.Future` objects *futures*,
+  usually returned by :func:`run_async`, :func:`pipe_async` or
+  :func:`submit`, and returns the list of their results.
+
+  .. code:: python
+
+    cc, cxx = shell.gather(shell.pipe_async(['gcc', '-v']),
+                           shell.pipe_async(['g++', '-v']))
+
+  :param return_exceptions: If True, exceptions are returned in the
+    result list instead of being raised. Otherwise, the exception of the
+    first future that failed is raised after all futures completed.
+  """
+
+  wait(futures)
+  results = []
+  for future in futures:
+    exc = future.exception()
+    if exc is not None and not return_exceptions:
+      raise exc
+    results.append(future.result() if exc is None else exc)
+  return results
+
+
 def pipe(*args, merge=True, **kwargs):
   """
   Like `run()`, but pipes stdout and stderr to a buffer instead of
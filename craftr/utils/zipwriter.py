@@ -0,0 +1,345 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.utils.zipwriter`
+=============================
+
+Writes ZIP archives for the ``craftr.utils.archive`` module. The members
+are compressed in parallel by a process pool into temporary files, which
+are then concatenated with their headers and followed by the central
+directory.
+
+The archives are deterministic: the members are ordered by their name,
+all have the same timestamp and only the executable bit of their
+permissions is kept. An index file next to the archive records the size,
+modification time and SHA-256 checksum of every member. When the archive
+is written again, the compressed data of the members whose file did not
+change is copied from the previous archive, and if no member changed,
+the archive is not written at all.
+"""
+
+from craftr.utils import argspec
+from craftr.utils import path
+
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+import zlib
+
+#: The timestamp of all members.
+DEFAULT_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+#: The suffix of the index file that is written next to the archive.
+INDEX_SUFFIX = '.index.json'
+
+#: Changing this value invalidates the index of existing archives.
+INDEX_VERSION = 2
+
+CHUNKSIZE = 1024 * 1024
+
+COMPRESSION_METHODS = {
+  'stored': zipfile.ZIP_STORED,
+  'deflated': zipfile.ZIP_DEFLATED
+}
+
+ZIP64_LIMIT = 0xFFFFFFFF
+
+
+class _Member(object):
+
+  def __init__(self, name, arc_name):
+    self.name = name
+    self.arc_name = arc_name
+    self.size = None
+    self.mtime_ns = None
+    self.executable = None
+    self.sha256 = None
+    self.crc = None
+    self.compress_size = None
+    self.tempname = None  # the compressed data, if not in the old archive
+    self.old_offset = None  # the offset of the data in the old archive
+    self.offset = None
+
+  def to_json(self):
+    return {'arc_name': self.arc_name, 'name': self.name, 'size': self.size, 'mtime_ns': self.mtime_ns,
+        'executable': self.executable, 'sha256': self.sha256, 'crc': self.crc,
+        'compress_size': self.compress_size}
+
+
+def _hash_file(filename):
+  hasher = hashlib.sha256()
+  with open(filename, 'rb') as fp:
+    for chunk in iter(lambda: fp.read(CHUNKSIZE), b''):
+      hasher.update(chunk)
+  return hasher.hexdigest()
+
+
+def compress_file(filename, tempname, method, compresslevel, expected_sha256=None):
+  """
+  Compresses the file *filename* into the file *tempname* as raw data for
+  a ZIP member with the specified *method*. Returns a tuple of the SHA-256
+  checksum, the CRC-32, the size and the compressed size. If
+  *expected_sha256* is specified and matches the content of the file, it
+  is not compressed and only the checksum is returned. Runs in the
+  processes of the pool used by :func:`write_zip`.
+  """
+
+  if expected_sha256 and _hash_file(filename) == expected_sha256:
+    return expected_sha256, None, None, None
+
+  hasher = hashlib.sha256()
+  crc = 0
+  size = 0
+  if method == zipfile.ZIP_DEFLATED:
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+  else:
+    compressor = None
+  with open(filename, 'rb') as sfp, open(tempname, 'wb') as dfp:
+    for chunk in iter(lambda: sfp.read(CHUNKSIZE), b''):
+      hasher.update(chunk)
+      crc = zlib.crc32(chunk, crc)
+      size += len(chunk)
+      dfp.write(compressor.compress(chunk) if compressor else chunk)
+    if compressor:
+      dfp.write(compressor.flush())
+    compress_size = dfp.tell()
+  return hasher.hexdigest(), crc, size, compress_size
+
+
+def _compress_batch(batch):
+  # Compresses a list of argument tuples for compress_file() in one task
+  # of the process pool (Executor.map() only supports chunks since 3.5).
+  return [compress_file(*args) for args in batch]
+
+
+def _dos_date_time(date_time):
+  year, month, day, hour, minute, second = date_time
+  return ((hour << 11) | (minute << 5) | (second // 2),
+      ((year - 1980) << 9) | (month << 5) | day)
+
+
+def _name_flags(arc_name):
+  # Bit 11 marks names that are encoded with UTF-8.
+  try:
+    arc_name.encode('ascii')
+  except UnicodeEncodeError:
+    return 0x800
+  return 0
+
+
+def _local_header(member, method, date_time):
+  name = member.arc_name.encode('utf8')
+  flags = _name_flags(member.arc_name)
+  time, date = _dos_date_time(date_time)
+  size, compress_size, extra = member.size, member.compress_size, b''
+  zip64 = size >= ZIP64_LIMIT or compress_size >= ZIP64_LIMIT
+  if zip64:
+    extra = struct.pack('<HHQQ', 1, 16, size, compress_size)
+    size = compress_size = ZIP64_LIMIT
+  return struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, flags,
+      method, time, date, member.crc, compress_size, size, len(name),
+      len(extra)) + name + extra
+
+
+def _central_header(member, method, date_time):
+  name = member.arc_name.encode('utf8')
+  flags = _name_flags(member.arc_name)
+  time, date = _dos_date_time(date_time)
+  fields = []
+  size, compress_size, offset = member.size, member.compress_size, member.offset
+  if size >= ZIP64_LIMIT:
+    fields.append(size)
+    size = ZIP64_LIMIT
+  if compress_size >= ZIP64_LIMIT:
+    fields.append(compress_size)
+    compress_size = ZIP64_LIMIT
+  if offset >= ZIP64_LIMIT:
+    fields.append(offset)
+    offset = ZIP64_LIMIT
+  extra = struct.pack('<HH' + 'Q' * len(fields), 1, 8 * len(fields), *fields) if fields else b''
+  version = 45 if fields else 20
+  mode = 0o100755 if member.executable else 0o100644
+  return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version,
+      version, flags, method, time, date, member.crc, compress_size, size,
+      len(name), len(extra), 0, 0, 0, mode << 16, offset) + name + extra
+
+
+def _end_record(count, cd_offset, cd_size, offset):
+  data = b''
+  if count >= 0xFFFF or cd_offset >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+    data += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count,
+        count, cd_size, cd_offset)
+    data += struct.pack('<IIQI', 0x07064b50, 0, offset, 1)
+  return data + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF),
+      min(count, 0xFFFF), min(cd_size, ZIP64_LIMIT), min(cd_offset, ZIP64_LIMIT), 0)
+
+
+def _read_index(filename, settings):
+  """
+  Reads the index of the archive *filename* and returns an ordered
+  dictionary that maps the names of its members to their entries, including
+  the offset of their data in the archive, in the order of the archive.
+  Returns an empty dictionary if the index does not exist, was written with
+  other *settings* or does not match the archive.
+  """
+
+  try:
+    with open(filename + INDEX_SUFFIX) as fp:
+      index = json.load(fp)
+    if index.get('settings') != settings:
+      return {}
+    # The members are stored as a list in the order of the archive, the
+    # order of a JSON object is not preserved before Python 3.6.
+    entries = collections.OrderedDict((x['arc_name'], x) for x in index['members'])
+    with zipfile.ZipFile(filename) as zf, open(filename, 'rb') as fp:
+      infos = zf.infolist()
+      if [x.filename for x in infos] != list(entries):
+        return {}
+      for info in infos:
+        entry = entries[info.filename]
+        if (info.CRC, info.compress_size) != (entry['crc'], entry['compress_size']):
+          return {}
+        fp.seek(info.header_offset)
+        header = fp.read(30)
+        if header[:4] != b'PK\x03\x04':
+          return {}
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        entry['offset'] = info.header_offset + 30 + name_length + extra_length
+    return entries
+  except (OSError, ValueError, KeyError, TypeError, zipfile.BadZipFile):
+    return {}
+
+
+def _copy_range(sfp, dfp, offset, size):
+  sfp.seek(offset)
+  while size > 0:
+    data = sfp.read(min(CHUNKSIZE, size))
+    if not data:
+      raise EOFError('unexpected end of the previous archive')
+    dfp.write(data)
+    size -= len(data)
+
+
+def write_zip(filename, members, jobs=None, compression='deflated',
+    compresslevel=6, incremental=True, date_time=DEFAULT_DATE_TIME):
+  """
+  Writes a ZIP archive to *filename*.
+
+  :param members: A list of tuples of the filename and the name of a
+    member in the archive.
+  :param jobs: The number of processes that compress the members.
+    Defaults to the number of CPUs.
+  :param compression: ``'deflated'`` or ``'stored'``.
+  :param compresslevel: The :mod:`zlib` compression level.
+  :param incremental: Copy the compressed data of the members that did not
+    change from the previous archive. If False, all members are compressed
+    again.
+  :param date_time: The timestamp of all members.
+  :raise ValueError: If a member name is used more than once.
+  :return: True if the archive was written, False if it did not change.
+  """
+
+  argspec.validate('compression', compression, {'enum': list(COMPRESSION_METHODS)})
+  method = COMPRESSION_METHODS[compression]
+  members = [_Member(path.norm(name), arc_name) for name, arc_name in members]
+  members.sort(key=lambda x: x.arc_name)
+  for prev, member in zip(members, members[1:]):
+    if prev.arc_name == member.arc_name:
+      raise ValueError('duplicate member name: {!r}'.format(member.arc_name))
+
+  settings = {'version': INDEX_VERSION, 'method': method,
+      'compresslevel': compresslevel, 'date_time': list(date_time)}
+  old_entries = _read_index(filename, settings) if incremental else {}
+
+  # Decide which members need to be compressed.
+  pending = []
+  for member in members:
+    st = os.stat(member.name)
+    member.size = st.st_size
+    member.mtime_ns = st.st_mtime_ns
+    member.executable = bool(st.st_mode & 0o111)
+    entry = old_entries.get(member.arc_name)
+    expected_sha256 = None
+    if entry and entry['name'] == member.name and entry['size'] == member.size:
+      member.sha256 = entry['sha256']
+      member.crc = entry['crc']
+      member.compress_size = entry['compress_size']
+      member.old_offset = entry['offset']
+      if entry['mtime_ns'] == member.mtime_ns:
+        continue
+      expected_sha256 = entry['sha256']
+    pending.append((member, expected_sha256))
+
+  tempdir = tempfile.mkdtemp(prefix='.zipwriter-', dir=path.dirname(path.norm(filename)))
+  try:
+    if pending:
+      args = [(member.name, path.join(tempdir, str(index)), method,
+          compresslevel, expected_sha256)
+          for index, (member, expected_sha256) in enumerate(pending)]
+      jobs = min(jobs or os.cpu_count() or 1, len(pending))
+      if jobs > 1:
+        chunksize = max(1, len(args) // (jobs * 4))
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+          futures = [executor.submit(_compress_batch, args[i:i + chunksize])
+              for i in range(0, len(args), chunksize)]
+          results = [x for future in futures for x in future.result()]
+      else:
+        results = _compress_batch(args)
+      for (member, expected_sha256), item, result in zip(pending, args, results):
+        member.sha256 = result[0]
+        if result[1] is not None:
+          member.crc, member.size, member.compress_size = result[1:]
+          member.tempname = item[1]
+          member.old_offset = None
+
+    unchanged = path.isfile(filename) and \
+        list(old_entries) == [x.arc_name for x in members] and \
+        all(x.tempname is None and x.executable == old_entries[x.arc_name]['executable']
+            for x in members)
+
+    if not unchanged:
+      tempname = path.join(tempdir, 'archive.zip')
+      reuse = any(x.old_offset is not None for x in members)
+      with open(tempname, 'wb') as fp, \
+          (open(filename, 'rb') if reuse else open(os.devnull, 'rb')) as old_fp:
+        for member in members:
+          member.offset = fp.tell()
+          fp.write(_local_header(member, method, date_time))
+          if member.tempname:
+            with open(member.tempname, 'rb') as sfp:
+              shutil.copyfileobj(sfp, fp, CHUNKSIZE)
+          else:
+            _copy_range(old_fp, fp, member.old_offset, member.compress_size)
+        cd_offset = fp.tell()
+        for member in members:
+          fp.write(_central_header(member, method, date_time))
+        fp.write(_end_record(len(members), cd_offset, fp.tell() - cd_offset, fp.tell()))
+      os.replace(tempname, filename)
+
+    # The index is updated in any case as modification times may have changed.
+    index = {'settings': settings, 'members': [x.to_json() for x in members]}
+    path.write_if_changed(filename + INDEX_SUFFIX,
+        json.dumps(index, indent=2, sort_keys=True))
+  finally:
+    shutil.rmtree(tempdir, ignore_errors=True)
+
+  return not unchanged
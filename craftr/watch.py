@@ -0,0 +1,339 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.watch`
+===================
+
+Change detection for ``craftr watch``. The directories that contain the
+build scripts, the globbed directories, the inputs of all targets and the
+dependencies that Ninja discovered from depfiles (eg. headers, see
+:func:`read_ninja_deps`) are watched with the Linux inotify API (through
+:mod:`ctypes`, no polling is involved). A burst of events, as produced by editors that save a file by
+writing a temporary file and renaming it, is collected into a single set
+of changes which :meth:`WatchState.classify` maps to either a re-export or
+a list of the targets that have to be rebuilt.
+"""
+
+from craftr.utils import path, shell
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+#: The events that files are added to or removed from a directory.
+STRUCTURE_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+WATCH_MASK = IN_CLOSE_WRITE | STRUCTURE_EVENTS | IN_DELETE_SELF | \
+    IN_MOVE_SELF | IN_ONLYDIR
+
+_event_header = struct.Struct('iIII')
+
+
+class Inotify(object):
+  """
+  A minimal wrapper for the inotify API that watches directories (not
+  individual files, as these are replaced by most editors when saving).
+
+  :raise OSError: If inotify is not available on the platform.
+  """
+
+  def __init__(self):
+    if not sys.platform.startswith('linux'):
+      raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+    self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      code = ctypes.get_errno()
+      raise OSError(code, 'inotify_init1(): ' + os.strerror(code))
+    self.directories = {}  # maps directory: watch descriptor
+    self._watches = {}  # maps watch descriptor: directory
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    if self.fd >= 0:
+      os.close(self.fd)
+      self.fd = -1
+
+  def update(self, directories):
+    """
+    Watches exactly the specified *directories*. Directories that do not
+    exist are ignored.
+    """
+
+    directories = set(directories)
+    for directory in set(self.directories) - directories:
+      self._libc.inotify_rm_watch(self.fd, self.directories.pop(directory))
+    for directory in directories - set(self.directories):
+      wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+      if wd < 0:
+        code = ctypes.get_errno()
+        if code in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+          continue
+        raise OSError(code, 'inotify_add_watch(): ' + os.strerror(code), directory)
+      self.directories[directory] = wd
+      self._watches[wd] = directory
+
+  def read(self, timeout=None):
+    """
+    Waits at most *timeout* seconds for events and returns a list of
+    ``(mask, filename)`` tuples. If the event queue overflowed, the filename
+    is :const:`None`.
+    """
+
+    if not select.select([self.fd], [], [], timeout)[0]:
+      return []
+    try:
+      data = os.read(self.fd, 64 * 1024)
+    except BlockingIOError:
+      return []
+
+    events = []
+    offset = 0
+    while offset < len(data):
+      wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+      offset += _event_header.size
+      name = os.fsdecode(data[offset:offset+length].rstrip(b'\0'))
+      offset += length
+      if mask & IN_Q_OVERFLOW:
+        events.append((mask, None))
+        continue
+      directory = self._watches.get(wd)
+      if directory is None:
+        continue
+      if mask & IN_IGNORED:
+        del self._watches[wd]
+        if self.directories.get(directory) == wd:
+          del self.directories[directory]
+        continue
+      events.append((mask, path.join(directory, name) if name else directory))
+    return events
+
+  def wait(self, debounce):
+    """
+    Blocks until at least one event occurs and then collects events until
+    there was none for *debounce* seconds. Returns a dictionary that maps
+    filenames to the combined event masks.
+    """
+
+    changes = collections.defaultdict(int)
+    timeout = None
+    while True:
+      events = self.read(timeout)
+      if not events and timeout is not None:
+        return dict(changes)
+      for mask, filename in events:
+        changes[filename] |= mask
+      timeout = debounce
+
+
+def glob_base(pattern):
+  """
+  Returns the directory that a glob *pattern* is rooted in and whether the
+  pattern matches recursively (contains ``**``).
+  """
+
+  parts = path.norm(pattern).split(os.sep)
+  for index, part in enumerate(parts):
+    if path.isglob(part):
+      break
+  else:
+    index = len(parts) - 1
+  return os.sep.join(parts[:index]) or os.sep, '**' in parts[index:]
+
+
+def glob_directories(patterns, exclude=None):
+  """
+  Returns the set of directories in which files need to be added or removed
+  to change the result of globbing the *patterns*. Hidden directories and
+  the directory *exclude* are skipped for recursive patterns.
+  """
+
+  result = set()
+  for pattern in patterns:
+    directory, recursive = glob_base(pattern)
+    result.add(directory)
+    if recursive:
+      for root, dirs, files in os.walk(directory):
+        dirs[:] = [x for x in dirs if not x.startswith('.') and
+            path.join(root, x) != exclude]
+        result.update(path.join(root, x) for x in dirs)
+  return result
+
+
+def parse_ninja_deps(text, builddir):
+  """
+  Parses the output of ``ninja -t deps`` and returns the set of absolute
+  filenames of the dependencies that are listed for any output. Relative
+  filenames are relative to the *builddir*.
+  """
+
+  result = set()
+  for line in text.splitlines():
+    # Outputs start at the beginning of the line, their dependencies
+    # are indented.
+    if line[:1].isspace() and line.strip():
+      result.add(path.norm(line.strip(), builddir))
+  return result
+
+
+def read_ninja_deps(ninja_bin, builddir):
+  """
+  Returns the dependencies recorded in the ``.ninja_deps`` file of the
+  *builddir* (see :func:`parse_ninja_deps`). These are only known for
+  targets with ``deps='gcc'`` or ``deps='msvc'`` that have been built at
+  least once. Returns an empty set if Ninja can not be invoked.
+  """
+
+  try:
+    output = shell.pipe([ninja_bin, '-t', 'deps'], cwd=builddir, merge=False,
+        check=True).stdout
+  except (OSError, shell.CalledProcessError):
+    return set()
+  return parse_ninja_deps(output, builddir)
+
+
+class WatchState(object):
+  """
+  The files of an exported project that are watched for changes.
+
+  :param modules: A list of the :class:`~craftr.core.session.Module`
+    objects that have been executed.
+  :param graph: The exported :class:`~craftr.core.build.Graph`.
+  :param target_deps: A dictionary that maps every target name to the
+    names of the targets it depends on.
+  :param builddir: The build directory. Changes in it are ignored.
+
+  .. attribute:: discovered
+
+    The set of files that Ninja discovered as dependencies of the targets,
+    see :func:`read_ninja_deps`. It must be updated after every build.
+  """
+
+  def __init__(self, modules, graph, target_deps, builddir):
+    self.builddir = path.norm(builddir)
+    self.definition_files = set()
+    self.glob_patterns = []
+    for module in modules:
+      self.definition_files.update(map(path.norm, module.dependent_files or ()))
+      self.glob_patterns.extend(module.glob_patterns or ())
+    self.globbed = self._glob()
+
+    self.inputs = collections.defaultdict(set)
+    for target in graph.targets.values():
+      for filename in target.inputs + target.implicit_deps:
+        if filename not in graph.outfiles and filename not in graph.targets:
+          self.inputs[path.norm(filename)].add(target.name)
+
+    self.dependents = collections.defaultdict(set)
+    for name, deps in target_deps.items():
+      for dep in deps:
+        self.dependents[dep].add(name)
+
+    self.glob_dirs = glob_directories(self.glob_patterns, self.builddir)
+    self.discovered = set()
+
+  def _glob(self):
+    return set(path.glob(self.glob_patterns)) if self.glob_patterns else set()
+
+  def _ignore(self, filename):
+    return filename == self.builddir or filename.startswith(self.builddir + os.sep)
+
+  @property
+  def directories(self):
+    """
+    The set of directories that need to be watched.
+    """
+
+    result = set(self.glob_dirs)
+    result.update(path.dirname(x) for x in self.definition_files)
+    result.update(path.dirname(x) for x in self.inputs)
+    result.update(path.dirname(x) for x in self.discovered)
+    return set(x for x in result if not self._ignore(x))
+
+  def classify(self, changes):
+    """
+    Decides what to do about the *changes* returned by :meth:`Inotify.wait`.
+    Returns a tuple of the action and the affected target names. The action
+    is ``'export'`` if a build definition changed or files were added to or
+    removed from a globbed directory, ``'build'`` if targets need to be
+    rebuilt or :const:`None` if the changes do not affect the build. The
+    target names are :const:`None` if all targets may be affected.
+    """
+
+    affected = set()
+    unknown = False
+    structure_changed = False
+    for filename, mask in changes.items():
+      if filename is None or filename in self.definition_files:
+        return 'export', None
+      if self._ignore(filename):
+        continue
+      if mask & (IN_DELETE_SELF | IN_MOVE_SELF) and filename in self.glob_dirs:
+        return 'export', None
+      if mask & STRUCTURE_EVENTS and path.dirname(filename) in self.glob_dirs:
+        if mask & IN_ISDIR:
+          return 'export', None
+        structure_changed = True
+      if filename in self.inputs:
+        affected.update(self.inputs[filename])
+      elif not self._is_temporary(filename) and path.exists(filename):
+        # Probably a header or another file that is only known to the
+        # compiler, Ninja knows from the depfiles what to rebuild.
+        unknown = True
+
+    if structure_changed and self._glob() != self.globbed:
+      return 'export', None
+    if unknown:
+      return 'build', None
+    if not affected:
+      return None, None
+
+    stack = list(affected)
+    while stack:
+      for name in self.dependents.get(stack.pop(), ()):
+        if name not in affected:
+          affected.add(name)
+          stack.append(name)
+    return 'build', sorted(affected)
+
+  @staticmethod
+  def _is_temporary(filename):
+    name = path.basename(filename)
+    return name.startswith('.') or name.endswith('~') or name.isdigit()
@@ -0,0 +1,150 @@
+
+from craftr.core import actioncache
+from os.path import join
+from shutil import rmtree, which
+from tempfile import mkdtemp
+from unittest import SkipTest
+
+import craftr
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+tempdir = None
+
+# Copies the input to the output and counts the invocations.
+COMPILER = '''
+import sys
+with open(sys.argv[1]) as src, open(sys.argv[2], 'w') as dst:
+  dst.write(src.read().upper())
+with open(sys.argv[3], 'a') as fp:
+  fp.write('compiled\\n')
+'''
+
+
+def setup_module():
+  global tempdir
+  tempdir = mkdtemp()
+
+
+def teardown_module():
+  rmtree(tempdir)
+
+
+def make_project(name, cache_dir, log):
+  project = join(tempdir, name)
+  os.makedirs(project)
+  with open(join(project, 'main.c'), 'w') as fp:
+    fp.write('int main() {}\n')
+  launcher = [sys.executable, '-m', 'craftr.core.actioncache', '--cache-dir',
+      cache_dir, '--map', project + '=@BUILDDIR@', '--inputs', '$in',
+      '--outputs', '$out', '--', sys.executable, join(tempdir, 'compiler.py'),
+      '$in', '$out', log]
+  command = ' '.join(x if x.startswith('$') else shlex.quote(x) for x in launcher)
+  with open(join(project, 'build.ninja'), 'w') as fp:
+    fp.write('rule cc\n  command = {}\n'.format(command))
+    fp.write('build main.o: cc main.c\n')
+  return project
+
+
+def ninja(project):
+  env = os.environ.copy()
+  env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(craftr.__file__)))
+  return subprocess.check_output([which('ninja')], cwd=project, env=env).decode()
+
+
+def count(log):
+  with open(log) as fp:
+    return fp.read().count('compiled')
+
+
+def test_hit_miss_restore():
+  if not which('ninja'):
+    raise SkipTest('ninja is not available')
+
+  with open(join(tempdir, 'compiler.py'), 'w') as fp:
+    fp.write(COMPILER)
+  cache_dir = join(tempdir, 'cache')
+  log = join(tempdir, 'compile.log')
+
+  # A miss executes the command and stores the output.
+  first = make_project('first', cache_dir, log)
+  ninja(first)
+  assert count(log) == 1
+  assert 'no work to do' in ninja(first)
+
+  # The same action in another build directory is restored from the cache,
+  # and the restored output is newer than its input.
+  time.sleep(0.01)
+  second = make_project('second', cache_dir, log)
+  ninja(second)
+  assert count(log) == 1
+  with open(join(second, 'main.o')) as fp:
+    assert fp.read() == 'INT MAIN() {}\n'
+  assert os.access(join(second, 'main.o'), os.W_OK)
+  assert 'no work to do' in ninja(second)
+
+  stats = actioncache.ActionCache(cache_dir).stats()
+  assert (stats['hits'], stats['misses']) == (1, 1)
+
+
+def test_gc():
+  cache = actioncache.ActionCache(join(tempdir, 'gc'))
+  filename = join(tempdir, 'output')
+  with open(filename, 'w') as fp:
+    fp.write('x' * 1000)
+
+  # Storing objects never removes other objects.
+  cache.put_object('aa', [filename], {'outputs': []})
+  old = time.time() - 10
+  os.utime(join(cache.directory, 'objects', 'aa', 'aa', 'meta.json'), (old, old))
+  cache.put_object('bb', [filename], {'outputs': []})
+  assert os.path.isdir(join(cache.directory, 'objects', 'aa', 'aa'))
+
+  cache.record('hit')
+  cache.record('miss')
+  assert cache.gc(1500)[0] == 1
+  assert cache.get_object('aa') is None
+  assert cache.get_object('bb') is not None
+
+  # The statistics log is summed up by the garbage collection.
+  assert not os.path.exists(join(cache.directory, 'stats.log'))
+  cache.record('hit')
+  stats = cache.stats()
+  assert (stats['entries'], stats['hits'], stats['misses']) == (1, 2, 1)
+
+
+def test_restore_removed_object():
+  with open(join(tempdir, 'compiler.py'), 'w') as fp:
+    fp.write(COMPILER)
+  cache_dir = join(tempdir, 'removed')
+  log = join(tempdir, 'removed.log')
+  source = join(tempdir, 'removed.c')
+  with open(source, 'w') as fp:
+    fp.write('int main() {}\n')
+
+  env = os.environ.copy()
+  env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(craftr.__file__)))
+  def launch(output):
+    subprocess.check_call([sys.executable, '-m', 'craftr.core.actioncache',
+        '--cache-dir', cache_dir, '--inputs', source, '--outputs', output,
+        '--', sys.executable, join(tempdir, 'compiler.py'), source, output,
+        log], env=env)
+
+  output = join(tempdir, 'removed.o')
+  launch(output)
+  assert count(log) == 1
+
+  # Remove the output file from the object as if "craftr cache gc" removed
+  # the object while it is restored, the action is executed instead.
+  objects = join(cache_dir, 'objects')
+  for root, dirs, files in os.walk(objects):
+    if '0' in files:
+      os.remove(join(root, '0'))
+  os.remove(output)
+  launch(output)
+  assert count(log) == 2
+  with open(output) as fp:
+    assert fp.read() == 'INT MAIN() {}\n'
@@ -0,0 +1,93 @@
+
+from craftr.core import archivecache
+from os.path import join
+from tempfile import mkdtemp
+
+import os
+import stat
+import threading
+import time
+
+tempdir = None
+
+
+def setup_module():
+  global tempdir
+  tempdir = mkdtemp()
+
+
+def teardown_module():
+  archivecache._remove_tree(tempdir)
+
+
+def test_download_and_tree():
+  cache = archivecache.ArchiveCache(join(tempdir, 'cache'))
+  key = cache.download_key('http://example.com/a.zip')
+  assert cache.download_key('http://example.com/a.zip', 'ABC') == 'abc'
+  assert cache.get_download(key) is None
+
+  filename = join(cache.download_dir(key), 'a.zip')
+  os.makedirs(cache.download_dir(key))
+  with open(filename, 'w') as fp:
+    fp.write('archive')
+  cache.put_download(key, 'http://example.com/a.zip', filename, 'xyz')
+  assert cache.get_download(key) == filename
+  archivecache.link_file(filename, join(tempdir, 'build', 'a.zip'))
+  with open(join(tempdir, 'build', 'a.zip')) as fp:
+    assert fp.read() == 'archive'
+
+  def extract(directory):
+    with open(join(directory, 'main.c'), 'w') as fp:
+      fp.write('int main() { }\n')
+
+  tree_key = cache.tree_key(key, ['*.txt'])
+  assert tree_key != cache.tree_key(key)
+  assert cache.get_tree(tree_key) is None
+  tree = cache.put_tree(tree_key, extract)
+  assert cache.get_tree(tree_key) == tree
+  assert not os.stat(join(tree, 'main.c')).st_mode & stat.S_IWUSR
+
+  link = join(tempdir, 'build', 'a')
+  os.makedirs(link)
+  archivecache.link_tree(tree, link)
+  with open(join(link, 'main.c')) as fp:
+    assert fp.read() == 'int main() { }\n'
+
+
+def test_prune():
+  cache = archivecache.ArchiveCache(join(tempdir, 'prune'))
+  for index, name in enumerate(['old', 'new']):
+    def extract(directory):
+      with open(join(directory, 'data'), 'wb') as fp:
+        fp.write(b'x' * 1000)
+    tree = cache.put_tree(name * 8, extract)
+    os.utime(tree + '.json', (index, index))
+
+  assert cache.prune(1500) == (1, 1000)
+  assert cache.get_tree('old' * 8) is None
+  assert cache.get_tree('new' * 8) is not None
+
+  # An entry that should be kept is not removed even if it alone is
+  # larger than the cache.
+  assert cache.prune(500, keep=[cache.tree_dir('new' * 8)]) == (0, 0)
+  assert cache.get_tree('new' * 8) is not None
+
+
+def test_download_lock():
+  cache = archivecache.ArchiveCache(join(tempdir, 'lock'))
+  key = cache.download_key('http://example.com/b.zip')
+  acquired = []
+  def wait():
+    with cache.lock_download(key):
+      acquired.append(time.time())
+
+  lock = cache.lock_download(key)
+  thread = threading.Thread(target=wait)
+  thread.start()
+  time.sleep(0.2)
+  assert acquired == []
+  released = time.time()
+  lock.release()
+  lock.release()
+  thread.join()
+  assert acquired[0] >= released
@@ -0,0 +1,109 @@
+
+from craftr import daemon
+from craftr.core import remote, rusage
+from craftr.core.build import ExportContext, Graph, Target, UnixPlatformHelper
+from ninja_syntax import Writer
+from os.path import join
+from shutil import rmtree, which
+from tempfile import mkdtemp
+
+import io
+import os
+import subprocess
+import threading
+import time
+
+tempdir = None
+
+
+def setup_module():
+  global tempdir
+  tempdir = mkdtemp()
+
+
+def teardown_module():
+  rmtree(tempdir)
+
+
+def test_snapshot():
+  os.makedirs(join(tempdir, 'src'))
+  source = join(tempdir, 'src', 'main.c')
+  script = join(tempdir, 'Craftrfile')
+  for filename in [source, script]:
+    open(filename, 'w').close()
+
+  snapshot = daemon.take_snapshot([script, join(tempdir, 'src')])
+  assert daemon.changed_files(snapshot) == []
+
+  # Replacing a file in a directory does not change the directory.
+  with open(source + '.tmp', 'w') as fp:
+    fp.write('int main() { }\n')
+  os.rename(source + '.tmp', source)
+  assert daemon.changed_files(snapshot) == []
+
+  open(join(tempdir, 'src', 'util.c'), 'w').close()
+  with open(script, 'w') as fp:
+    fp.write('# changed\n')
+  assert sorted(daemon.changed_files(snapshot)) == [script, join(tempdir, 'src')]
+
+
+def test_forward():
+  socket_path = join(tempdir, daemon.SOCKET_NAME)
+  assert daemon.forward(socket_path, [], tempdir, {}, io.StringIO(), io.StringIO()) is None
+
+  def handler(request, stdout, stderr):
+    stdout.write(' '.join(request['argv']) + '\n')
+    stderr.write(request['environ']['NAME'] + '\n')
+    return 3
+
+  thread = threading.Thread(target=daemon.serve, args=(socket_path, handler))
+  thread.daemon = True
+  thread.start()
+  for i in range(100):
+    if daemon.is_running(socket_path):
+      break
+    time.sleep(0.01)
+
+  stdout, stderr = io.StringIO(), io.StringIO()
+  returncode = daemon.forward(socket_path, ['export', '-v'], tempdir,
+      {'NAME': 'value'}, stdout, stderr)
+  assert returncode == 3
+  assert stdout.getvalue() == 'export -v\n'
+  assert stderr.getvalue() == 'value\n'
+
+  # The socket is only accessible by the current user, the directory that
+  # it was created in is removed.
+  assert os.stat(socket_path).st_mode & 0o777 == 0o600
+  assert [x for x in os.listdir(tempdir) if x.startswith('.craftr-daemon')] == \
+      [daemon.SOCKET_NAME]
+
+
+def test_export_twice():
+  # The daemon exports the same Graph again on every warm "craftr export".
+  builddir = join(tempdir, 'build')
+  os.makedirs(builddir)
+  open(join(tempdir, 'main.c'), 'w').close()
+  graph = Graph()
+  graph.add_target(Target('main.obj', [['cc', '$in']], [join(tempdir, 'main.c')],
+      [join(builddir, 'main.o')], cacheable=True))
+  workers = [{'address': '127.0.0.1:1', 'jobs': 2}]
+
+  oldcwd = os.getcwd()
+  os.chdir(builddir)
+  try:
+    for jobs in [2, 3]:
+      workers[0]['jobs'] = jobs
+      launchers = [remote.RemoteLauncher(workers, [tempdir]),
+          rusage.ResourceLauncher(builddir, 1024 ** 3, 1024 ** 3)]
+      with open('build.ninja', 'w') as fp:
+        graph.export(Writer(fp), ExportContext('1.7.2', launchers), UnixPlatformHelper())
+  finally:
+    os.chdir(oldcwd)
+
+  with open(join(builddir, 'build.ninja')) as fp:
+    manifest = fp.read()
+  assert manifest.count('pool remote\n') == 1
+  assert 'depth = 3' in manifest
+  assert manifest.count('include ' + join(builddir, rusage.POOL_FILENAME)) == 1
+  if which('ninja'):
+    subprocess.check_call([which('ninja'), '-n'], cwd=builddir, stdout=subprocess.DEVNULL)
@@ -0,0 +1,158 @@
+
+from craftr.core import dyndep
+from craftr.core.build import ExportContext, Graph, Target, UnixPlatformHelper
+from ninja_syntax import Writer
+from os.path import join
+from shutil import rmtree, which
+from tempfile import mkdtemp
+from unittest import SkipTest
+
+import io
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+
+tempdir = None
+
+# A fake source file is a JSON object with the modules that it "provides"
+# and "requires". The scanner converts it to P1689.
+SCANNER = '''
+import json, sys
+with open(sys.argv[1]) as fp:
+  source = json.load(fp)
+rule = {'primary-output': sys.argv[2]}
+rule['provides'] = [{'logical-name': x} for x in source.get('provides', [])]
+rule['requires'] = [{'logical-name': x} for x in source.get('requires', [])]
+with open(sys.argv[2], 'w') as fp:
+  json.dump({'version': 1, 'revision': 0, 'rules': [rule]}, fp)
+'''
+
+# The fake compiler reads the GCC-style module map, fails if a required
+# BMI does not exist yet and writes the BMIs of the provided modules.
+COMPILER = '''
+import json, os, sys
+source, output, modmap = sys.argv[1:]
+with open(source) as fp:
+  source = json.load(fp)
+bmis = dict(line.split() for line in open(modmap) if line.strip())
+for name in source.get('requires', []):
+  if not os.path.isfile(bmis[name]):
+    sys.exit('missing BMI for ' + name)
+for name in source.get('provides', []):
+  open(bmis[name], 'w').close()
+open(output, 'w').close()
+with open('compile.log', 'a') as fp:
+  fp.write(os.path.basename(output) + '\\n')
+'''
+
+
+def setup_module():
+  global tempdir
+  tempdir = mkdtemp()
+
+
+def teardown_module():
+  rmtree(tempdir)
+
+
+def command(args):
+  return ' '.join(x if x.startswith('$') else shlex.quote(x) for x in args)
+
+
+def write_source(project, name, provides=(), requires=()):
+  filename = join(project, name)
+  exists = os.path.exists(filename)
+  with open(filename, 'w') as fp:
+    json.dump({'provides': list(provides), 'requires': list(requires)}, fp)
+  if not exists:
+    # Make sure that sources modified later are newer than the outputs.
+    mtime = time.time() - 60
+    os.utime(filename, (mtime, mtime))
+  return filename
+
+
+def test_export():
+  graph = Graph()
+  target = Target('main.compile', [['cc', '$in', '-o', '$out']],
+      ['a.cpp'], ['a.o'], dyndep='main.dd')
+  graph.add_target(target)
+  assert os.path.abspath('main.dd') in target.order_only_deps
+  fp = io.StringIO()
+  graph.export(Writer(fp), ExportContext('1.10.0'), UnixPlatformHelper())
+  # Long lines are wrapped depending on the length of the paths.
+  manifest = re.sub(r' \$\n +', ' ', fp.getvalue())
+  assert 'ninja_required_version = 1.10' in manifest
+  build = next(x for x in manifest.split('\n')
+      if x.startswith('build ') and ': main.compile ' in x)
+  assert os.path.abspath('main.dd') in build.partition(' || ')[2].split()
+  assert 'dyndep = ' + os.path.abspath('main.dd') in manifest
+
+
+def test_collate_and_build():
+  ninja = which('ninja')
+  if not ninja:
+    raise SkipTest('ninja is not available')
+
+  project = join(tempdir, 'project')
+  os.makedirs(project)
+  for name, content in [('scan.py', SCANNER), ('cc.py', COMPILER)]:
+    with open(join(project, name), 'w') as fp:
+      fp.write(content)
+
+  sources = [
+    write_source(project, 'main', requires=['app']),
+    write_source(project, 'app', provides=['app'], requires=['util', 'app:part']),
+    write_source(project, 'part', provides=['app:part'], requires=['util']),
+    write_source(project, 'util', provides=['util']),
+  ]
+  objects = [x + '.o' for x in sources]
+  scans = [x + dyndep.SCAN_SUFFIX for x in objects]
+  output = join(project, 'modules.dd')
+
+  with open(join(project, 'build.ninja'), 'w') as fp:
+    writer = Writer(fp)
+    writer.variable('ninja_required_version', '1.10')
+    writer.rule('scan', command([sys.executable, join(project, 'scan.py'), '$in', '$out']))
+    writer.rule('collate', command([sys.executable, '-m', 'craftr.core.dyndep',
+        'collate', '--compiler', 'gcc', '--output', output, '--bmi-dir',
+        join(project, 'bmi'), '$in']), restat=True)
+    writer.rule('cc', command([sys.executable, join(project, 'cc.py'), '$in',
+        '$out', '$out' + dyndep.MODMAP_SUFFIX]))
+    for source, scan in zip(sources, scans):
+      writer.build(scan, 'scan', source)
+    writer.build([output] + [x + dyndep.MODMAP_SUFFIX for x in objects],
+        'collate', scans)
+    for source, obj in zip(sources, objects):
+      writer.build(obj, 'cc', source, order_only=[output],
+          variables={'dyndep': output})
+
+  env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(
+      os.path.dirname(os.path.abspath(dyndep.__file__)))))
+
+  def build():
+    subprocess.check_call([ninja], cwd=project, env=env, stdout=subprocess.DEVNULL)
+    with open(join(project, 'compile.log')) as fp:
+      return fp.read().split()
+
+  # The modules are compiled before the translation units that import them.
+  order = build()
+  assert sorted(order) == sorted(os.path.basename(x) for x in objects)
+  assert order.index('util.o') < order.index('part.o') < order.index('app.o')
+  assert order.index('app.o') < order.index('main.o')
+
+  # Changing a source without changing the imports does not recompile the
+  # translation units that are not affected by the module map.
+  write_source(project, 'main', requires=['app'])
+  assert build()[len(order):] == ['main.o']
+
+  # The BMI of "util" changes, thus all its (transitive) importers are
+  # recompiled after it.
+  count = len(order) + 1
+  write_source(project, 'util', provides=['util'])
+  order = build()[count:]
+  assert sorted(order) == sorted(os.path.basename(x) for x in objects)
+  assert order[0] == 'util.o'
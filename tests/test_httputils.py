@@ -0,0 +1,115 @@
+
+from craftr.utils import httputils
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import hashlib
+import os
+import threading
+
+CONTENT = bytes(range(256)) * 4096
+tempdir = None
+server = None
+requests_log = []
+
+
+class Handler(BaseHTTPRequestHandler):
+
+  #: The number of bytes after which the next response is cut off.
+  cutoff = None
+
+  def do_GET(self):
+    offset = 0
+    status = 200
+    range_header = self.headers.get('Range')
+    requests_log.append(range_header)
+    if range_header and self.headers.get('If-Range') == '"v1"':
+      offset = int(range_header[len('bytes='):].rstrip('-'))
+      status = 206
+    data = CONTENT[offset:]
+    self.send_response(status)
+    self.send_header('Content-Length', str(len(data)))
+    self.send_header('Accept-Ranges', 'bytes')
+    self.send_header('ETag', '"v1"')
+    self.end_headers()
+    if Handler.cutoff is not None:
+      data = data[:Handler.cutoff]
+      Handler.cutoff = None
+      self.close_connection = True
+    self.wfile.write(data)
+
+  def log_message(self, *args):
+    pass
+
+
+def setup_module():
+  global tempdir, server
+  tempdir = mkdtemp()
+  server = HTTPServer(('127.0.0.1', 0), Handler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+
+
+def teardown_module():
+  server.shutdown()
+  server.server_close()
+  rmtree(tempdir)
+
+
+def get_url(name):
+  return 'http://127.0.0.1:{}/{}'.format(server.server_address[1], name)
+
+
+def test_download():
+  filename, reused = httputils.download_file(get_url('a.bin'), directory=tempdir)
+  assert (filename, reused) == (join(tempdir, 'a.bin'), False)
+  with open(filename, 'rb') as fp:
+    assert fp.read() == CONTENT
+  assert not os.path.exists(filename + '.part')
+  assert httputils.download_file(get_url('a.bin'), directory=tempdir,
+      on_exists='skip') == (filename, True)
+
+
+def test_resume_interrupted():
+  del requests_log[:]
+  Handler.cutoff = 100000
+  filename = join(tempdir, 'b.bin')
+  assert httputils.download_file(get_url('b.bin'), filename=filename,
+      chunksize=4096) == (filename, False)
+  with open(filename, 'rb') as fp:
+    assert fp.read() == CONTENT
+  # The chunk that was being read when the connection was closed is lost.
+  assert len(requests_log) == 2 and requests_log[0] is None
+  assert 0 < int(requests_log[1][len('bytes='):].rstrip('-')) <= 100000
+
+
+def test_resume_partial_file():
+  filename = join(tempdir, 'c.bin')
+  with open(filename + '.part', 'wb') as fp:
+    fp.write(CONTENT[:5000])
+  with open(filename + '.part.json', 'w') as fp:
+    fp.write('{"url": "%s", "validator": "\\"v1\\""}' % get_url('c.bin'))
+
+  del requests_log[:]
+  httputils.download_file(get_url('c.bin'), filename=filename)
+  with open(filename, 'rb') as fp:
+    assert fp.read() == CONTENT
+  assert requests_log == [None, 'bytes=5000-']
+  assert not os.path.exists(filename + '.part.json')
+
+
+def test_hash_resumed():
+  filename = join(tempdir, 'd.bin')
+  with open(filename + '.part', 'wb') as fp:
+    fp.write(CONTENT[:5000])
+  with open(filename + '.part.json', 'w') as fp:
+    fp.write('{"url": "%s", "validator": "\\"v1\\""}' % get_url('d.bin'))
+
+  download = httputils.Download(get_url('d.bin'), filename=filename, hash_name='sha256')
+  download.start()
+  download.finish()
+  assert download.offset == 5000
+  assert download.hexdigest == hashlib.sha256(CONTENT).hexdigest()
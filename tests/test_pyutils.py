@@ -0,0 +1,41 @@
+
+from craftr.utils import pyutils
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import io
+import os
+
+CONTENT = bytes(range(256)) * 1024
+tempdir = None
+
+
+def setup_module():
+  global tempdir
+  tempdir = mkdtemp()
+  with open(join(tempdir, 'source'), 'wb') as fp:
+    fp.write(CONTENT)
+
+
+def teardown_module():
+  rmtree(tempdir)
+
+
+def test_copyfileobj():
+  sfp, dfp = io.BytesIO(CONTENT), io.BytesIO()
+  progress = list(pyutils.copyfileobj(sfp, dfp, chunksize=100000))
+  assert dfp.getvalue() == CONTENT
+  assert progress == [(0, len(CONTENT)), (100000, len(CONTENT)),
+      (200000, len(CONTENT)), (len(CONTENT), len(CONTENT))]
+
+
+def test_copyfile():
+  for link in (False, True):
+    dest = join(tempdir, 'dest_{}'.format(link))
+    progress = list(pyutils.copyfile(join(tempdir, 'source'), dest, link))
+    assert progress[-1] == (len(CONTENT), len(CONTENT))
+    with open(dest, 'rb') as fp:
+      assert fp.read() == CONTENT
+    is_link = os.stat(dest).st_ino == os.stat(join(tempdir, 'source')).st_ino
+    assert is_link == link
@@ -0,0 +1,169 @@
+
+from craftr.core import remote
+from os import chdir, getcwd, makedirs
+from os.path import join, isfile
+from shutil import rmtree, which
+from tempfile import mkdtemp
+from threading import Thread
+from unittest import SkipTest
+
+import json
+import socket
+
+SECRET = 'test-secret'
+workers = []
+tempdir = None
+
+
+def setup_module():
+  global tempdir
+  tempdir = mkdtemp()
+  for index in range(3):
+    worker = remote.Worker(('127.0.0.1', 0), join(tempdir, 'worker{}'.format(index)), 1, SECRET)
+    Thread(target=worker.serve_forever, daemon=True).start()
+    workers.append(worker)
+
+
+def teardown_module():
+  for worker in workers:
+    worker.shutdown()
+    worker.server_close()
+  rmtree(tempdir)
+
+
+def address(worker):
+  return '{}:{}'.format(*worker.server_address)
+
+
+def make_project(name, workers):
+  """
+  Creates a project and build directory with a C source file that includes
+  a header from the project directory and writes the worker configuration.
+  """
+
+  project = join(tempdir, name)
+  builddir = join(project, 'build')
+  config = join(builddir, remote.CONFIG_FILENAME)
+  rmtree(project, ignore_errors=True)
+  makedirs(join(project, 'include'))
+  makedirs(builddir)
+  with open(join(project, 'include', 'answer.h'), 'w') as fp:
+    fp.write('#define ANSWER 42  /* {} */\n'.format(name))
+  with open(join(project, 'main.c'), 'w') as fp:
+    fp.write('#include "answer.h"\nint {}(void) {{ return ANSWER; }}\n'.format(name))
+  with open(config, 'w') as fp:
+    json.dump({'workers': remote.query_workers([address(x) for x in workers], SECRET),
+        'secret': SECRET}, fp)
+  return project, builddir, config
+
+
+def compile(project, builddir, config):
+  source = join(project, 'main.c')
+  output = join(builddir, 'main.o')
+  depfile = output + '.d'
+  command = ['gcc', '-c', source, '-o', output, '-I' + join(project, 'include'),
+      '-MD', '-MP', '-MF', depfile]
+  oldcwd = getcwd()
+  chdir(builddir)
+  try:
+    return remote.main(['--config', config, '--root', project, '--root', builddir,
+        '--depfile', depfile, '--inputs', source, '--outputs', output, '--'] + command)
+  finally:
+    chdir(oldcwd)
+
+
+def require_gcc():
+  if not which('gcc'):
+    raise SkipTest('gcc is not available')
+
+
+def test_query_workers():
+  found = remote.query_workers([address(x) for x in workers] + ['127.0.0.1:1'], SECRET)
+  assert len(found) == 3
+  launcher = remote.RemoteLauncher(found, [tempdir])
+  assert launcher.depth == 3
+  assert remote.query_workers([address(x) for x in workers], 'wrong') == []
+
+
+def request(worker, header, secret=SECRET):
+  with socket.create_connection(worker.server_address) as sock:
+    remote.send_message(sock, header, secret=secret)
+    return remote.recv_message(sock.makefile('rb'))[0]
+
+
+def test_authentication():
+  worker = workers[0]
+  assert request(worker, {'op': 'info'})['status'] == 'ok'
+  for secret in [None, 'wrong']:
+    response = request(worker, {'op': 'info'}, secret)
+    assert response == {'status': 'error', 'message': 'authentication failed'}
+  # The signature covers the header.
+  header = {'op': 'info', 'auth': remote.sign(SECRET, {'op': 'has'}, b'')}
+  assert request(worker, header, None)['status'] == 'error'
+
+
+def test_sandbox():
+  worker = workers[0]
+  digest = remote.hash_bytes(b'')
+  response = request(worker, {'op': 'put', 'digest': digest})
+  assert response['status'] == 'ok'
+  escape = join(tempdir, 'escaped.txt')
+  for files, outputs in [({'@ROOT0@/../../../../escaped.txt': digest}, []),
+      ({escape: digest}, []), ({}, ['/etc/passwd'])]:
+    response = request(worker, {'op': 'execute', 'roots': 1, 'command': ['true'],
+        'files': files, 'outputs': outputs})
+    assert response['status'] == 'error'
+    assert 'outside of the sandbox' in response['message']
+  assert not isfile(escape)
+
+
+def test_compile_remote():
+  require_gcc()
+  project, builddir, config = make_project('compile_remote', workers)
+  executed = sum(x.stats['executed'] for x in workers)
+  assert compile(project, builddir, config) == 0
+  assert sum(x.stats['executed'] for x in workers) == executed + 1
+  assert isfile(join(builddir, 'main.o'))
+  with open(join(builddir, 'main.o.d')) as fp:
+    depfile = fp.read()
+  assert join(project, 'include', 'answer.h') in depfile
+  assert '@ROOT' not in depfile
+
+
+def test_blobs_are_uploaded_once():
+  require_gcc()
+  worker = workers[0]
+  project, builddir, config = make_project('blobs', [worker])
+  uploads = worker.stats['uploads']
+  assert compile(project, builddir, config) == 0
+  assert worker.stats['uploads'] == uploads + 2
+  assert compile(project, builddir, config) == 0
+  assert worker.stats['uploads'] == uploads + 2
+
+
+def test_busy_workers_fall_back_to_local():
+  require_gcc()
+  project, builddir, config = make_project('busy', workers)
+  for worker in workers:
+    worker.semaphore.acquire()
+  try:
+    executed = sum(x.stats['executed'] for x in workers)
+    assert compile(project, builddir, config) == 0
+    assert sum(x.stats['executed'] for x in workers) == executed
+    assert isfile(join(builddir, 'main.o'))
+  finally:
+    for worker in workers:
+      worker.semaphore.release()
+
+
+def test_local_slots():
+  prefix = join(tempdir, 'slots')
+  first = remote.LocalSlot.acquire(prefix, 2)
+  second = remote.LocalSlot.acquire(prefix, 2)
+  assert first and second
+  assert remote.LocalSlot.acquire(prefix, 2) is None
+  second.close()
+  with remote.LocalSlot.acquire(prefix, 2) as third:
+    assert third is not None
+    assert remote.LocalSlot.acquire(prefix, 2) is None
+  first.close()
@@ -0,0 +1,95 @@
+
+from craftr.core import restat
+from craftr.core.build import ExportContext, Target, UnixPlatformHelper
+from ninja_syntax import Writer
+from os.path import join
+from shutil import rmtree, which
+from tempfile import mkdtemp
+from unittest import SkipTest
+
+import io
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+tempdir = None
+
+# A code generator that always rewrites its output, like moc or cython.
+GENERATOR = '''
+import sys
+with open(sys.argv[1]) as src, open(sys.argv[2], 'w') as dst:
+  dst.write('#define VALUE ' + src.read().strip() + '\\n')
+'''
+
+
+def setup_module():
+  global tempdir
+  tempdir = mkdtemp()
+
+
+def teardown_module():
+  rmtree(tempdir)
+
+
+def bump_mtime(filename, content=None):
+  if content is not None:
+    with open(filename, 'w') as fp:
+      fp.write(content)
+  mtime = time.time() + 10
+  if os.path.exists(filename):
+    mtime = max(mtime, os.stat(filename).st_mtime + 10)
+  os.utime(filename, (mtime, mtime))
+
+
+def command(args):
+  return ' '.join(x if x.startswith('$') else shlex.quote(x) for x in args)
+
+
+def test_export():
+  target = Target('main.gen', [['gen', '$in', '$out']], ['value.txt'],
+      ['value.h'], restat=True)
+  fp = io.StringIO()
+  target.export(Writer(fp), ExportContext('1.7.2'), UnixPlatformHelper())
+  manifest = fp.getvalue()
+  assert 'restat = 1' in manifest
+  assert 'craftr.core.restat' in manifest
+
+
+def test_unchanged_output_does_not_relink():
+  ninja = which('ninja')
+  if not ninja:
+    raise SkipTest('ninja is not available')
+
+  project = join(tempdir, 'project')
+  os.makedirs(project)
+  with open(join(project, 'gen.py'), 'w') as fp:
+    fp.write(GENERATOR)
+  with open(join(project, 'value.txt'), 'w') as fp:
+    fp.write('42\n')
+
+  gen = [sys.executable, join(project, 'gen.py'), '$in', '$out']
+  link = [sys.executable, '-c', 'import sys; open(sys.argv[1], "w"); '
+      'open("link.log", "a").write("linked\\n")', '$out']
+  with open(join(project, 'build.ninja'), 'w') as fp:
+    writer = Writer(fp)
+    writer.rule('gen', command(restat.wrap(gen)), restat=True)
+    writer.rule('link', command(link))
+    writer.build('value.h', 'gen', 'value.txt')
+    writer.build('app', 'link', implicit=['value.h'])
+
+  def build():
+    subprocess.check_call([ninja], cwd=project, stdout=subprocess.DEVNULL)
+    with open(join(project, 'link.log')) as fp:
+      return fp.read().count('linked')
+
+  assert build() == 1
+
+  # The generator runs again but produces the same header.
+  bump_mtime(join(project, 'value.txt'))
+  assert build() == 1
+
+  # A different header must relink the application.
+  bump_mtime(join(project, 'value.txt'), '43\n')
+  assert build() == 2
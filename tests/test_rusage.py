@@ -0,0 +1,51 @@
+
+from craftr.core import rusage
+from craftr.core.build import ExportContext, Graph, Target, UnixPlatformHelper
+from ninja_syntax import Writer
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import SkipTest
+
+import io
+import sys
+
+tempdir = None
+
+# Allocates about 200 MB.
+ALLOCATE = 'x = bytearray(200 * 1024 * 1024); x[::4096] = b"x" * len(x[::4096])'
+
+
+def setup_module():
+  global tempdir
+  tempdir = mkdtemp()
+
+
+def teardown_module():
+  rmtree(tempdir)
+
+
+def test_record_and_export():
+  if not rusage.is_available():
+    raise SkipTest('os.wait4() is not available')
+  database = join(tempdir, rusage.DATABASE_FILENAME)
+  assert rusage.execute(database, 'main.heavy', [sys.executable, '-c', ALLOCATE]) == 0
+  assert rusage.execute(database, 'main.light', [sys.executable, '-c', 'exit(3)']) == 3
+
+  peaks = rusage.get_peaks(database)
+  assert peaks['main.heavy'] >= 200 * 1024 ** 2 > peaks['main.light']
+
+  launcher = rusage.ResourceLauncher(tempdir, 100 * 1024 ** 2, 1024 ** 3)
+  assert list(launcher.heavy) == ['main.heavy']
+  graph = Graph()
+  graph.add_target(Target('main.heavy', [['cc', '$in']], ['a.c'], ['a.o']))
+  graph.add_target(Target('main.light', [['cc', '$in']], ['b.c'], ['b.o']))
+  fp = io.StringIO()
+  graph.export(Writer(fp), ExportContext('1.7.2', [launcher]), UnixPlatformHelper())
+  manifest = fp.getvalue()
+  assert 'include ' + join(tempdir, rusage.POOL_FILENAME) in manifest
+  assert manifest.count('pool = mem_heavy') == 1
+  with open(join(tempdir, rusage.POOL_FILENAME)) as fp:
+    depth = int(fp.read().split('=')[1])
+  assert depth == rusage.heavy_pool_depth({'main.heavy': peaks['main.heavy']}, 1024 ** 3)
+  assert 1 <= depth <= 4
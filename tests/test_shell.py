@@ -0,0 +1,106 @@
+
+from craftr.utils import shell
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import craftr
+import os
+import sys
+import time
+
+
+def test_gather():
+  start = time.perf_counter()
+  results = shell.gather(
+    shell.pipe_async([sys.executable, '-c', 'import time; time.sleep(0.3); print("a")']),
+    shell.pipe_async([sys.executable, '-c', 'import time; time.sleep(0.3); exit(3)']),
+    shell.pipe_async([sys.executable, '-c', 'import os; print(os.environ["NAME"])'],
+        env={'NAME': 'value'}),
+    shell.pipe_async([sys.executable, '-c', 'print(input())'], input=b'in'),
+    shell.pipe_async(['craftr-test-nonexistent-program']),
+    return_exceptions=True)
+  assert time.perf_counter() - start < 0.6
+  assert results[0].output.strip() == 'a'
+  assert results[1].returncode == 3
+  assert results[2].output.strip() == 'value'
+  assert results[3].output.strip() == 'in'
+  assert isinstance(results[4], FileNotFoundError)
+
+
+def test_run_async_errors():
+  try:
+    shell.gather(shell.run_async([sys.executable, '-c', 'exit(1)'], check=True))
+  except shell.CalledProcessError as exc:
+    assert exc.returncode == 1
+  else:
+    assert False, 'CalledProcessError not raised'
+
+  try:
+    shell.gather(shell.run_async([sys.executable, '-c', 'import time; time.sleep(5)'], timeout=0.2))
+  except shell.TimeoutExpired:
+    pass
+  else:
+    assert False, 'TimeoutExpired not raised'
+
+
+def test_gather_fresh_interpreter():
+  # gather() must not depend on state set up by another test, eg. an
+  # event loop or a child watcher.
+  code = (
+    'import sys\n'
+    'from craftr.utils import shell\n'
+    'a, b = shell.gather(shell.pipe_async([sys.executable, "-c", "print(1)"]),\n'
+    '                    shell.pipe_async([sys.executable, "-c", "print(2)"]))\n'
+    'print(a.output.strip() + b.output.strip())\n')
+  root = os.path.dirname(os.path.dirname(os.path.abspath(craftr.__file__)))
+  result = shell.pipe([sys.executable, '-c', code], env={'PYTHONPATH': root},
+      check=True)
+  assert result.output.strip() == '12'
+
+
+def test_find_program_cache():
+  tempdir = mkdtemp()
+  old_path = os.environ['PATH']
+  dirs = [join(tempdir, 'a'), join(tempdir, 'b')]
+  for dirname in dirs:
+    os.makedirs(dirname)
+  def make_program(dirname):
+    filename = join(dirname, 'craftr-test-program')
+    with open(filename, 'w') as fp:
+      fp.write('#!/bin/sh\n')
+    os.chmod(filename, 0o755)
+    return filename
+
+  def set_mtimes():
+    for dirname in dirs:
+      os.utime(dirname, (time.time() - 10, time.time() - 10))
+
+  os.environ['PATH'] = os.pathsep.join(dirs)
+  try:
+    second = make_program(dirs[1])
+    set_mtimes()
+    assert shell.find_program('craftr-test-program') == second
+    # A program that is added earlier in the PATH invalidates the result.
+    first = make_program(dirs[0])
+    assert shell.find_program('craftr-test-program') == first
+    os.remove(first)
+    set_mtimes()
+    assert shell.find_program('craftr-test-program') == second
+
+    cachefile = join(tempdir, shell.PROGRAM_CACHE_FILENAME)
+    shell.save_program_cache(cachefile)
+    shell._program_cache.clear()
+    shell.load_program_cache(cachefile)
+    key = ('craftr-test-program', os.environ['PATH'], os.environ.get('PATHEXT', ''))
+    assert shell._program_cache[key][0] == second
+    os.remove(second)
+    try:
+      shell.find_program('craftr-test-program')
+    except FileNotFoundError:
+      pass
+    else:
+      assert False, 'FileNotFoundError not raised'
+  finally:
+    os.environ['PATH'] = old_path
+    rmtree(tempdir)
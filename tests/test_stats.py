@@ -0,0 +1,96 @@
+
+from craftr import stats
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import os
+
+tempdir = None
+
+# Two Ninja invocations, the second one starts when the end time drops.
+FIRST_RUN = [(0, 100, 'a.o'), (50, 300, 'b.o'), (300, 400, 'app')]
+SECOND_RUN = [(0, 80, 'a.o'), (80, 150, 'app')]
+
+
+def setup_module():
+  global tempdir
+  tempdir = mkdtemp()
+
+
+def teardown_module():
+  rmtree(tempdir)
+
+
+def format_entries(entries):
+  return ''.join('{}\t{}\t0\t{}\tdeadbeef\n'.format(*x) for x in entries)
+
+
+def test_read_log_and_split_runs():
+  filename = join(tempdir, 'read.ninja_log')
+  with open(filename, 'w') as fp:
+    fp.write('# ninja log v5\n' + format_entries(FIRST_RUN + SECOND_RUN))
+    fp.write('150\t2')  # Ninja is still writing this line
+
+  entries, offset = stats.read_log(filename, 0)
+  assert entries == FIRST_RUN + SECOND_RUN
+  assert offset == os.path.getsize(filename) - len('150\t2')
+  assert stats.split_runs(entries) == [FIRST_RUN, SECOND_RUN]
+
+  # The partial line is read once it is complete.
+  assert stats.read_log(filename, offset) == ([], offset)
+  with open(filename, 'a') as fp:
+    fp.write('00\t0\tlib.a\tdeadbeef\n')
+  entries, offset = stats.read_log(filename, offset)
+  assert entries == [(150, 200, 'lib.a')]
+  assert offset == os.path.getsize(filename)
+
+
+def test_import_recompacted_log():
+  builddir = join(tempdir, 'build')
+  os.makedirs(builddir)
+  logfile = join(builddir, '.ninja_log')
+  cache = {'target_outputs': {'main.app': [join(builddir, 'app')]}}
+  with open(logfile, 'w') as fp:
+    fp.write('# ninja log v5\n' + format_entries(FIRST_RUN + SECOND_RUN))
+  assert stats.import_log(builddir, tempdir, cache) == 2
+  assert stats.import_log(builddir, tempdir, cache) == 0
+
+  # Ninja recompacts the log by writing a new file, only the most recent
+  # invocation can be told apart.
+  with open(logfile + '.tmp', 'w') as fp:
+    fp.write('# ninja log v5\n' + format_entries(FIRST_RUN[1:] + SECOND_RUN))
+  os.replace(logfile + '.tmp', logfile)
+  assert stats.import_log(builddir, tempdir, cache) == 1
+
+  db = stats.open_database(builddir)
+  try:
+    build = stats.get_build(db)
+    assert build[3] == 150
+    edges = sorted(stats.get_edges(db, build[0]))
+    assert edges == [stats.Edge('a.o', 0, 80), stats.Edge('main.app', 80, 150)]
+  finally:
+    db.close()
+
+
+def test_critical_path_and_parallelism():
+  edges = [stats.Edge('main.a', 0, 100), stats.Edge('main.b', 100, 300),
+      stats.Edge('main.b', 100, 150), stats.Edge('main.c', 300, 350),
+      stats.Edge('other.d', 0, 300)]
+  deps = {'main.c': ['main.b'], 'main.b': ['main.a']}
+  assert stats.critical_path(edges, deps) == (350, ['main.a', 'main.b', 'main.c'])
+  assert stats.critical_path([], deps) == (0, [])
+
+  edges = [stats.Edge('a', 0, 100), stats.Edge('b', 0, 50)]
+  assert stats.parallelism(edges, buckets=2) == [(0, 2.0), (50, 1.0)]
+  assert stats.parallelism([]) == []
+
+
+def test_critical_path_long_chain():
+  count = 5000
+  edges = [stats.Edge('t{}'.format(i), i, i + 1) for i in range(count)]
+  deps = {'t{}'.format(i): ['t{}'.format(i - 1)] for i in range(1, count)}
+  deps['t0'] = ['t{}'.format(count - 1)]  # a cycle is ignored
+  total, path = stats.critical_path(edges, deps)
+  assert total == count
+  assert len(path) == count
@@ -0,0 +1,105 @@
+
+from craftr import watch
+from craftr.core.build import Graph, Target
+from os.path import join
+from shutil import rmtree, which
+from tempfile import mkdtemp
+from types import SimpleNamespace
+from unittest import SkipTest
+
+import os
+import subprocess
+import sys
+
+tempdir = None
+
+
+def setup_module():
+  global tempdir
+  tempdir = mkdtemp()
+  for name in ['src/sub', 'build']:
+    os.makedirs(join(tempdir, name))
+  for name in ['Craftrfile', 'src/a.c', 'src/sub/b.c', 'src/a.h']:
+    open(join(tempdir, name), 'w').close()
+
+
+def teardown_module():
+  rmtree(tempdir)
+
+
+def make_state():
+  graph = Graph()
+  objects = [join(tempdir, 'build', x) for x in ['a.o', 'b.o']]
+  graph.add_target(Target('main.objects', [['cc', '$in']],
+      [join(tempdir, 'src/a.c'), join(tempdir, 'src/sub/b.c')], objects,
+      foreach=True))
+  graph.add_target(Target('main.app', [['ld', '$in']], objects,
+      [join(tempdir, 'build/app')]))
+  module = SimpleNamespace(dependent_files=[join(tempdir, 'Craftrfile')],
+      glob_patterns=[join(tempdir, 'src/**/*.c')])
+  return watch.WatchState([module], graph, {'main.app': ['main.objects']},
+      join(tempdir, 'build'))
+
+
+def test_classify():
+  state = make_state()
+  src = join(tempdir, 'src')
+  assert state.directories == {tempdir, src, join(src, 'sub')}
+
+  # A changed input rebuilds its target and the targets that depend on it.
+  assert state.classify({join(src, 'a.c'): watch.IN_CLOSE_WRITE}) == \
+      ('build', ['main.app', 'main.objects'])
+  # Saving a file by renaming a temporary file is not a new source.
+  assert state.classify({
+      join(src, 'sub', '.b.c.swp'): watch.IN_CREATE | watch.IN_MOVED_FROM,
+      join(src, 'sub', 'b.c'): watch.IN_MOVED_TO}) == \
+      ('build', ['main.app', 'main.objects'])
+  # Files that are unknown to Craftr might be known to Ninja.
+  assert state.classify({join(src, 'a.h'): watch.IN_CLOSE_WRITE}) == ('build', None)
+  assert state.classify({join(tempdir, 'build', 'a.o'): watch.IN_CLOSE_WRITE}) == (None, None)
+
+  assert state.classify({join(tempdir, 'Craftrfile'): watch.IN_CLOSE_WRITE}) == ('export', None)
+  open(join(src, 'c.c'), 'w').close()
+  try:
+    assert state.classify({join(src, 'c.c'): watch.IN_CREATE}) == ('export', None)
+  finally:
+    os.remove(join(src, 'c.c'))
+
+
+def test_inotify():
+  if not sys.platform.startswith('linux'):
+    raise SkipTest('inotify is only available on Linux')
+  with watch.Inotify() as inotify:
+    inotify.update([join(tempdir, 'src')])
+    with open(join(tempdir, 'src', 'a.c'), 'w') as fp:
+      fp.write('int main() { }\n')
+    changes = inotify.wait(0.05)
+  assert changes[join(tempdir, 'src', 'a.c')] & watch.IN_CLOSE_WRITE
+
+
+def test_discovered_deps():
+  include = join(tempdir, 'include')
+  os.makedirs(include)
+  with open(join(include, 'b.h'), 'w') as fp:
+    fp.write('#define B 1\n')
+  with open(join(tempdir, 'src', 'sub', 'b.c'), 'w') as fp:
+    fp.write('#include "b.h"\n')
+  builddir = join(tempdir, 'build')
+  with open(join(builddir, 'build.ninja'), 'w') as fp:
+    fp.write('rule cc\n  command = {} -c "{}" $in $out.d $out\n'.format(
+        sys.executable.replace('$', '$$'),
+        "import sys; open(sys.argv[2], 'w').write(sys.argv[3] + ': "
+        + join(include, 'b.h') + "\\n'); open(sys.argv[3], 'w').close()"))
+    fp.write('  depfile = $out.d\n  deps = gcc\n')
+    fp.write('build b.o: cc ../src/sub/b.c\n')
+
+  state = make_state()
+  assert include not in state.directories
+  ninja = which('ninja')
+  if not ninja:
+    raise SkipTest('ninja is not available')
+  subprocess.check_call([ninja], cwd=builddir, stdout=subprocess.DEVNULL)
+  state.discovered = watch.read_ninja_deps(ninja, builddir)
+  assert join(include, 'b.h') in state.discovered
+  assert include in state.directories
+  assert state.classify({join(include, 'b.h'): watch.IN_CLOSE_WRITE}) == ('build', None)
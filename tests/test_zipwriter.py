@@ -0,0 +1,73 @@
+
+from craftr.utils import zipwriter
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import json
+import os
+import zipfile
+
+tempdir = None
+
+
+def setup_module():
+  global tempdir
+  tempdir = mkdtemp()
+  for index in range(8):
+    with open(join(tempdir, 'file{}.txt'.format(index)), 'w') as fp:
+      fp.write('content of file {}\n'.format(index) * (index * 1000 + 1))
+
+
+def teardown_module():
+  rmtree(tempdir)
+
+
+def get_members():
+  return [(join(tempdir, 'file{}.txt'.format(index)), 'dir/file{}.txt'.format(index))
+      for index in reversed(range(8))]
+
+
+def read(filename):
+  with open(filename, 'rb') as fp:
+    return fp.read()
+
+
+def test_write_zip():
+  filename = join(tempdir, 'a.zip')
+  assert zipwriter.write_zip(filename, get_members(), jobs=2)
+  with zipfile.ZipFile(filename) as zf:
+    assert zf.testzip() is None
+    assert zf.namelist() == sorted(x[1] for x in get_members())
+    assert zf.read('dir/file3.txt') == read(join(tempdir, 'file3.txt'))
+    assert zf.getinfo('dir/file3.txt').date_time == zipwriter.DEFAULT_DATE_TIME
+
+  # The archive is deterministic.
+  other = join(tempdir, 'b.zip')
+  zipwriter.write_zip(other, get_members(), jobs=1, incremental=False)
+  assert read(filename) == read(other)
+
+
+def test_incremental():
+  filename = join(tempdir, 'c.zip')
+  zipwriter.write_zip(filename, get_members())
+  content = read(filename)
+
+  # The index lists the members in the order of the archive.
+  with open(filename + zipwriter.INDEX_SUFFIX) as fp:
+    index = json.load(fp)
+  with zipfile.ZipFile(filename) as zf:
+    assert [x['arc_name'] for x in index['members']] == zf.namelist()
+
+  # The modification time changed, but not the content.
+  os.utime(join(tempdir, 'file2.txt'), (0, 0))
+  assert not zipwriter.write_zip(filename, get_members())
+  assert read(filename) == content
+
+  with open(join(tempdir, 'file5.txt'), 'a') as fp:
+    fp.write('more content\n')
+  assert zipwriter.write_zip(filename, get_members())
+  with zipfile.ZipFile(filename) as zf:
+    assert zf.testzip() is None
+    assert zf.read('dir/file5.txt') == read(join(tempdir, 'file5.txt'))
+    assert zf.read('dir/file2.txt') == read(join(tempdir, 'file2.txt'))